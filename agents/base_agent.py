@@ -4,16 +4,58 @@ Agent基类定义
 """
 
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple, Callable, Awaitable, Iterator
 import json
+import hashlib
 from datetime import datetime
 import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
 
+from llm.usage import track_usage, summarize_usage
+from llm.telemetry import agent_scope, mark_repair
+from llm.structured_output import (
+    schema_from_format, validate_output, apply_patch,
+    build_repair_prompt, build_reformat_prompt, is_raw_response
+)
+
+
+# 当前执行中未通过输出校验的LLM回答（由enforce_output记录，execute据此决定是否登记结果索引）
+_output_problems: ContextVar[Optional[List[str]]] = ContextVar("agent_output_problems", default=None)
+
+# 当前执行所属的项目ID（由execute设置，供process中读写项目级缓存）
+_current_project: ContextVar[Optional[str]] = ContextVar("agent_project", default=None)
+
+
+@contextmanager
+def collect_output_problems() -> Iterator[List[str]]:
+    """收集范围内未通过输出校验的回答（可嵌套，内层收集的问题不会进入外层）"""
+    problems: List[str] = []
+    token = _output_problems.set(problems)
+    try:
+        yield problems
+    finally:
+        _output_problems.reset(token)
+
+
+def report_output_problem(description: str) -> None:
+    """记录一个未通过输出校验的回答到当前收集范围"""
+    problems = _output_problems.get()
+    if problems is not None:
+        problems.append(description)
+
 
 class BaseAgent(ABC):
     """Agent基类"""
     
+    # 允许缺失的输出字段（由post_process计算的字段）
+    OPTIONAL_OUTPUT_FIELDS: Tuple[str, ...] = ()
+    # 输出缺字段时的补全轮数（0表示不补全）
+    MAX_REPAIR_ROUNDS = 1
+    # 单次补全请求最多包含的字段数
+    MAX_REPAIR_FIELDS = 12
+    
     def __init__(self, 
                  name: str, 
                  description: str,
@@ -53,7 +95,8 @@ class BaseAgent(ABC):
     async def execute(self, 
                      project_id: str,
                      input_data: Dict[str, Any],
-                     save_result: bool = True) -> Dict[str, Any]:
+                     save_result: bool = True,
+                     use_cache: bool = True) -> Dict[str, Any]:
         """
         执行Agent任务
         
@@ -61,23 +104,55 @@ class BaseAgent(ABC):
             project_id: 项目ID
             input_data: 输入数据
             save_result: 是否保存结果
+            use_cache: 输入哈希与项目中已有结果相同时直接返回已有结果
         
         Returns:
             Agent处理结果
         """
+        project_token = _current_project.set(project_id)
         try:
             # 记录开始时间
             start_time = datetime.now()
             
-            # 处理数据
-            result = await self.process(input_data)
+            # 计算有效输入的哈希，命中则复用项目中已保存的结果
+            input_hash = self.compute_input_hash(input_data)
+            if use_cache and self.project_manager:
+                cached = self.project_manager.find_prompt_by_hash(project_id, self.get_save_type(), input_hash)
+                if cached:
+                    metadata = cached.get("_metadata", {})
+                    # 本次没有调用LLM：用量清零，原结果的用量移到cached_llm_usage
+                    cached_usage = metadata.pop("llm_usage", None)
+                    metadata.pop("llm_calls", None)
+                    cached["_metadata"] = {
+                        **metadata,
+                        "llm_usage": summarize_usage([]),
+                        "llm_calls": [],
+                        "cached_llm_usage": cached_usage,
+                        "timestamp": datetime.now().isoformat(),
+                        "processing_time": (datetime.now() - start_time).total_seconds(),
+                        "project_id": project_id,
+                        "input_hash": input_hash,
+                        "cache_hit": True,
+                        "cached_at": metadata.get("timestamp")
+                    }
+                    return cached
+            
+            # 处理数据（记录本次执行内所有LLM调用的用量和耗时，以及未通过校验的回答）
+            with track_usage() as usage_records, agent_scope(self.name), collect_output_problems() as problems:
+                result = await self.process(input_data)
             
             # 添加元数据
             result["_metadata"] = {
                 "agent": self.name,
                 "timestamp": datetime.now().isoformat(),
                 "processing_time": (datetime.now() - start_time).total_seconds(),
-                "project_id": project_id
+                "project_id": project_id,
+                "llm_usage": summarize_usage(usage_records),
+                "llm_calls": usage_records,
+                "input_hash": input_hash,
+                "cache_hit": False,
+                "output_valid": not problems,
+                "output_problems": problems
             }
             
             # 保存结果
@@ -89,6 +164,13 @@ class BaseAgent(ABC):
         except Exception as e:
             print(f"Agent {self.name} execution error: {str(e)}")
             raise
+        finally:
+            _current_project.reset(project_token)
+    
+    @staticmethod
+    def current_project_id() -> Optional[str]:
+        """当前执行所属的项目ID（不经过execute直接调用process时为None）"""
+        return _current_project.get()
     
     async def save_result(self, project_id: str, result: Dict[str, Any]) -> None:
         """保存Agent处理结果"""
@@ -98,18 +180,47 @@ class BaseAgent(ABC):
         # 确定保存类型
         save_type = self.get_save_type()
         
-        # 生成文件名
+        # 生成文件名（附带输入哈希前缀，避免同一秒内不同输入的结果互相覆盖）
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        input_hash = result.get("_metadata", {}).get("input_hash")
         filename = f"{self.name}_{timestamp}"
+        if input_hash:
+            filename = f"{filename}_{input_hash[:8]}"
         
-        # 保存到项目
+        # 保存到项目（通过输出校验的结果同时登记输入哈希索引；降级结果不登记，相同输入下次会重新生成）
+        valid = result.get("_metadata", {}).get("output_valid", True)
         self.project_manager.save_prompt(
             project_id=project_id,
             prompt_type=save_type,
             filename=filename,
-            content=result
+            content=result,
+            input_hash=input_hash if valid else None
         )
     
+    def compute_input_hash(self, input_data: Dict[str, Any]) -> str:
+        """
+        计算有效输入的规范化哈希
+        
+        包括输入数据（忽略上游结果中的_metadata）、系统提示词、prompt模板、输出格式、模型
+        以及子类通过cache_key_extras声明的额外模板和参数，任一变化都会得到不同的哈希
+        """
+        llm = getattr(self.llm, "llm_instance", None) or self.llm
+        payload = {
+            "agent": self.name,
+            "agent_class": type(self).__name__,
+            "input": _strip_metadata(input_data),
+            "system_prompt": self.get_system_prompt(),
+            "prompt_template": self.format_prompt({}),
+            "model": getattr(llm, "model", None),
+            "extras": self.cache_key_extras()
+        }
+        canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+    
+    def cache_key_extras(self) -> Dict[str, Any]:
+        """参与输入哈希的额外内容（子类覆盖：分块/分段等次级prompt模板、切换处理方式的阈值）"""
+        return {}
+    
     def get_save_type(self) -> str:
         """获取保存类型（子类可覆盖）"""
         # 默认根据Agent名称推断
@@ -128,6 +239,45 @@ class BaseAgent(ABC):
         
         return "general"
     
+    async def run_concurrently(self,
+                               items: List[Any],
+                               worker: Callable[[Any], Awaitable[Any]],
+                               max_concurrency: int = 4,
+                               max_retries: int = 0,
+                               is_failed: Optional[Callable[[Any], bool]] = None) -> List[Any]:
+        """
+        并发处理多个子任务（限制最大并发数），按输入顺序返回结果
+        
+        Args:
+            items: 子任务输入列表
+            worker: 处理单个子任务的协程函数
+            max_concurrency: 最大并发数
+            max_retries: 单个子任务失败时的重试次数（只重试失败的子任务）
+            is_failed: 判断结果是否失败的函数，默认只有抛出异常视为失败
+        """
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        
+        async def run_one(item):
+            attempt = 0
+            while True:
+                error = None
+                async with semaphore:
+                    try:
+                        result = await worker(item)
+                    except Exception as e:
+                        result, error = None, e
+                
+                failed = error is not None or (is_failed is not None and is_failed(result))
+                if not failed or attempt >= max_retries:
+                    if error is not None:
+                        raise error
+                    return result
+                
+                attempt += 1
+                print(f"Agent {self.name} subtask failed, retrying ({attempt}/{max_retries})")
+        
+        return await asyncio.gather(*[run_one(item) for item in items])
+    
     def validate_input(self, input_data: Dict[str, Any], required_fields: List[str]) -> bool:
         """验证输入数据"""
         for field in required_fields:
@@ -144,27 +294,125 @@ class BaseAgent(ABC):
             output_format=self.get_output_format()
         )
     
+    def format_prompt_parts(self, input_data: Dict[str, Any],
+                            output_format: Optional[str] = None) -> Tuple[str, str]:
+        """格式化prompt，返回（可缓存的稳定前缀, 输入数据部分）"""
+        return self.llm.format_agent_prompt_parts(
+            agent_name=self.name,
+            agent_description=self.description,
+            input_data=input_data,
+            output_format=output_format or self.get_output_format()
+        )
+    
     async def generate_response(self, 
                                input_data: Dict[str, Any],
                                temperature: float = 0.7,
-                               max_tokens: int = 3000) -> Dict[str, Any]:
-        """生成LLM响应"""
-        prompt = self.format_prompt(input_data)
+                               max_tokens: int = 3000,
+                               output_format: Optional[str] = None) -> Dict[str, Any]:
+        """
+        生成LLM响应（output_format为空时使用Agent的输出格式）
+        
+        返回结果会按输出格式校验，缺失或无效的字段通过补全请求单独重新生成
+        """
+        cache_prefix, prompt = self.format_prompt_parts(input_data, output_format)
         system_prompt = self.get_system_prompt()
         
-        return await self.llm.generate_json(
+        result = await self.llm.generate_json(
             prompt=prompt,
             system_prompt=system_prompt,
             temperature=temperature,
+            max_tokens=max_tokens,
+            cache_prefix=cache_prefix
+        )
+        
+        return await self.enforce_output(
+            result, prompt, system_prompt, cache_prefix,
+            output_format=output_format,
             max_tokens=max_tokens
         )
     
+    async def enforce_output(self,
+                             result: Dict[str, Any],
+                             prompt: str,
+                             system_prompt: str,
+                             cache_prefix: Optional[str],
+                             output_format: Optional[str] = None,
+                             max_tokens: int = 3000) -> Dict[str, Any]:
+        """
+        按输出格式校验结果并定向补全
+        
+        非JSON回答先请求模型转换为JSON；缺失或无效的字段只针对这些字段追问一次，
+        补全请求沿用原prompt前缀（可命中prompt缓存）。补全失败时返回原结果，交给post_process兜底，
+        并记录到当前的输出问题收集范围（见collect_output_problems）
+        
+        Args:
+            result: generate_json的返回结果
+            prompt: 原请求的输入数据部分
+            system_prompt: 原请求的系统提示词
+            cache_prefix: 原请求的可缓存前缀
+            output_format: 输出格式（为空时使用Agent的输出格式）
+            max_tokens: 原请求的最大token数（用于格式转换）
+        """
+        schema = schema_from_format(output_format or self.get_output_format())
+        if schema is None or self.MAX_REPAIR_ROUNDS <= 0:
+            if is_raw_response(result):
+                report_output_problem("raw_response")
+            elif schema is not None:
+                self._report_problems(validate_output(result, schema, self.OPTIONAL_OUTPUT_FIELDS))
+            return result
+        
+        try:
+            if is_raw_response(result):
+                reformatted = await self.llm.generate_json(
+                    prompt=f"{prompt}\n\n{build_reformat_prompt(result['raw_response'])}",
+                    system_prompt=system_prompt,
+                    temperature=0.2,
+                    max_tokens=max_tokens,
+                    cache_prefix=cache_prefix
+                )
+                success = not is_raw_response(reformatted)
+                mark_repair("reformat", ["*"], ["*"] if success else [])
+                if not success:
+                    report_output_problem("raw_response")
+                    return result
+                result = reformatted
+            
+            for _ in range(self.MAX_REPAIR_ROUNDS):
+                problems = validate_output(result, schema, self.OPTIONAL_OUTPUT_FIELDS)
+                if not problems:
+                    break
+                
+                paths = problems[:self.MAX_REPAIR_FIELDS]
+                patch = await self.llm.generate_json(
+                    prompt=f"{prompt}\n\n{build_repair_prompt(result, schema, paths)}",
+                    system_prompt=system_prompt,
+                    temperature=0.3,
+                    max_tokens=min(max_tokens, 1500),
+                    cache_prefix=cache_prefix
+                )
+                repaired = apply_patch(result, patch, paths) if isinstance(patch, dict) else []
+                mark_repair("fields", paths, repaired)
+                if not repaired:
+                    break
+        except Exception as e:
+            print(f"Agent {self.name} output repair error: {str(e)}")
+        
+        if is_raw_response(result):
+            report_output_problem("raw_response")
+        else:
+            self._report_problems(validate_output(result, schema, self.OPTIONAL_OUTPUT_FIELDS))
+        return result
+    
+    def _report_problems(self, paths: List[str]) -> None:
+        if paths:
+            report_output_problem(f"invalid fields: {', '.join(paths[:self.MAX_REPAIR_FIELDS])}")
+    
     def sync_generate_response(self, 
                               input_data: Dict[str, Any],
                               temperature: float = 0.7,
                               max_tokens: int = 3000) -> Dict[str, Any]:
         """同步生成LLM响应"""
-        prompt = self.format_prompt(input_data)
+        cache_prefix, prompt = self.format_prompt_parts(input_data)
         system_prompt = self.get_system_prompt()
         
         if hasattr(self.llm, 'generate_json_sync'):
@@ -172,7 +420,8 @@ class BaseAgent(ABC):
                 prompt=prompt,
                 system_prompt=system_prompt,
                 temperature=temperature,
-                max_tokens=max_tokens
+                max_tokens=max_tokens,
+                cache_prefix=cache_prefix
             )
         else:
             # 如果没有同步方法，运行异步方法
@@ -183,8 +432,18 @@ class BaseAgent(ABC):
                     prompt=prompt,
                     system_prompt=system_prompt,
                     temperature=temperature,
-                    max_tokens=max_tokens
+                    max_tokens=max_tokens,
+                    cache_prefix=cache_prefix
                 )
             )
             loop.close()
-            return result
\ No newline at end of file
+            return result
+
+
+def _strip_metadata(value: Any) -> Any:
+    """递归去掉结果中的_metadata（时间戳等不影响内容的字段）"""
+    if isinstance(value, dict):
+        return {k: _strip_metadata(v) for k, v in value.items() if k != "_metadata"}
+    if isinstance(value, list):
+        return [_strip_metadata(v) for v in value]
+    return value
\ No newline at end of file
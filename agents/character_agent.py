@@ -4,13 +4,27 @@
 负责为故事中的角色创建详细的视觉设计方案
 """
 
-from typing import Dict, Any, List
-from .base_agent import BaseAgent
+import hashlib
+from typing import Dict, Any, List, Set
+from .base_agent import BaseAgent, collect_output_problems, report_output_problem
 
 
 class CharacterDesignAgent(BaseAgent):
     """角色设计Agent"""
     
+    # 角色数达到该值时自动启用逐角色并行设计
+    PARALLEL_THRESHOLD = 2
+    # 逐角色设计的最大并发数
+    MAX_CONCURRENCY = 4
+    # 单个角色失败时的重试次数
+    MAX_RETRIES = 2
+    
+    # 逐角色设计时附加的说明
+    DESIGN_INSTRUCTIONS = "只为target_character设计一个角色，characters数组中只包含这一个角色，注意与full_cast中其他角色在外观上保持区分度"
+    
+    # 由post_process计算的输出字段
+    OPTIONAL_OUTPUT_FIELDS = ("total_characters",)
+    
     def __init__(self, llm_provider: Any, project_manager: Any = None):
         super().__init__(
             name="角色设计Agent",
@@ -92,18 +106,127 @@ class CharacterDesignAgent(BaseAgent):
             "narrative_context": story_analysis.get("narrative_structure", {})
         }
         
-        # 生成响应
-        result = await self.generate_response(
-            input_data=process_input,
-            temperature=0.8,  # 角色设计需要更多创造性
-            max_tokens=4000
-        )
+        # mode: single（一次设计全部角色）/ parallel（逐角色并行）/ auto（默认，按角色数决定）
+        mode = input_data.get("mode", "auto")
+        if mode == "parallel" or (mode == "auto" and len(characters) >= self.PARALLEL_THRESHOLD):
+            result = await self._process_parallel(process_input)
+        else:
+            # 生成响应
+            result = await self.generate_response(
+                input_data=process_input,
+                temperature=0.8,  # 角色设计需要更多创造性
+                max_tokens=4000
+            )
+            # 模型按列表位置编号的ID在调整角色顺序后会变化，统一由post_process按角色名生成
+            designed = result.get("characters")
+            for character in designed if isinstance(designed, list) else [designed]:
+                if isinstance(character, dict):
+                    character.pop("character_id", None)
         
         # 后处理
         result = self.post_process(result)
         
         return result
     
+    async def _process_parallel(self, process_input: Dict[str, Any]) -> Dict[str, Any]:
+        """每个角色单独调用LLM并行设计，失败的角色单独重试，最后合并"""
+        characters = process_input["characters_list"]
+        cast = [self._character_name(c) for c in characters]
+        taken: Set[str] = set()
+        character_ids = [self._character_id(name, taken) for name in cast]
+        # 每个角色最后一次尝试的输出问题（重试成功的角色不计入之前失败的回答）
+        attempt_problems: Dict[int, List[str]] = {}
+        
+        async def design_character(index):
+            character_input = {
+                **process_input,
+                "characters_list": [characters[index]],
+                "target_character": characters[index],
+                "character_id": character_ids[index],
+                "full_cast": cast,
+                "design_instructions": self.DESIGN_INSTRUCTIONS
+            }
+            with collect_output_problems() as problems:
+                attempt_problems[index] = problems
+                try:
+                    return await self.generate_response(
+                        input_data=character_input,
+                        temperature=0.8,
+                        max_tokens=1500
+                    )
+                except Exception as e:
+                    return {"error": str(e)}
+        
+        def is_failed(result):
+            return "error" in result or not self._extract_character(result)
+        
+        results = await self.run_concurrently(
+            list(range(len(characters))),
+            design_character,
+            max_concurrency=self.MAX_CONCURRENCY,
+            max_retries=self.MAX_RETRIES,
+            is_failed=is_failed
+        )
+        
+        merged = []
+        failed = []
+        for index, result in enumerate(results):
+            for problem in attempt_problems.get(index, []):
+                report_output_problem(f"{cast[index]}: {problem}")
+            character = self._extract_character(result) or {}
+            if not character:
+                failed.append(cast[index])
+                report_output_problem(f"{cast[index]}: {result.get('error') or 'no character design'}")
+            # 以角色名生成稳定的ID
+            character["character_id"] = character_ids[index]
+            character.setdefault("character_name", cast[index])
+            merged.append(character)
+        
+        return {"characters": merged, "failed_characters": failed}
+    
+    def cache_key_extras(self) -> Dict[str, Any]:
+        """逐角色设计的阈值和prompt也影响结果"""
+        return {
+            "parallel_threshold": self.PARALLEL_THRESHOLD,
+            "design_instructions": self.DESIGN_INSTRUCTIONS
+        }
+    
+    @staticmethod
+    def _character_id(name: str, taken: Set[str]) -> str:
+        """
+        由角色名生成稳定的ID（名字的短哈希），调整角色顺序或插入角色不影响其他角色的ID
+
+        Args:
+            name: 角色名
+            taken: 已使用的ID，重名时追加序号；生成的ID会加入其中
+        """
+        base = f"CHAR_{hashlib.sha256(name.strip().lower().encode('utf-8')).hexdigest()[:6].upper()}"
+        character_id = base
+        suffix = 2
+        while character_id in taken:
+            character_id = f"{base}_{suffix}"
+            suffix += 1
+        taken.add(character_id)
+        return character_id
+    
+    @staticmethod
+    def _character_name(character: Any) -> str:
+        if isinstance(character, dict):
+            return str(character.get("name") or character.get("character_name") or character)
+        return str(character)
+    
+    @staticmethod
+    def _extract_character(result: Dict[str, Any]) -> Dict[str, Any]:
+        """从单角色结果中取出角色设计"""
+        characters = result.get("characters")
+        if isinstance(characters, list) and characters and isinstance(characters[0], dict):
+            return characters[0]
+        if isinstance(characters, dict):
+            return characters
+        if "character_design" in result:
+            return {k: v for k, v in result.items() if k != "total_characters"}
+        return {}
+    
     def post_process(self, result: Dict[str, Any]) -> Dict[str, Any]:
         """后处理结果"""
         # 确保characters是数组
@@ -113,10 +236,12 @@ class CharacterDesignAgent(BaseAgent):
             result["characters"] = [result["characters"]]
         
         # 为每个角色生成默认值和ID
+        taken = {c["character_id"] for c in result["characters"] if isinstance(c, dict) and c.get("character_id")}
         for i, character in enumerate(result["characters"]):
-            # 确保character_id
-            if "character_id" not in character:
-                character["character_id"] = f"CHAR_{str(i+1).zfill(3)}"
+            # 确保character_id（由角色名生成）
+            if not character.get("character_id"):
+                name = str(character.get("character_name") or f"Character {i+1}")
+                character["character_id"] = self._character_id(name, taken)
             
             # 确保character_design存在
             if "character_design" not in character:
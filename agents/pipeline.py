@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Agent流水线
+按声明的依赖关系（DAG）编排多个Agent，无依赖关系的Agent并发执行
+"""
+
+import asyncio
+import time
+from typing import Dict, List, Optional, Any, Callable
+
+from .base_agent import BaseAgent
+
+
+class PipelineStage:
+    """流水线中的一个Agent阶段"""
+
+    def __init__(self,
+                 name: str,
+                 agent: BaseAgent,
+                 depends_on: Optional[List[str]] = None,
+                 build_input: Optional[Callable[[Dict[str, Any], Dict[str, Any]], Dict[str, Any]]] = None):
+        """
+        初始化阶段
+
+        Args:
+            name: 阶段名称
+            agent: 执行该阶段的Agent
+            depends_on: 依赖的上游阶段名称
+            build_input: 根据（流水线输入, 上游结果）构建Agent输入的函数，默认直接使用流水线输入
+        """
+        self.name = name
+        self.agent = agent
+        self.depends_on = depends_on or []
+        self.build_input = build_input or (lambda pipeline_input, upstream: pipeline_input)
+
+
+class AgentPipeline:
+    """基于DAG的Agent流水线"""
+
+    def __init__(self, stages: List[PipelineStage]):
+        self.stages = {stage.name: stage for stage in stages}
+        self.order = self._topological_order()
+
+    def _topological_order(self) -> List[str]:
+        """校验依赖并返回拓扑序"""
+        for stage in self.stages.values():
+            for dep in stage.depends_on:
+                if dep not in self.stages:
+                    raise ValueError(f"Stage '{stage.name}' depends on unknown stage '{dep}'")
+
+        order = []
+        visiting = set()
+        visited = set()
+
+        def visit(name: str):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"Pipeline has a dependency cycle at stage '{name}'")
+            visiting.add(name)
+            for dep in self.stages[name].depends_on:
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+
+        return order
+
+    async def run(self,
+                  project_id: str,
+                  pipeline_input: Dict[str, Any],
+                  save_result: bool = True,
+                  use_cache: bool = True) -> Dict[str, Any]:
+        """
+        执行流水线
+
+        每个阶段在其所有上游完成后立即启动，结果通过Agent.execute保存到项目。
+        启用use_cache时，输入哈希未变化的阶段直接复用已有结果，
+        因此只有上游结果实际变化的下游阶段会重新执行
+
+        Returns:
+            各阶段结果、耗时、错误以及关键路径
+        """
+        pipeline_start = time.perf_counter()
+        tasks: Dict[str, asyncio.Task] = {}
+        timings: Dict[str, Dict[str, float]] = {}
+
+        async def run_stage(stage: PipelineStage) -> Dict[str, Any]:
+            upstream_results = await asyncio.gather(*[tasks[dep] for dep in stage.depends_on])
+            upstream = dict(zip(stage.depends_on, upstream_results))
+
+            started = time.perf_counter()
+            input_data = stage.build_input(pipeline_input, upstream)
+            result = await stage.agent.execute(project_id, input_data, save_result, use_cache)
+            finished = time.perf_counter()
+
+            timings[stage.name] = {
+                "start": round(started - pipeline_start, 3),
+                "end": round(finished - pipeline_start, 3),
+                "duration": round(finished - started, 3)
+            }
+            return result
+
+        # 按拓扑序创建任务，保证依赖的任务已存在
+        for name in self.order:
+            tasks[name] = asyncio.ensure_future(run_stage(self.stages[name]))
+
+        outcomes = await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        results = {}
+        errors = {}
+        reused = []
+        for name, outcome in zip(tasks.keys(), outcomes):
+            if isinstance(outcome, BaseException):
+                errors[name] = str(outcome)
+            else:
+                results[name] = outcome
+                if outcome.get("_metadata", {}).get("cache_hit"):
+                    reused.append(name)
+
+        critical_path, critical_time = self._critical_path(timings)
+
+        return {
+            "results": results,
+            "errors": errors,
+            "reused": reused,
+            "timings": timings,
+            "wall_time": round(time.perf_counter() - pipeline_start, 3),
+            "critical_path": critical_path,
+            "critical_path_time": critical_time
+        }
+
+    def _critical_path(self, timings: Dict[str, Dict[str, float]]):
+        """根据各阶段实际耗时计算最长依赖链"""
+        longest: Dict[str, float] = {}
+        previous: Dict[str, Optional[str]] = {}
+
+        for name in self.order:
+            if name not in timings:
+                continue
+            best_dep, best_time = None, 0.0
+            for dep in self.stages[name].depends_on:
+                if longest.get(dep, 0.0) > best_time:
+                    best_dep, best_time = dep, longest[dep]
+            longest[name] = best_time + timings[name]["duration"]
+            previous[name] = best_dep
+
+        if not longest:
+            return [], 0.0
+
+        tail = max(longest, key=longest.get)
+        path = []
+        while tail:
+            path.append(tail)
+            tail = previous[tail]
+
+        return list(reversed(path)), round(max(longest.values()), 3)
+
+
+def build_preproduction_pipeline(agents: Dict[str, BaseAgent]) -> AgentPipeline:
+    """
+    构建前期制作流水线：故事分析 → (分镜脚本 ∥ 角色设计)
+
+    流水线输入字段: story, requirements, target_audience, duration
+    """
+    def story_input(pipeline_input, upstream):
+        return {
+            "story": pipeline_input["story"],
+            "requirements": pipeline_input.get("requirements", ""),
+            "target_audience": pipeline_input.get("target_audience", "general"),
+            "duration": pipeline_input.get("duration", 60)
+        }
+
+    def analysis_input(pipeline_input, upstream):
+        return {"story_analysis": upstream["story"]}
+
+    return AgentPipeline([
+        PipelineStage("story", agents["story"], build_input=story_input),
+        PipelineStage("storyboard", agents["storyboard"], depends_on=["story"], build_input=analysis_input),
+        PipelineStage("character", agents["character"], depends_on=["story"], build_input=analysis_input)
+    ])
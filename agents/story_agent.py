@@ -4,13 +4,55 @@
 负责分析用户的故事创意，提炼可视化的核心要素
 """
 
-from typing import Dict, Any
+import re
+import json
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Any, List
 from .base_agent import BaseAgent
 
 
+# 章节标题行（第X章/节/回/幕/集、Chapter N、Markdown标题）
+CHAPTER_HEADING = re.compile(
+    r"^\s*(第[0-9一二三四五六七八九十百千零〇两]+[章节回幕集]|chapter\s+\w+|#{1,3}\s)",
+    re.IGNORECASE
+)
+# 句末标点，用于拆分过长的段落
+SENTENCE_END = re.compile(r"(?<=[。！？!?…；;])|(?<=\.\s)")
+
+
 class StoryAnalysisAgent(BaseAgent):
     """故事分析Agent"""
     
+    # 故事文本超过该字符数时自动启用分块分析（map-reduce）
+    CHUNK_CHAR_THRESHOLD = 6000
+    # 单个分块的最大字符数
+    MAX_CHUNK_CHARS = 4000
+    # 分块的最小字符数与平均目标字符数（边界由段落内容决定，见split_chunks）
+    MIN_CHUNK_CHARS = 1000
+    TARGET_CHUNK_CHARS = 2500
+    # 分块分析的最大并发数
+    MAX_CONCURRENCY = 6
+    # 分块分析结果的内存缓存条数
+    CHUNK_CACHE_SIZE = 512
+    
+    # 分块分析（map阶段）的输出格式
+    CHUNK_OUTPUT_FORMAT = """```json
+{
+  "summary": "本段情节概要（100字以内）",
+  "characters": ["出场角色"],
+  "locations": ["出现的场景地点"],
+  "props": ["重要道具"],
+  "beats": ["关键情节节拍，按发生顺序"],
+  "visual_effects": ["需要的视觉效果"],
+  "mood": "本段情感基调"
+}
+```"""
+    
+    # 分块分析和汇总阶段附加的说明
+    CHUNK_INSTRUCTIONS = "这是全文{total}个片段中的第{index}段，只分析本片段出现的内容，不要推测其他片段"
+    REDUCE_INSTRUCTIONS = "原文过长，已拆分为{total}个片段分别分析。请综合所有片段的概要和情节节拍，按输出格式给出整个故事的分析"
+    
     def __init__(self, llm_provider: Any, project_manager: Any = None):
         super().__init__(
             name="故事分析Agent",
@@ -18,6 +60,9 @@ class StoryAnalysisAgent(BaseAgent):
             llm_provider=llm_provider,
             project_manager=project_manager
         )
+        # 分块哈希 -> 分块分析结果，修改故事后只重新分析变化的分块
+        # （内存中的最近结果；通过execute执行时同时保存到项目的prompts/_chunk_cache.json，重启后仍可复用）
+        self._chunk_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
     
     def get_system_prompt(self) -> str:
         """获取系统提示词"""
@@ -59,7 +104,12 @@ class StoryAnalysisAgent(BaseAgent):
 ```"""
     
     async def process(self, input_data: Dict[str, Any]) -> Dict[str, Any]:
-        """处理输入数据并返回结果"""
+        """
+        处理输入数据并返回结果
+        
+        input_data.mode: single（整篇一次分析）/ chunked（分块并行分析后合并）/
+        auto（默认，故事超过CHUNK_CHAR_THRESHOLD字符时分块）
+        """
         # 验证输入
         self.validate_input(input_data, ["story"])
         
@@ -71,18 +121,211 @@ class StoryAnalysisAgent(BaseAgent):
             "duration_preference": input_data.get("duration", 60)
         }
         
-        # 生成响应
+        mode = input_data.get("mode", "auto")
+        story = str(process_input["story"])
+        
+        if mode == "chunked" or (mode == "auto" and len(story) > self.CHUNK_CHAR_THRESHOLD):
+            result = await self._process_chunked(process_input)
+        else:
+            # 生成响应
+            result = await self.generate_response(
+                input_data=process_input,
+                temperature=0.7,
+                max_tokens=3000
+            )
+        
+        # 后处理
+        result = self.post_process(result)
+        
+        return result
+    
+    def split_chunks(self, story: str) -> List[str]:
+        """
+        按章节和段落边界拆分故事
+        
+        分块边界由内容决定：分块达到MIN_CHUNK_CHARS后，在哈希满足条件的段落之后断开
+        （段落越长越容易成为边界，平均分块约TARGET_CHUNK_CHARS）。边界只取决于段落本身，
+        前文插入或删除段落后，后续分块会在下一个边界处重新对齐，只有附近的分块需要重新分析。
+        章节标题处优先断开（当前分块已达到MIN_CHUNK_CHARS时），超过MAX_CHUNK_CHARS时强制断开；
+        段落不会被拆开，只有单个段落超过MAX_CHUNK_CHARS时才按句子拆分；
+        当前分块只有标题行时不断开，标题随下一段进入同一分块
+        """
+        paragraphs = []
+        for line in story.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if len(line) <= self.MAX_CHUNK_CHARS:
+                paragraphs.append(line)
+                continue
+            # 过长段落按句子拆分，单句仍过长则硬切
+            piece = ""
+            for sentence in SENTENCE_END.split(line):
+                if len(piece) + len(sentence) > self.MAX_CHUNK_CHARS and piece:
+                    paragraphs.append(piece)
+                    piece = ""
+                while len(sentence) > self.MAX_CHUNK_CHARS:
+                    paragraphs.append(sentence[:self.MAX_CHUNK_CHARS])
+                    sentence = sentence[self.MAX_CHUNK_CHARS:]
+                piece += sentence
+            if piece:
+                paragraphs.append(piece)
+        
+        chunks = []
+        current: List[str] = []
+        current_len = 0
+        for paragraph in paragraphs:
+            is_heading = bool(CHAPTER_HEADING.match(paragraph))
+            at_chapter = is_heading and current_len >= self.MIN_CHUNK_CHARS
+            heading_only = all(CHAPTER_HEADING.match(line) for line in current)
+            if current and not heading_only and (at_chapter or current_len + len(paragraph) + 1 > self.MAX_CHUNK_CHARS):
+                chunks.append("\n".join(current))
+                current, current_len = [], 0
+            current.append(paragraph)
+            current_len += len(paragraph) + 1
+            if not is_heading and current_len >= self.MIN_CHUNK_CHARS and self._is_boundary(paragraph):
+                chunks.append("\n".join(current))
+                current, current_len = [], 0
+        if current:
+            chunks.append("\n".join(current))
+        
+        return chunks
+    
+    def _is_boundary(self, paragraph: str) -> bool:
+        """段落之后是否为内容定义的分块边界（概率与段落长度成正比）"""
+        digest = int(hashlib.sha256(paragraph.encode("utf-8")).hexdigest()[:8], 16) / 0x100000000
+        return digest < len(paragraph) / max(1, self.TARGET_CHUNK_CHARS - self.MIN_CHUNK_CHARS)
+    
+    async def _process_chunked(self, process_input: Dict[str, Any]) -> Dict[str, Any]:
+        """分块并行分析（map），再合并为完整的故事分析（reduce）"""
+        chunks = self.split_chunks(str(process_input["story"]))
+        keys = [self._chunk_key(text) for text in chunks]
+        
+        # 内存中没有的分块从项目中已保存的分析结果读取
+        project_id = self.current_project_id()
+        stored = {}
+        if self.project_manager and project_id:
+            stored = self.project_manager.load_chunk_analyses(
+                project_id, [key for key in keys if key not in self._chunk_cache]
+            )
+        new_analyses: Dict[str, Dict[str, Any]] = {}
+        
+        async def analyze_chunk(item):
+            index, text = item
+            key = keys[index]
+            if key in self._chunk_cache:
+                self._chunk_cache.move_to_end(key)
+                return self._chunk_cache[key], True
+            if key in stored:
+                self._remember_chunk(key, stored[key])
+                return stored[key], True
+            
+            analysis = await self.generate_response(
+                input_data={
+                    "story_excerpt": text,
+                    "chunk_instructions": self.CHUNK_INSTRUCTIONS.format(total=len(chunks), index=index + 1)
+                },
+                temperature=0.3,
+                max_tokens=1500,
+                output_format=self.CHUNK_OUTPUT_FORMAT
+            )
+            if "raw_response" not in analysis:
+                self._remember_chunk(key, analysis)
+                new_analyses[key] = analysis
+            return analysis, False
+        
+        outcomes = await self.run_concurrently(list(enumerate(chunks)), analyze_chunk, self.MAX_CONCURRENCY)
+        if new_analyses and self.project_manager and project_id:
+            self.project_manager.save_chunk_analyses(project_id, new_analyses)
+        analyses = [analysis for analysis, _ in outcomes]
+        
+        # reduce：基于各片段分析生成完整的故事分析
+        reduce_input = {
+            "chunk_analyses": [
+                {
+                    "index": i + 1,
+                    "summary": analysis.get("summary", ""),
+                    "beats": analysis.get("beats", []),
+                    "mood": analysis.get("mood", "")
+                }
+                for i, analysis in enumerate(analyses)
+            ],
+            "visual_elements": self.merge_visual_elements(analyses),
+            "additional_requirements": process_input["additional_requirements"],
+            "target_audience": process_input["target_audience"],
+            "duration_preference": process_input["duration_preference"],
+            "reduce_instructions": self.REDUCE_INSTRUCTIONS.format(total=len(chunks))
+        }
         result = await self.generate_response(
-            input_data=process_input,
+            input_data=reduce_input,
             temperature=0.7,
             max_tokens=3000
         )
         
-        # 后处理
-        result = self.post_process(result)
+        # reduce结果缺少的视觉元素用片段汇总补齐
+        visual = result.setdefault("visual_requirements", {})
+        if isinstance(visual, dict):
+            for field, values in reduce_input["visual_elements"].items():
+                if not visual.get(field):
+                    visual[field] = values
         
+        result["chunks"] = [
+            {
+                "index": i + 1,
+                "chars": len(text),
+                "cached": cached,
+                "parse_failed": "raw_response" in analysis
+            }
+            for i, (text, (analysis, cached)) in enumerate(zip(chunks, outcomes))
+        ]
         return result
     
+    def merge_visual_elements(self, analyses: List[Dict[str, Any]]) -> Dict[str, List[str]]:
+        """按出现顺序去重合并各片段的角色、场景、道具和视觉效果"""
+        fields = {
+            "main_characters": "characters",
+            "key_locations": "locations",
+            "required_props": "props",
+            "visual_effects_needed": "visual_effects"
+        }
+        merged: Dict[str, List[str]] = {}
+        for target, source in fields.items():
+            seen = set()
+            values = []
+            for analysis in analyses:
+                items = analysis.get(source, [])
+                for item in items if isinstance(items, list) else [items]:
+                    name = str(item).strip()
+                    if name and name.lower() not in seen:
+                        seen.add(name.lower())
+                        values.append(name)
+            merged[target] = values
+        return merged
+    
+    def cache_key_extras(self) -> Dict[str, Any]:
+        """分块模式的阈值、分块大小和分块/汇总prompt也影响结果"""
+        return {
+            "chunk_char_threshold": self.CHUNK_CHAR_THRESHOLD,
+            "max_chunk_chars": self.MAX_CHUNK_CHARS,
+            "min_chunk_chars": self.MIN_CHUNK_CHARS,
+            "target_chunk_chars": self.TARGET_CHUNK_CHARS,
+            "chunk_output_format": self.CHUNK_OUTPUT_FORMAT,
+            "chunk_instructions": self.CHUNK_INSTRUCTIONS,
+            "reduce_instructions": self.REDUCE_INSTRUCTIONS
+        }
+    
+    def _remember_chunk(self, key: str, analysis: Dict[str, Any]) -> None:
+        self._chunk_cache[key] = analysis
+        while len(self._chunk_cache) > self.CHUNK_CACHE_SIZE:
+            self._chunk_cache.popitem(last=False)
+    
+    def _chunk_key(self, text: str) -> str:
+        """分块缓存键：分块文本 + 分块prompt + 模型"""
+        llm = getattr(self.llm, "llm_instance", None) or self.llm
+        payload = [text, self.CHUNK_OUTPUT_FORMAT, self.CHUNK_INSTRUCTIONS, self.get_system_prompt(),
+                   getattr(llm, "model", None)]
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+    
     def post_process(self, result: Dict[str, Any]) -> Dict[str, Any]:
         """后处理结果"""
         # 确保必要字段存在
@@ -4,6 +4,7 @@
 负责将故事转化为具体的镜头序列
 """
 
+import re
 from typing import Dict, Any, List
 from .base_agent import BaseAgent
 
@@ -11,6 +12,29 @@ from .base_agent import BaseAgent
 class StoryboardAgent(BaseAgent):
     """分镜脚本Agent"""
     
+    # 目标时长超过该值（秒）时自动启用分段并行生成
+    CHUNK_DURATION_THRESHOLD = 90
+    # 单个分段的最大时长（秒），超过则继续拆分
+    MAX_SEGMENT_DURATION = 60
+    # 分段生成的最大并发数（5分钟成片约6段，可一轮全部并发）
+    MAX_CONCURRENCY = 8
+    # 叙事结构各部分的时长占比
+    ACT_WEIGHTS = {
+        "opening": 0.15,
+        "development": 0.35,
+        "climax": 0.35,
+        "resolution": 0.15
+    }
+    
+    # 分段生成时附加的说明
+    SEGMENT_INSTRUCTIONS = (
+        "这是全片{total}个段落中的第{index}段，只为当前段落生成分镜，"
+        "镜头时长合计约{duration}秒，开头和结尾要与前后段落自然衔接"
+    )
+    
+    # 由post_process计算的输出字段
+    OPTIONAL_OUTPUT_FIELDS = ("total_shots", "estimated_duration")
+    
     def __init__(self, llm_provider: Any, project_manager: Any = None):
         super().__init__(
             name="分镜脚本Agent",
@@ -61,7 +85,12 @@ class StoryboardAgent(BaseAgent):
 ```"""
     
     async def process(self, input_data: Dict[str, Any]) -> Dict[str, Any]:
-        """处理输入数据并返回结果"""
+        """
+        处理输入数据并返回结果
+        
+        input_data.mode: single（一次生成全部镜头）/ chunked（按叙事段落并行生成）/
+        auto（默认，目标时长超过CHUNK_DURATION_THRESHOLD时分段）
+        """
         # 验证输入
         self.validate_input(input_data, ["story_analysis"])
         
@@ -76,18 +105,145 @@ class StoryboardAgent(BaseAgent):
             "style_direction": story_analysis.get("style_direction", {})
         }
         
-        # 生成响应
-        result = await self.generate_response(
-            input_data=process_input,
-            temperature=0.7,
-            max_tokens=4000  # 分镜脚本可能需要更多tokens
-        )
+        mode = input_data.get("mode", "auto")
+        target_duration = self._parse_seconds(process_input["target_duration"], 60)
+        
+        if mode == "chunked" or (mode == "auto" and target_duration > self.CHUNK_DURATION_THRESHOLD):
+            result = await self._process_chunked(process_input, target_duration)
+        else:
+            # 生成响应
+            result = await self.generate_response(
+                input_data=process_input,
+                temperature=0.7,
+                max_tokens=4000  # 分镜脚本可能需要更多tokens
+            )
         
         # 后处理
         result = self.post_process(result)
         
         return result
     
+    def split_segments(self, narrative_structure: Dict[str, Any], target_duration: int) -> List[Dict[str, Any]]:
+        """
+        将叙事结构拆分为分段，按占比分配时长
+        
+        时长超过MAX_SEGMENT_DURATION的段落继续均分；没有叙事结构时按时长均分
+        """
+        acts = [(key, value) for key, value in (narrative_structure or {}).items() if value]
+        if not acts:
+            acts = [("sequence", "按故事顺序推进")]
+        
+        weights = [self.ACT_WEIGHTS.get(key, 1.0 / len(acts)) for key, _ in acts]
+        total_weight = sum(weights)
+        
+        segments = []
+        for (act, description), weight in zip(acts, weights):
+            act_duration = max(1, round(target_duration * weight / total_weight))
+            parts = max(1, -(-act_duration // self.MAX_SEGMENT_DURATION))  # 向上取整
+            for part in range(parts):
+                segments.append({
+                    "act": act,
+                    "description": description,
+                    "part": f"{part + 1}/{parts}",
+                    "target_duration": max(1, round(act_duration / parts))
+                })
+        
+        for i, segment in enumerate(segments):
+            segment["index"] = i + 1
+            segment["total"] = len(segments)
+        
+        return segments
+    
+    async def _process_chunked(self, process_input: Dict[str, Any], target_duration: int) -> Dict[str, Any]:
+        """按叙事段落并行生成分镜，再合并为完整的分镜脚本"""
+        segments = self.split_segments(process_input["narrative_structure"], target_duration)
+        
+        # 各分段共享的风格上下文
+        shared_context = {
+            "story_analysis": process_input["story_analysis"].get("story_analysis", {}),
+            "visual_requirements": process_input["visual_requirements"],
+            "style_direction": process_input["style_direction"]
+        }
+        
+        async def generate_segment(segment):
+            index = segment["index"] - 1
+            segment_input = {
+                **shared_context,
+                "target_duration": segment["target_duration"],
+                "current_segment": segment,
+                "previous_segment": segments[index - 1]["description"] if index > 0 else None,
+                "next_segment": segments[index + 1]["description"] if index + 1 < len(segments) else None,
+                "segment_instructions": self.SEGMENT_INSTRUCTIONS.format(
+                    total=segment["total"], index=segment["index"], duration=segment["target_duration"]
+                )
+            }
+            return await self.generate_response(
+                input_data=segment_input,
+                temperature=0.7,
+                max_tokens=4000
+            )
+        
+        segment_results = await self.run_concurrently(segments, generate_segment, self.MAX_CONCURRENCY)
+        
+        return self.merge_segments(segments, segment_results)
+    
+    def merge_segments(self, segments: List[Dict[str, Any]], segment_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """合并各分段结果，重新编号shot_id"""
+        storyboard = []
+        key_moments = []
+        pacing = []
+        segment_summary = []
+        
+        for segment, result in zip(segments, segment_results):
+            shots = result.get("storyboard", [])
+            if not isinstance(shots, list):
+                shots = [shots]
+            
+            for shot in shots:
+                if isinstance(shot, dict):
+                    shot.setdefault("sequence_name", segment["act"])
+                    storyboard.append(shot)
+            
+            moments = result.get("key_moments", [])
+            key_moments.extend(moments if isinstance(moments, list) else [moments])
+            if result.get("overall_pacing"):
+                pacing.append(str(result["overall_pacing"]))
+            
+            segment_summary.append({
+                "act": segment["act"],
+                "part": segment["part"],
+                "target_duration": segment["target_duration"],
+                "shots": len(shots),
+                "parse_failed": "raw_response" in result
+            })
+        
+        for i, shot in enumerate(storyboard):
+            shot["shot_id"] = f"SHOT_{str(i+1).zfill(3)}"
+        
+        return {
+            "storyboard": storyboard,
+            "overall_pacing": "；".join(pacing),
+            "key_moments": key_moments,
+            "segments": segment_summary
+        }
+    
+    def cache_key_extras(self) -> Dict[str, Any]:
+        """分段模式的阈值、分段方式和分段prompt也影响结果"""
+        return {
+            "chunk_duration_threshold": self.CHUNK_DURATION_THRESHOLD,
+            "max_segment_duration": self.MAX_SEGMENT_DURATION,
+            "act_weights": self.ACT_WEIGHTS,
+            "segment_instructions": self.SEGMENT_INSTRUCTIONS
+        }
+    
+    @staticmethod
+    def _parse_seconds(value: Any, default: int) -> int:
+        """解析时长字段（兼容"3秒"、"3.5"等写法）"""
+        if isinstance(value, (int, float)):
+            return int(value)
+        match = re.search(r"\d+(\.\d+)?", str(value or ""))
+        return int(float(match.group())) if match else default
+    
     def post_process(self, result: Dict[str, Any]) -> Dict[str, Any]:
         """后处理结果"""
         # 确保storyboard是数组
@@ -130,7 +286,7 @@ class StoryboardAgent(BaseAgent):
         result["total_shots"] = len(result["storyboard"])
         
         total_duration = sum(
-            int(shot.get("shot_description", {}).get("duration", 3))
+            self._parse_seconds(shot.get("shot_description", {}).get("duration", 3), 3)
             for shot in result["storyboard"]
         )
         result["estimated_duration"] = total_duration
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+DashScope API Key池
+服务商按Key分配各模型的并发任务配额，配置多个Key时按剩余配额把任务分散到各Key：
+优先选择该模型进行中任务最少、最近未被限流的Key；收到429后该Key冷却一段时间（连续限流时加倍）。
+任务的状态查询和取消必须使用提交它的Key，Key与任务的对应关系保存在池中并写入任务日志
+"""
+
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Any, List, Optional
+
+from config.settings import DASHSCOPE_API_KEYS, DASHSCOPE_KEY_CONCURRENCY
+
+
+class DashScopeCredentialPool:
+    """多个API Key的选择、任务归属记录与用量统计"""
+
+    # 统计最近限流次数的时间窗口（秒）
+    THROTTLE_WINDOW = 60
+    # 429后的基础冷却时间与上限（秒）
+    COOLDOWN_BASE = 5
+    COOLDOWN_MAX = 60
+    # 保留的任务ID -> Key对应关系条数（用于取消、恢复已结束轮询的任务）
+    TASK_KEY_WINDOW = 1000
+
+    def __init__(self, keys: Optional[List[str]] = None, per_key_concurrency: Optional[int] = None):
+        """
+        Args:
+            keys: API Key列表，不传则使用配置中的DASHSCOPE_API_KEYS
+            per_key_concurrency: 单个Key下每个模型同时进行的任务数
+        """
+        self.keys = list(dict.fromkeys(key for key in (DASHSCOPE_API_KEYS if keys is None else keys) if key))
+        self.per_key_concurrency = per_key_concurrency or DASHSCOPE_KEY_CONCURRENCY
+        self._lock = threading.Lock()
+        self._ids = {self.key_id(key): key for key in self.keys}
+        self._task_keys: "OrderedDict[str, str]" = OrderedDict()
+        self._keys: Dict[str, Dict[str, Any]] = {
+            key: {
+                # 模型 -> 进行中的任务数
+                "outstanding": {},
+                "throttles": deque(),
+                "cooldown_until": 0.0,
+                "submitted": 0,
+                "completed": 0,
+                "throttled": 0,
+                "last_used": 0.0
+            }
+            for key in self.keys
+        }
+
+    @staticmethod
+    def key_id(key: str) -> str:
+        """Key的稳定标识（写入日志和统计，不暴露Key本身）"""
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+
+    @staticmethod
+    def _mask(key: str) -> str:
+        return f"{key[:3]}****{key[-4:]}" if len(key) > 8 else "****"
+
+    # ==================== 选择与释放 ====================
+
+    def _pick(self, model: str) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            candidates = []
+            for index, key in enumerate(self.keys):
+                state = self._keys[key]
+                while state["throttles"] and now - state["throttles"][0] > self.THROTTLE_WINDOW:
+                    state["throttles"].popleft()
+                if state["cooldown_until"] > now:
+                    continue
+                remaining = self.per_key_concurrency - state["outstanding"].get(model, 0)
+                candidates.append((-remaining, len(state["throttles"]),
+                                   sum(state["outstanding"].values()), state["last_used"], index, key))
+            if not candidates:
+                return None
+            key = min(candidates)[-1]
+            state = self._keys[key]
+            state["outstanding"][model] = state["outstanding"].get(model, 0) + 1
+            state["submitted"] += 1
+            state["last_used"] = now
+            return key
+
+    async def acquire(self, model: str) -> str:
+        """
+        为一次任务提交选择Key并占用该Key的一个模型配额（任务结束后调用release）
+
+        所有Key都在冷却时等待最早结束冷却的Key
+        """
+        if not self.keys:
+            raise ValueError("API key is required. Please set DASHSCOPE_API_KEY in .env file")
+        while True:
+            key = self._pick(model)
+            if key is not None:
+                return key
+            with self._lock:
+                wait = min(state["cooldown_until"] for state in self._keys.values()) - time.monotonic()
+            print(f"⏳ 所有API Key都在限流冷却中，等待 {max(wait, 0):.1f} 秒")
+            await asyncio.sleep(max(wait, 0.05))
+
+    def release(self, key: str, model: str, completed: bool = True) -> None:
+        """
+        释放Key的模型配额
+
+        Args:
+            key: acquire返回的Key
+            model: 提交任务时的模型
+            completed: 任务是否已在服务端结束（提交失败时为False）
+        """
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None:
+                return
+            remaining = state["outstanding"].get(model, 0) - 1
+            if remaining > 0:
+                state["outstanding"][model] = remaining
+            else:
+                state["outstanding"].pop(model, None)
+            if completed:
+                state["completed"] += 1
+            else:
+                state["submitted"] -= 1
+
+    def throttled(self, key: str) -> float:
+        """记录Key收到429，返回本次冷却秒数"""
+        now = time.monotonic()
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None:
+                return 0.0
+            state["throttles"].append(now)
+            state["throttled"] += 1
+            cooldown = min(self.COOLDOWN_MAX, self.COOLDOWN_BASE * 2 ** (len(state["throttles"]) - 1))
+            state["cooldown_until"] = max(state["cooldown_until"], now + cooldown)
+        print(f"🚦 API Key {self._mask(key)} 被限流，冷却 {cooldown:.0f} 秒")
+        return cooldown
+
+    # ==================== 任务归属 ====================
+
+    def assign(self, task_id: str, key: str) -> None:
+        """记录任务由哪个Key提交"""
+        with self._lock:
+            self._task_keys[task_id] = key
+            self._task_keys.move_to_end(task_id)
+            while len(self._task_keys) > self.TASK_KEY_WINDOW:
+                self._task_keys.popitem(last=False)
+
+    def key_for_task(self, task_id: str, key_id: Optional[str] = None) -> Optional[str]:
+        """
+        查找提交任务的Key
+
+        Args:
+            task_id: 任务ID
+            key_id: 任务日志中记录的Key标识（服务重启后恢复任务时使用）
+        """
+        with self._lock:
+            key = self._task_keys.get(task_id)
+        if key is None and key_id:
+            key = self._ids.get(key_id)
+        return key
+
+    # ==================== 统计 ====================
+
+    def stats(self) -> Dict[str, Any]:
+        """各Key的进行中任务数、提交/完成/限流次数和冷却状态"""
+        now = time.monotonic()
+        keys = {}
+        with self._lock:
+            for key in self.keys:
+                state = self._keys[key]
+                keys[self.key_id(key)] = {
+                    "key": self._mask(key),
+                    "outstanding": dict(state["outstanding"]),
+                    "submitted": state["submitted"],
+                    "completed": state["completed"],
+                    "throttled": state["throttled"],
+                    "recent_throttles": sum(1 for t in state["throttles"] if now - t <= self.THROTTLE_WINDOW),
+                    "cooldown": round(max(0.0, state["cooldown_until"] - now), 1)
+                }
+        return {
+            "keys": keys,
+            "per_key_concurrency": self.per_key_concurrency,
+            "outstanding": sum(sum(info["outstanding"].values()) for info in keys.values()),
+            "throttled": sum(info["throttled"] for info in keys.values())
+        }
+
+
+# 进程级Key池
+credential_pool = DashScopeCredentialPool()
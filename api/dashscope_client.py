@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+DashScope异步任务客户端
+所有DashScope模型共用一个进程级连接池，统一实现
+X-DashScope-Async提交任务、tasks/<id>轮询和结果下载；
+各模型类只需声明接口地址和请求体
+"""
+
+import asyncio
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Tuple
+import aiohttp
+
+from api.task_poller import DashScopeTaskPoller
+from api.credential_pool import DashScopeCredentialPool, credential_pool
+from api.task_journal import journal_context, task_journal
+from api.media_download import stream_download
+from api.provider_errors import DashScopeAPIError, report_provider_failure
+
+
+class DashScopeSessionPool:
+    """进程级aiohttp会话池（每个事件循环一个会话），并统计连接复用情况"""
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 20, keepalive_timeout: float = 60):
+        """
+        Args:
+            limit: 连接池总连接数上限
+            limit_per_host: 单个主机的连接数上限
+            keepalive_timeout: 空闲连接保持时间（秒）
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self._sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "connections_created": 0,
+            "connections_reused": 0
+        }
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            self._count("requests")
+
+        async def on_connection_create_end(session, context, params):
+            self._count("connections_created")
+
+        async def on_connection_reuseconn(session, context, params):
+            self._count("connections_reused")
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace
+
+    def _count(self, field: str) -> None:
+        with self._lock:
+            self._stats[field] += 1
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """获取当前事件循环的共享会话（首次调用时创建）"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            # 丢弃已关闭事件循环上的会话
+            for old_loop in [l for l in self._sessions if l.is_closed()]:
+                del self._sessions[old_loop]
+
+            session = self._sessions.get(loop)
+            if session is None or session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=300
+                )
+                session = aiohttp.ClientSession(connector=connector, trace_configs=[self._trace_config()])
+                self._sessions[loop] = session
+            return session
+
+    async def close(self) -> None:
+        """关闭当前事件循环的会话"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._sessions.pop(loop, None)
+        if session and not session.closed:
+            await session.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """连接复用统计"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["open_sessions"] = sum(1 for s in self._sessions.values() if not s.closed)
+        connections = stats["connections_created"] + stats["connections_reused"]
+        stats["reuse_ratio"] = round(stats["connections_reused"] / connections, 4) if connections else 0.0
+        return stats
+
+
+class DashScopeThrottledError(DashScopeAPIError):
+    """请求被限流（HTTP 429）"""
+    pass
+
+
+# 进程级会话池
+dashscope_pool = DashScopeSessionPool()
+
+# 进程级状态轮询器，所有任务共用连接池会话和查询速率预算
+task_poller = DashScopeTaskPoller(dashscope_pool)
+
+
+class DashScopeTaskClient:
+    """DashScope异步任务客户端基类，子类声明ENDPOINT并构建请求体"""
+
+    # 提交任务的接口路径（相对于base_url）
+    ENDPOINT = ""
+    # 默认模型
+    MODEL = ""
+    # 结果保存目录
+    OUTPUT_DIR = "./output"
+    # 尚无历史样本时的预期任务耗时（秒），之后按实际完成耗时学习
+    EXPECTED_DURATION = 60
+    # 自适应轮询的最小/最大查询间隔与最长等待时间（秒）
+    MIN_POLL_INTERVAL = 1
+    MAX_POLL_INTERVAL = 30
+    MAX_WAIT = 600
+    # 提交请求超时（秒）
+    SUBMIT_TIMEOUT = 60
+    # 所有Key都被限流后继续等待冷却并重试的次数
+    THROTTLE_RETRIES = 3
+
+    def __init__(self, api_key: str = None):
+        # 未指定Key时从进程级Key池中为每个任务选择Key
+        self.credentials = credential_pool if api_key is None else DashScopeCredentialPool([api_key])
+        if not self.credentials.keys:
+            raise ValueError("API key is required. Please set DASHSCOPE_API_KEY in .env file")
+        self.api_key = self.credentials.keys[0]
+        self.base_url = os.getenv("DASHSCOPE_BASE_URL", "https://dashscope.aliyuncs.com/api/v1")
+        self.model = self.MODEL
+        self.output_dir = Path(self.OUTPUT_DIR)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        # 任务ID -> 提交时刻（事件循环时间），用于计算轮询时的已耗时
+        self._submitted_at: Dict[str, float] = {}
+        # 任务ID -> (提交的Key, 模型)，任务结束时释放该Key的配额
+        self._task_quota: Dict[str, Tuple[str, str]] = {}
+
+    def _headers(self, async_task: bool = False, api_key: Optional[str] = None) -> Dict[str, str]:
+        headers = {
+            "Authorization": f"Bearer {api_key or self.api_key}",
+            "Content-Type": "application/json"
+        }
+        if async_task:
+            headers["X-DashScope-Async"] = "enable"
+        return headers
+
+    async def post_json(self, endpoint: str, request_body: Dict[str, Any],
+                        async_task: bool = False, timeout: Optional[float] = None,
+                        api_key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        POST请求DashScope接口并返回JSON，HTTP错误或业务错误时抛出DashScopeAPIError（限流时为DashScopeThrottledError）
+
+        服务商侧故障（限流除外，由调用方换Key重试）记录到当前生成请求的上下文
+        """
+        session = dashscope_pool.get_session()
+        url = f"{self.base_url}{endpoint}"
+        try:
+            async with session.post(
+                url,
+                headers=self._headers(async_task, api_key),
+                json=request_body,
+                timeout=aiohttp.ClientTimeout(total=timeout or self.SUBMIT_TIMEOUT)
+            ) as response:
+                response_text = await response.text()
+
+            if response.status == 429:
+                raise DashScopeThrottledError(f"API请求被限流 (429): {response_text}", status=429)
+            if response.status != 200:
+                raise DashScopeAPIError(f"API请求失败 ({response.status}): {response_text}",
+                                        status=response.status, code=self._error_code(response_text))
+
+            try:
+                data = json.loads(response_text)
+            except json.JSONDecodeError:
+                raise DashScopeAPIError(f"响应JSON解析失败: {response_text}", status=response.status)
+
+            if data.get("code") and data["code"] != "200":
+                raise DashScopeAPIError(f"API错误: {data.get('message', 'Unknown error')}", code=data["code"])
+            return data
+        except DashScopeThrottledError:
+            raise
+        except Exception as e:
+            report_provider_failure(e)
+            raise
+
+    @staticmethod
+    def _error_code(response_text: str) -> Optional[str]:
+        """错误响应中的code字段"""
+        try:
+            return json.loads(response_text).get("code")
+        except (json.JSONDecodeError, AttributeError):
+            return None
+
+    async def submit_task(self, request_body: Dict[str, Any], endpoint: Optional[str] = None) -> str:
+        """
+        以X-DashScope-Async方式提交任务，返回任务ID
+
+        从Key池中选择剩余配额最多的Key提交，被限流时该Key进入冷却并改用其他Key重试
+        """
+        endpoint = endpoint or self.ENDPOINT
+        model = request_body.get("model") or self.model
+        print(f"📤 提交任务: {self.base_url}{endpoint} (模型: {model})")
+
+        attempts = len(self.credentials.keys) + self.THROTTLE_RETRIES
+        for attempt in range(attempts):
+            key = await self.credentials.acquire(model)
+            try:
+                data = await self.post_json(endpoint, request_body, async_task=True, api_key=key)
+                task_id = (data.get("output") or {}).get("task_id")
+                if not task_id:
+                    raise RuntimeError(f"未获取到任务ID: {data}")
+            except DashScopeThrottledError as e:
+                self.credentials.release(key, model, completed=False)
+                self.credentials.throttled(key)
+                if attempt == attempts - 1:
+                    report_provider_failure(e)
+                    raise
+                continue
+            except BaseException:
+                self.credentials.release(key, model, completed=False)
+                raise
+            break
+
+        self.credentials.assign(task_id, key)
+        self._task_quota[task_id] = (key, model)
+        self._submitted_at[task_id] = asyncio.get_running_loop().time()
+        context = journal_context.get()
+        if context is not None:
+            # 立即写入任务日志，服务重启后仍能找回已付费的任务
+            task_journal.record_submit(task_id, provider_model=model, base_url=self.base_url,
+                                       key_id=self.credentials.key_id(key), **context)
+            context["task_ids"].append(task_id)
+        print(f"✅ 任务ID: {task_id}")
+        return task_id
+
+    async def poll_task(self,
+                        task_id: str,
+                        poll_interval: Optional[float] = None,
+                        max_wait: Optional[float] = None) -> Dict[str, Any]:
+        """
+        等待任务结束，返回成功任务的完整响应
+
+        状态查询由进程级的task_poller统一调度：默认按模型的历史完成耗时自适应安排
+        查询时机（见api/task_eta.py），传入poll_interval时改为固定间隔。
+        任务失败或不存在时抛出RuntimeError，超过max_wait抛出TimeoutError
+        """
+        loop = asyncio.get_running_loop()
+        submitted_at = self._submitted_at.pop(task_id, loop.time())
+        try:
+            return await task_poller.wait(self, task_id, submitted_at, max_wait or self.MAX_WAIT, poll_interval,
+                                          api_key=self._task_key(task_id))
+        except Exception as e:
+            report_provider_failure(e)
+            raise
+        finally:
+            quota = self._task_quota.pop(task_id, None)
+            if quota:
+                self.credentials.release(*quota)
+
+    def _task_key(self, task_id: str) -> str:
+        """提交任务的Key（服务重启后从任务日志中查找），任务只能用提交它的Key查询和取消"""
+        key = self.credentials.key_for_task(task_id)
+        if key is None:
+            entry = task_journal.get(task_id) or {}
+            key = self.credentials.key_for_task(task_id, entry.get("key_id"))
+        return key or self.api_key
+
+    async def cancel_task(self, task_id: str) -> bool:
+        """
+        取消任务（DashScope只能取消仍在排队的任务），返回是否取消成功
+
+        已开始执行的任务无法取消，会在服务端继续运行到结束
+        """
+        try:
+            await self.post_json(f"/tasks/{task_id}/cancel", {}, timeout=10, api_key=self._task_key(task_id))
+        except (RuntimeError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"⚠️ 任务 {task_id} 取消失败: {e}")
+            return False
+        print(f"🛑 已取消任务: {task_id}")
+        return True
+
+    async def download(self, url: str, output_path: Path, timeout: float = 300) -> int:
+        """流式下载结果文件（断点续传、大小校验、原子重命名），返回字节数"""
+        try:
+            result = await stream_download(dashscope_pool.get_session(), url, output_path, timeout=timeout)
+        except Exception as e:
+            report_provider_failure(e)
+            raise
+        return result["bytes"]
+
+    async def run_task(self, request_body: Dict[str, Any], endpoint: Optional[str] = None) -> Tuple[str, Dict[str, Any]]:
+        """提交任务并等待完成，返回（任务ID, 任务响应）"""
+        task_id = await self.submit_task(request_body, endpoint)
+        data = await self.poll_task(task_id)
+        return task_id, data
+
+    @staticmethod
+    def extract_video_url(data: Dict[str, Any]) -> Optional[str]:
+        """从任务响应中取出视频URL（兼容video_url和results两种格式）"""
+        output = data.get("output", {})
+        if output.get("video_url"):
+            return output["video_url"]
+        results = output.get("results") or []
+        if results and results[0].get("url"):
+            return results[0]["url"]
+        return None
+
+    @staticmethod
+    def extract_image_urls(data: Dict[str, Any]) -> List[str]:
+        """从任务响应中取出图片URL列表"""
+        results = data.get("output", {}).get("results") or []
+        return [result["url"] for result in results if result.get("url")]
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+图片输入的data URI编码缓存
+按 (路径, 文件大小, 修改时间, 目标尺寸) 缓存已编码的data URI，总大小超出上限时按LRU淘汰；
+未命中时在工作线程中预处理（缩小、重新压缩，见image_preprocess.py）或分块读取原图并编码，
+同一图片的并发请求只编码一次
+"""
+
+import asyncio
+import base64
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Any, Tuple, Optional
+
+from api.image_preprocess import prepare_image
+
+# 缓存键：(路径, 文件大小, 修改时间, 目标尺寸, 是否按方向翻转)
+CacheKey = Tuple[str, int, int, Optional[Tuple[int, int]], bool]
+
+# 分块读取大小（3的倍数，保证各块的base64可以直接拼接）
+ENCODE_CHUNK_SIZE = 3 * 256 * 1024
+
+
+def _encode_file(path: str, mime_type: str,
+                 max_size: Optional[Tuple[int, int]] = None, match_orientation: bool = False) -> str:
+    """预处理或分块读取并base64编码，返回data URI"""
+    if max_size:
+        prepared = prepare_image(path, max_size, match_orientation)
+        # 只有预处理后确实更小时才替换原图
+        if prepared and len(prepared[0]) < os.path.getsize(path):
+            data, prepared_mime = prepared
+            return f"data:{prepared_mime};base64," + base64.b64encode(data).decode("ascii")
+
+    parts = [f"data:{mime_type};base64,"]
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(ENCODE_CHUNK_SIZE)
+            if not chunk:
+                break
+            parts.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(parts)
+
+
+class DataURICache:
+    """已编码图片的LRU缓存（按data URI字符数计内存）"""
+
+    # 缓存总大小上限（字符数，约等于字节数）
+    MAX_BYTES = int(os.getenv("IMAGE_URI_CACHE_MB", "256")) * 1024 * 1024
+    # 编码线程数
+    MAX_WORKERS = 4
+
+    def __init__(self, max_bytes: int = None):
+        """
+        Args:
+            max_bytes: 缓存总大小上限，单个超过上限一半的图片不缓存
+        """
+        self.max_bytes = max_bytes or self.MAX_BYTES
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[CacheKey, str]" = OrderedDict()
+        self._inflight: Dict[CacheKey, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS, thread_name_prefix="image-encode")
+        self._size = 0
+        self._stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+
+    async def get(self,
+                  image_path: str,
+                  default_mime: str = "image/png",
+                  max_size: Optional[Tuple[int, int]] = None,
+                  match_orientation: bool = False) -> str:
+        """
+        返回图片的data URI（缓存命中时不读文件）
+
+        Args:
+            image_path: 本地图片路径
+            default_mime: 无法从扩展名识别时使用的MIME类型
+            max_size: 上传前缩小到的尺寸上限 (宽, 高)，不传则上传原图
+            match_orientation: 按图片横竖方向翻转max_size
+        """
+        path = Path(image_path)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            raise FileNotFoundError(f"图片文件不存在: {image_path}")
+
+        key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns,
+               tuple(max_size) if max_size else None, match_orientation)
+        with self._lock:
+            uri = self._entries.get(key)
+            if uri is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return uri
+
+            future = self._inflight.get(key)
+            owner = future is None
+            # 同一图片正在编码时等待同一个结果
+            self._stats["misses" if owner else "coalesced"] += 1
+            if owner:
+                mime_type = mimetypes.guess_type(image_path)[0] or default_mime
+                future = self._executor.submit(_encode_file, key[0], mime_type, key[3], match_orientation)
+                self._inflight[key] = future
+
+        if owner:
+            # 回调可能在当前线程立即执行，需在释放锁之后注册
+            future.add_done_callback(lambda f: self._store(key, f))
+        # 取消一个等待方不能取消共享的编码任务（尚未开始执行时wrap_future会连带取消它），
+        # 否则等待同一结果的其他请求都会收到CancelledError
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    def _store(self, key: CacheKey, future: Future) -> None:
+        with self._lock:
+            self._inflight.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            uri = future.result()
+            if len(uri) > self.max_bytes // 2:
+                return
+
+            # 同一路径的旧版本不再可能命中
+            for old_key in [k for k in self._entries if k[0] == key[0] and k[1:3] != key[1:3]]:
+                self._size -= len(self._entries.pop(old_key))
+
+            self._entries[key] = uri
+            self._size += len(uri)
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self._stats["evictions"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._size
+        stats["max_bytes"] = self.max_bytes
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+# 进程级图片编码缓存
+image_uri_cache = DataURICache()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+上传前的图片预处理
+按目标分辨率等比缩小（不放大）、按透明通道选择JPEG或WebP重新压缩，
+并提供按宽高比就近选择模型支持分辨率的工具函数。未安装Pillow/NumPy时退化为原图上传
+"""
+
+import io
+import math
+from typing import Optional, Tuple, List
+
+try:
+    from PIL import Image, ImageOps
+    import numpy as np
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+
+# 重新压缩质量
+JPEG_QUALITY = 90
+WEBP_QUALITY = 90
+# 宽高比差异在此范围内视为同一比例（对数差）
+ASPECT_TOLERANCE = 0.05
+# EXIF方向标记中需要交换宽高的取值
+_ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def parse_resolution(resolution: str) -> Optional[Tuple[int, int]]:
+    """解析 "1280*720" / "1280x720" 形式的分辨率，失败返回None"""
+    if not resolution:
+        return None
+    for sep in ("*", "x", "X"):
+        if sep in resolution:
+            try:
+                width, height = (int(v) for v in resolution.split(sep, 1))
+            except ValueError:
+                return None
+            return (width, height) if width > 0 and height > 0 else None
+    return None
+
+
+def image_size(image_path: str) -> Optional[Tuple[int, int]]:
+    """读取图片的显示尺寸（考虑EXIF旋转，只解析文件头），失败返回None"""
+    if not HAS_PIL:
+        return None
+    try:
+        with Image.open(image_path) as img:
+            width, height = img.size
+            if img.getexif().get(0x0112) in _ROTATED_ORIENTATIONS:
+                width, height = height, width
+            return width, height
+    except Exception:
+        return None
+
+
+def nearest_resolution(size: Tuple[int, int], supported: List[str]) -> str:
+    """
+    在支持的分辨率中选择宽高比最接近的一项；比例相近的多项中选面积最接近的
+
+    Args:
+        size: 参考尺寸（输入图片或请求的分辨率）
+        supported: 支持的分辨率列表（"W*H"）
+    """
+    width, height = size
+    aspect = math.log(width / height)
+    candidates = [(res, parse_resolution(res)) for res in supported]
+    candidates = [(res, dims) for res, dims in candidates if dims]
+
+    def aspect_diff(dims):
+        return abs(math.log(dims[0] / dims[1]) - aspect)
+
+    best = min(aspect_diff(dims) for _, dims in candidates)
+    close = [(res, dims) for res, dims in candidates if aspect_diff(dims) <= best + ASPECT_TOLERANCE]
+    area = width * height
+    return min(close, key=lambda item: abs(math.log(item[1][0] * item[1][1] / area)))[0]
+
+
+def prepare_image(image_path: str,
+                  max_size: Tuple[int, int],
+                  match_orientation: bool = False) -> Optional[Tuple[bytes, str]]:
+    """
+    缩小并重新压缩图片，返回 (图片字节, MIME类型)；无法处理时返回None
+
+    Args:
+        image_path: 本地图片路径
+        max_size: 目标尺寸上限 (宽, 高)，图片等比缩小到不超过该尺寸
+        match_orientation: 为True时按图片横竖方向翻转max_size（用于只约束清晰度档位的模型）
+    """
+    if not HAS_PIL:
+        return None
+    try:
+        with Image.open(image_path) as source:
+            img = ImageOps.exif_transpose(source)
+            img.load()
+    except Exception:
+        return None
+
+    box_width, box_height = max_size
+    if match_orientation and (img.width >= img.height) != (box_width >= box_height):
+        box_width, box_height = box_height, box_width
+
+    scale = min(box_width / img.width, box_height / img.height, 1.0)
+    if scale < 1.0:
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                         Image.LANCZOS)
+
+    # 只有真正存在半透明像素时才保留透明通道
+    has_alpha = False
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        has_alpha = bool(np.asarray(img.getchannel("A")).min() < 255)
+
+    buffer = io.BytesIO()
+    if has_alpha:
+        img.save(buffer, format="WEBP", quality=WEBP_QUALITY, method=4)
+        return buffer.getvalue(), "image/webp"
+
+    img.convert("RGB").save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return buffer.getvalue(), "image/jpeg"
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+本地T2V服务节点池
+多个局域网GPU节点共用一个连接池会话；按节点上进行中的任务数（其次是最近观察到的排队深度）选择节点，
+连接失败的节点标记为不可用，间隔一段时间后通过健康检查恢复，并统计每个节点的任务量和吞吐
+"""
+
+import asyncio
+import threading
+import time
+from typing import Dict, Any, List, Optional
+
+import aiohttp
+
+from api.dashscope_client import DashScopeSessionPool
+from config.settings import LOCAL_T2V_BACKENDS
+
+
+class LocalT2VBackendPool:
+    """本地T2V节点池：健康检查、最少进行中任务调度与节点统计"""
+
+    # 健康检查路径（查询一个不存在的任务，节点存活时返回not_found）
+    HEALTH_PATH = "/task_status/healthcheck"
+    HEALTH_TIMEOUT = 5
+    # 可用节点的健康检查间隔、不可用节点的重新探测间隔（秒）
+    HEALTH_INTERVAL = 30
+    RETRY_INTERVAL = 15
+
+    def __init__(self, backends: Optional[List[str]] = None):
+        """
+        Args:
+            backends: 节点地址列表，不传则使用配置中的LOCAL_T2V_BACKENDS
+        """
+        self.backends = [url.rstrip("/") for url in (backends or LOCAL_T2V_BACKENDS)]
+        if not self.backends:
+            raise ValueError("至少需要一个本地T2V节点")
+        # 局域网地址，会话不读取代理环境变量
+        self.sessions = DashScopeSessionPool(limit_per_host=8)
+        self._lock = threading.Lock()
+        self._nodes: Dict[str, Dict[str, Any]] = {
+            url: {
+                "healthy": True,
+                "last_check": 0.0,
+                "last_error": None,
+                "outstanding": 0,
+                "queue_depth": 0,
+                "submitted": 0,
+                "completed": 0,
+                "failed": 0,
+                "failovers": 0,
+                "busy_seconds": 0.0,
+                "bytes": 0
+            }
+            for url in self.backends
+        }
+
+    def get_session(self) -> aiohttp.ClientSession:
+        return self.sessions.get_session()
+
+    # ==================== 健康检查 ====================
+
+    async def _probe(self, url: str) -> bool:
+        try:
+            async with self.get_session().get(f"{url}{self.HEALTH_PATH}",
+                                              timeout=aiohttp.ClientTimeout(total=self.HEALTH_TIMEOUT)) as response:
+                await response.read()
+                healthy, error = response.status < 500, f"HTTP {response.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            healthy, error = False, f"{type(e).__name__}: {e}"
+
+        with self._lock:
+            node = self._nodes[url]
+            if healthy != node["healthy"]:
+                print(f"{'✅' if healthy else '❌'} 本地T2V节点 {url} {'恢复可用' if healthy else '不可用'}")
+            node["healthy"] = healthy
+            node["last_check"] = time.monotonic()
+            node["last_error"] = None if healthy else error
+        return healthy
+
+    async def check_health(self, force: bool = False) -> None:
+        """探测超过检查间隔的节点（force为True时探测全部节点）"""
+        now = time.monotonic()
+        with self._lock:
+            stale = [
+                url for url, node in self._nodes.items()
+                if force or now - node["last_check"] >= (self.HEALTH_INTERVAL if node["healthy"] else self.RETRY_INTERVAL)
+            ]
+        if stale:
+            await asyncio.gather(*(self._probe(url) for url in stale))
+
+    def mark_down(self, url: str, error: str) -> None:
+        """任务执行中发现节点失联时标记为不可用"""
+        with self._lock:
+            node = self._nodes[url]
+            if node["healthy"]:
+                print(f"❌ 本地T2V节点 {url} 标记为不可用: {error}")
+            node["healthy"] = False
+            node["last_check"] = time.monotonic()
+            node["last_error"] = error
+
+    # ==================== 调度 ====================
+
+    def _pick(self) -> Optional[str]:
+        with self._lock:
+            candidates = [(node["outstanding"], node["queue_depth"], index, url)
+                          for index, (url, node) in enumerate(self._nodes.items()) if node["healthy"]]
+            if not candidates:
+                return None
+            url = min(candidates)[3]
+            node = self._nodes[url]
+            node["outstanding"] += 1
+            node["submitted"] += 1
+            return url
+
+    async def acquire(self) -> str:
+        """选择进行中任务最少的可用节点并占用（任务结束后调用release）"""
+        await self.check_health()
+        url = self._pick()
+        if url is None:
+            # 所有节点都不可用时立即重新探测一次
+            await self.check_health(force=True)
+            url = self._pick()
+        if url is None:
+            raise ConnectionError(f"没有可用的本地T2V节点: {', '.join(self.backends)}")
+        return url
+
+    def release(self, url: str, elapsed: float, size: int = 0,
+                failed: bool = False, failover: bool = False) -> None:
+        """
+        释放节点并记录任务结果
+
+        Args:
+            url: acquire返回的节点地址
+            elapsed: 任务在该节点上的耗时（秒）
+            size: 下载的视频字节数
+            failed: 任务是否失败
+            failover: 是否因节点失联改投其他节点
+        """
+        with self._lock:
+            node = self._nodes[url]
+            node["outstanding"] = max(0, node["outstanding"] - 1)
+            node["busy_seconds"] += elapsed
+            node["bytes"] += size
+            if failover:
+                node["failovers"] += 1
+            elif failed:
+                node["failed"] += 1
+            else:
+                node["completed"] += 1
+            if node["outstanding"] == 0:
+                node["queue_depth"] = 0
+
+    def update_queue_depth(self, url: str, depth: int) -> None:
+        """记录轮询时观察到的节点排队深度"""
+        with self._lock:
+            self._nodes[url]["queue_depth"] = depth
+
+    def stats(self) -> Dict[str, Any]:
+        """各节点的可用状态、进行中任务数和吞吐统计"""
+        with self._lock:
+            nodes = {url: dict(node) for url, node in self._nodes.items()}
+        now = time.monotonic()
+        for node in nodes.values():
+            busy = node.pop("busy_seconds")
+            finished = node["completed"] + node["failed"] + node["failovers"]
+            last_check = node.pop("last_check")
+            node["avg_job_seconds"] = round(busy / finished, 1) if finished else 0.0
+            node["bytes_per_sec"] = round(node["bytes"] / busy, 1) if busy else 0.0
+            node["seconds_since_check"] = round(now - last_check, 1) if last_check else None
+        return {
+            "backends": nodes,
+            "healthy": sum(1 for node in nodes.values() if node["healthy"]),
+            "outstanding": sum(node["outstanding"] for node in nodes.values())
+        }
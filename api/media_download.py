@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+媒体文件流式下载
+分块写入同目录下的 .part 临时文件，连接中断时按已写入字节数发送 Range 续传，
+完成后核对 Content-Length（以及整包下载时的 Content-MD5），再原子重命名为目标文件
+"""
+
+import asyncio
+import base64
+import hashlib
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+import aiohttp
+
+try:
+    import aiofiles
+    HAS_AIOFILES = True
+except ImportError:
+    HAS_AIOFILES = False
+
+
+# 每次读取/写入的块大小
+CHUNK_SIZE = 256 * 1024
+# 单个文件的最大重试次数
+MAX_RETRIES = 3
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+class DownloadError(Exception):
+    """下载失败（重试耗尽或服务端返回错误）"""
+    pass
+
+
+class DownloadTelemetry:
+    """下载量、吞吐与重试统计"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {
+            "downloads": 0,
+            "failures": 0,
+            "retries": 0,
+            "resumes": 0,
+            "bytes": 0,
+            "seconds": 0.0
+        }
+
+    def record(self, size: int, elapsed: float, retries: int, resumes: int, failed: bool = False) -> None:
+        with self._lock:
+            self._stats["downloads"] += 1
+            self._stats["failures"] += int(failed)
+            self._stats["retries"] += retries
+            self._stats["resumes"] += resumes
+            self._stats["bytes"] += size
+            self._stats["seconds"] += elapsed
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["bytes_per_sec"] = round(stats["bytes"] / stats["seconds"], 1) if stats["seconds"] else 0.0
+        stats["seconds"] = round(stats["seconds"], 3)
+        return stats
+
+
+# 进程级下载统计
+download_telemetry = DownloadTelemetry()
+
+
+async def _write(handle, chunk: bytes) -> None:
+    if HAS_AIOFILES:
+        await handle.write(chunk)
+    else:
+        await asyncio.get_running_loop().run_in_executor(None, handle.write, chunk)
+
+
+async def _open(path: Path, mode: str):
+    if HAS_AIOFILES:
+        return await aiofiles.open(path, mode)
+    return await asyncio.get_running_loop().run_in_executor(None, open, path, mode)
+
+
+async def _close(handle) -> None:
+    if HAS_AIOFILES:
+        await handle.close()
+    else:
+        await asyncio.get_running_loop().run_in_executor(None, handle.close)
+
+
+async def stream_download(session: aiohttp.ClientSession,
+                          url: str,
+                          output_path: Path,
+                          params: Optional[Dict[str, str]] = None,
+                          headers: Optional[Dict[str, str]] = None,
+                          timeout: float = 300,
+                          max_retries: int = MAX_RETRIES) -> Dict[str, Any]:
+    """
+    流式下载到output_path，返回 {"bytes", "elapsed", "bytes_per_sec", "retries", "resumes"}
+
+    Args:
+        session: 复用的aiohttp会话
+        url: 下载地址
+        output_path: 目标文件路径
+        params: 查询参数
+        headers: 额外请求头
+        timeout: 单次请求的总超时（秒）
+        max_retries: 中断或校验失败后的最大重试次数
+    """
+    output_path = Path(output_path)
+    part_path = output_path.with_name(output_path.name + ".part")
+    started = time.monotonic()
+    retries = 0
+    resumes = 0
+    last_error = None
+
+    for attempt in range(max_retries + 1):
+        if attempt:
+            retries += 1
+            await asyncio.sleep(min(2 ** (attempt - 1), 8))
+
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        request_headers = dict(headers or {})
+        if offset:
+            request_headers["Range"] = f"bytes={offset}-"
+
+        try:
+            async with session.get(url, params=params, headers=request_headers,
+                                   timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status == 416:
+                    # 临时文件已不匹配服务端内容，从头下载
+                    part_path.unlink(missing_ok=True)
+                    last_error = DownloadError("Range不被接受，重新下载")
+                    continue
+                if response.status not in (200, 206):
+                    error_text = await response.text()
+                    error = DownloadError(f"下载失败 ({response.status}): {error_text[:200]}")
+                    if response.status == 429 or response.status >= 500:
+                        last_error = error
+                        continue
+                    # 不可重试的错误（如续传时链接已过期返回403）：不会再续传，删除临时文件
+                    download_telemetry.record(0, time.monotonic() - started, retries, resumes, failed=True)
+                    part_path.unlink(missing_ok=True)
+                    raise error
+
+                expected_size = None
+                if response.status == 206:
+                    match = CONTENT_RANGE.match(response.headers.get("Content-Range", ""))
+                    if not match or int(match.group(1)) != offset:
+                        part_path.unlink(missing_ok=True)
+                        last_error = DownloadError("Content-Range与已下载部分不一致，重新下载")
+                        continue
+                    if match.group(3) != "*":
+                        expected_size = int(match.group(3))
+                    resumes += 1
+                    mode = "ab"
+                else:
+                    # 服务端忽略Range时整包重下
+                    if response.content_length is not None:
+                        expected_size = response.content_length
+                    mode = "wb"
+
+                # 只有整包下载时Content-MD5才对应完整文件
+                content_md5 = response.headers.get("Content-MD5") if response.status == 200 else None
+                digest = hashlib.md5() if content_md5 else None
+
+                handle = await _open(part_path, mode)
+                try:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        await _write(handle, chunk)
+                        if digest:
+                            digest.update(chunk)
+                finally:
+                    await _close(handle)
+
+            size = part_path.stat().st_size
+            if expected_size is not None and size != expected_size:
+                # 长度不足时保留临时文件，下次续传；超长则说明内容已变化
+                if size > expected_size:
+                    part_path.unlink(missing_ok=True)
+                last_error = DownloadError(f"文件大小不符: {size} / {expected_size}")
+                continue
+            if digest and base64.b64encode(digest.digest()).decode() != content_md5:
+                part_path.unlink(missing_ok=True)
+                last_error = DownloadError("Content-MD5校验失败")
+                continue
+
+            os.replace(part_path, output_path)
+            elapsed = time.monotonic() - started
+            rate = size / elapsed if elapsed > 0 else 0.0
+            download_telemetry.record(size, elapsed, retries, resumes)
+            print(f"💾 已保存: {output_path} ({size / 1024 / 1024:.2f} MB, "
+                  f"{rate / 1024 / 1024:.2f} MB/s, 重试 {retries} 次)")
+            return {
+                "bytes": size,
+                "elapsed": round(elapsed, 3),
+                "bytes_per_sec": round(rate, 1),
+                "retries": retries,
+                "resumes": resumes
+            }
+        except asyncio.CancelledError:
+            # 下载被取消：不会再续传，删除临时文件
+            part_path.unlink(missing_ok=True)
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # 连接中断：保留已写入的部分，下一轮续传
+            last_error = e
+            print(f"⚠️ 下载中断({type(e).__name__})，已下载 "
+                  f"{part_path.stat().st_size if part_path.exists() else 0} 字节，准备续传")
+
+    download_telemetry.record(0, time.monotonic() - started, retries, resumes, failed=True)
+    part_path.unlink(missing_ok=True)
+    raise DownloadError(f"下载失败（重试 {retries} 次）: {last_error}")
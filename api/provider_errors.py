@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+服务商侧故障的识别与上报
+模型熔断只统计服务商侧的失败（5xx/429、超时、网络错误、服务端任务失败），
+调用方的问题（参数错误、输入文件缺失、内容审核拒绝）不计入。
+各模型客户端通常把异常转换为{"status": "error"}返回，因此在提交、轮询、下载等公共路径上
+把服务商故障记录到当前生成请求的上下文中，由GenerationService在调用结束后读取
+"""
+
+import asyncio
+from contextvars import ContextVar
+from typing import List, Optional
+
+import aiohttp
+
+from api.media_download import DownloadError
+
+# 当前生成请求中发生的服务商侧故障，由GenerationService在调用API前设置为空列表
+provider_failures: ContextVar[Optional[List[str]]] = ContextVar("provider_failures", default=None)
+
+# 服务端错误码中表示服务商侧故障的前缀（其余如InvalidParameter、DataInspectionFailed属于调用方问题）
+PROVIDER_ERROR_CODES = ("InternalError", "SystemError", "ServiceUnavailable", "Throttling", "RequestTimeOut")
+
+
+class DashScopeAPIError(RuntimeError):
+    """DashScope接口返回错误（HTTP错误或业务错误码）"""
+
+    def __init__(self, message: str, status: Optional[int] = None, code: Optional[str] = None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+    @property
+    def provider_failure(self) -> bool:
+        if self.status is not None and (self.status >= 500 or self.status == 429):
+            return True
+        return bool(self.code) and self.code.startswith(PROVIDER_ERROR_CODES)
+
+
+class DashScopeTaskFailedError(RuntimeError):
+    """异步任务在服务端以FAILED结束"""
+
+    def __init__(self, message: str, code: Optional[str] = None):
+        super().__init__(message)
+        self.code = code
+
+    @property
+    def provider_failure(self) -> bool:
+        return not self.code or self.code.startswith(PROVIDER_ERROR_CODES)
+
+
+def is_provider_failure(error: BaseException) -> bool:
+    """异常是否属于服务商侧故障"""
+    if isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, TimeoutError, DownloadError)):
+        return True
+    return bool(getattr(error, "provider_failure", False))
+
+
+def report_provider_failure(error: BaseException) -> None:
+    """服务商侧故障记录到当前生成请求的上下文（其他异常忽略）"""
+    failures = provider_failures.get()
+    if failures is not None and is_provider_failure(error):
+        failures.append(str(error) or type(error).__name__)
@@ -6,26 +6,29 @@
 
 import asyncio
 import json
-import time
-import base64
-import os
 from pathlib import Path
-from typing import Optional, Dict, Any
-import aiohttp
-import aiofiles
+from typing import Optional, Dict, Any, Tuple
 from datetime import datetime
 
-class QwenKeyframePlusAPI:
+from api.dashscope_client import DashScopeTaskClient
+from api.task_eta import task_eta
+from api.image_encoding import image_uri_cache
+
+class QwenKeyframePlusAPI(DashScopeTaskClient):
     """通义万相2.1-首尾帧-Plus模型API"""
     
-    def __init__(self, api_key: str = None):
-        self.api_key = api_key or os.getenv('DASHSCOPE_API_KEY')
-        if not self.api_key:
-            raise ValueError("API key is required. Please set DASHSCOPE_API_KEY in .env file")
-        self.base_url = "https://dashscope.aliyuncs.com/api/v1"
-        self.model = "wanx2.1-kf2v-plus"
-        self.output_dir = Path("./output/keyframe_plus")
-        self.output_dir.mkdir(parents=True, exist_ok=True)
+    ENDPOINT = "/services/aigc/image2video/video-synthesis"
+    MODEL = "wanx2.1-kf2v-plus"
+    OUTPUT_DIR = "./output/keyframe_plus"
+    EXPECTED_DURATION = 300  # 首尾帧视频通常需要数分钟
+    MAX_WAIT = 900  # 最长等待15分钟
+    # 各清晰度档位对应的输入图片尺寸上限（长边, 短边），按图片方向翻转
+    RESOLUTION_SIZES = {
+        "480P": (832, 480),
+        "720P": (1280, 720),
+        "1080P": (1920, 1080)
+    }
+    SUBMIT_TIMEOUT = 30
     
     async def generate_keyframe_video(
         self,
@@ -55,9 +58,10 @@ class QwenKeyframePlusAPI:
         
         try:
             # 1. 编码图片
-            print(f"\n🔧 步骤1: 编码图片为base64...")
-            first_frame_base64 = await self._encode_image(first_frame_path)
-            last_frame_base64 = await self._encode_image(last_frame_path)
+            print(f"\n🔧 步骤1: 缩小并编码图片为base64...")
+            max_size = self.RESOLUTION_SIZES.get(str(resolution).upper(), self.RESOLUTION_SIZES["1080P"])
+            first_frame_base64 = await self._encode_image(first_frame_path, max_size)
+            last_frame_base64 = await self._encode_image(last_frame_path, max_size)
             print(f"  ✅ 首帧大小: {len(first_frame_base64) / 1024:.1f} KB")
             print(f"  ✅ 尾帧大小: {len(last_frame_base64) / 1024:.1f} KB")
             
@@ -87,7 +91,7 @@ class QwenKeyframePlusAPI:
             if result.get("video_url"):
                 print(f"\n🔧 步骤4: 下载生成的视频...")
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                output_path = self.output_dir / f"keyframe_{timestamp}.mp4"
+                output_path = self.output_dir / f"keyframe_{timestamp}_{task_id[:8]}.mp4"
                 
                 success = await self._download_video(result["video_url"], output_path)
                 if success:
@@ -106,22 +110,10 @@ class QwenKeyframePlusAPI:
             print(f"📍 错误详情: {traceback.format_exc()}")
             return {"status": "error", "error": str(e)}
     
-    async def _encode_image(self, image_path: str) -> str:
-        """将图片编码为base64 data URI"""
-        file_path = Path(image_path)
-        
-        if not file_path.exists():
-            raise FileNotFoundError(f"图片文件不存在: {image_path}")
-        
-        # 检测MIME类型
-        import mimetypes
-        mime_type = mimetypes.guess_type(image_path)[0] or "image/png"
-        
-        async with aiofiles.open(image_path, 'rb') as f:
-            content = await f.read()
-            base64_str = base64.b64encode(content).decode('utf-8')
-            # 返回完整的data URI格式
-            return f"data:{mime_type};base64,{base64_str}"
+    async def _encode_image(self, image_path: str, max_size: Optional[Tuple[int, int]] = None) -> str:
+        """将图片缩小到max_size以内并编码为base64 data URI（按路径、大小和修改时间缓存）"""
+        return await image_uri_cache.get(image_path, default_mime="image/png",
+                                         max_size=max_size, match_orientation=True)
     
     async def _submit_task(
         self, 
@@ -132,16 +124,6 @@ class QwenKeyframePlusAPI:
         prompt_extend: bool
     ) -> Optional[str]:
         """提交视频生成任务"""
-        
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-            "X-DashScope-Async": "enable"
-        }
-        
-        # 使用正确的API端点
-        url = f"{self.base_url}/services/aigc/image2video/video-synthesis"
-        
         request_body = {
             "model": self.model,
             "input": {
@@ -155,41 +137,16 @@ class QwenKeyframePlusAPI:
             }
         }
         
-        print(f"  📦 模型: {self.model}")
-        print(f"  📡 API端点: {url}")
-        
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.post(
-                    url, 
-                    headers=headers, 
-                    json=request_body,
-                    timeout=aiohttp.ClientTimeout(total=30)
-                ) as response:
-                    response_text = await response.text()
-                    
-                    if response.status != 200:
-                        print(f"  ❌ 请求失败: HTTP {response.status}")
-                        print(f"  错误响应: {response_text}")
-                        return None
-                    
-                    data = json.loads(response_text)
-                    
-                    # 检查响应格式
-                    if "output" in data and "task_id" in data["output"]:
-                        return data["output"]["task_id"]
-                    else:
-                        print(f"  ❌ 响应格式异常: {data}")
-                        return None
-                        
-            except asyncio.TimeoutError:
-                print(f"  ❌ 请求超时(30秒)")
-                return None
-            except Exception as e:
-                print(f"  ❌ 请求异常: {e}")
-                return None
+        try:
+            return await self.submit_task(request_body)
+        except asyncio.TimeoutError:
+            print(f"  ❌ 请求超时({self.SUBMIT_TIMEOUT}秒)")
+            return None
+        except Exception as e:
+            print(f"  ❌ 请求异常: {e}")
+            return None
     
-    async def _poll_task_status(self, task_id: str, max_wait: int = 900) -> Dict[str, Any]:
+    async def _poll_task_status(self, task_id: str, max_wait: int = None) -> Dict[str, Any]:
         """
         轮询任务状态
         
@@ -197,111 +154,43 @@ class QwenKeyframePlusAPI:
             task_id: 任务ID
             max_wait: 最大等待时间(秒)，默认15分钟
         """
-        headers = {
-            "Authorization": f"Bearer {self.api_key}"
-        }
+        max_wait = max_wait or self.MAX_WAIT
+        estimate = task_eta.expected(self.model, self.EXPECTED_DURATION)
+        print(f"  ⏳ 最多等待 {max_wait} 秒，预计 {estimate['mean']:.0f} 秒完成")
         
-        url = f"{self.base_url}/tasks/{task_id}"
-        poll_interval = 30  # 每30秒查询一次
-        max_polls = max_wait // poll_interval
+        try:
+            data = await self.poll_task(task_id, max_wait=max_wait)
+        except TimeoutError:
+            print(f"\n  ⏱️ 等待超时(超过 {max_wait} 秒)")
+            return {"status": "error", "error": f"生成超时(超过{max_wait}秒)"}
+        except RuntimeError as e:
+            print(f"\n  ❌ 任务失败: {e}")
+            return {"status": "error", "error": str(e)}
         
-        print(f"  ⏳ 最多等待 {max_wait} 秒，每 {poll_interval} 秒查询一次")
+        print(f"\n  ✅ 视频生成成功!")
+        output = data.get("output", {})
+        usage = data.get("usage", {})
         
-        async with aiohttp.ClientSession() as session:
-            start_time = time.time()
-            last_status = None
-            
-            for i in range(max_polls):
-                try:
-                    async with session.get(
-                        url, 
-                        headers=headers,
-                        timeout=aiohttp.ClientTimeout(total=30)
-                    ) as response:
-                        if response.status != 200:
-                            print(f"  ⚠️ 查询失败: HTTP {response.status}")
-                            await asyncio.sleep(poll_interval)
-                            continue
-                        
-                        data = json.loads(await response.text())
-                        output = data.get("output", {})
-                        status = output.get("task_status", "UNKNOWN")
-                        
-                        # 只在状态变化时打印
-                        if status != last_status:
-                            elapsed = int(time.time() - start_time)
-                            print(f"  [{elapsed}秒] 任务状态: {status}")
-                            last_status = status
-                        
-                        if status == "SUCCEEDED":
-                            print(f"\n  ✅ 视频生成成功!")
-                            
-                            # 获取视频信息
-                            video_url = output.get("video_url")
-                            usage = data.get("usage", {})
-                            
-                            if output.get("orig_prompt"):
-                                print(f"  原始提示词: {output.get('orig_prompt')}")
-                            if output.get("actual_prompt"):
-                                print(f"  扩展提示词: {output.get('actual_prompt')}")
-                            
-                            return {
-                                "status": "success",
-                                "video_url": video_url,
-                                "duration": usage.get("video_duration", 5),
-                                "ratio": usage.get("video_ratio"),
-                                "task_id": task_id,
-                                "orig_prompt": output.get("orig_prompt"),
-                                "actual_prompt": output.get("actual_prompt")
-                            }
-                        
-                        elif status == "FAILED":
-                            error_msg = output.get("message", "未知错误")
-                            print(f"\n  ❌ 任务失败: {error_msg}")
-                            return {"status": "error", "error": error_msg}
-                        
-                        elif status == "UNKNOWN":
-                            print(f"\n  ⚠️ 任务不存在或已过期")
-                            return {"status": "error", "error": "任务不存在或已过期"}
-                        
-                except asyncio.TimeoutError:
-                    print(f"  ⚠️ 查询超时，继续重试...")
-                except Exception as e:
-                    print(f"  ⚠️ 查询出错: {e}")
-                
-                # 等待下次轮询
-                await asyncio.sleep(poll_interval)
+        if output.get("orig_prompt"):
+            print(f"  原始提示词: {output.get('orig_prompt')}")
+        if output.get("actual_prompt"):
+            print(f"  扩展提示词: {output.get('actual_prompt')}")
         
-        print(f"\n  ⏱️ 等待超时(超过 {max_wait} 秒)")
-        return {"status": "error", "error": f"生成超时(超过{max_wait}秒)"}
+        return {
+            "status": "success",
+            "video_url": self.extract_video_url(data),
+            "duration": usage.get("video_duration", 5),
+            "ratio": usage.get("video_ratio"),
+            "task_id": task_id,
+            "orig_prompt": output.get("orig_prompt"),
+            "actual_prompt": output.get("actual_prompt")
+        }
     
     async def _download_video(self, video_url: str, output_path: Path) -> bool:
         """下载生成的视频"""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    video_url,
-                    timeout=aiohttp.ClientTimeout(total=300)  # 5分钟超时
-                ) as response:
-                    if response.status != 200:
-                        print(f"  ❌ 下载失败: HTTP {response.status}")
-                        return False
-                    
-                    # 获取文件大小
-                    total_size = int(response.headers.get('content-length', 0))
-                    if total_size > 0:
-                        print(f"  📊 文件大小: {total_size / 1024 / 1024:.2f} MB")
-                    
-                    # 下载并保存
-                    content = await response.read()
-                    
-                    async with aiofiles.open(output_path, 'wb') as f:
-                        await f.write(content)
-                    
-                    actual_size = len(content) / 1024 / 1024
-                    print(f"  ✅ 下载完成: {actual_size:.2f} MB")
-                    return True
-                    
+            await self.download(video_url, output_path, timeout=300)  # 5分钟超时
+            return True
         except asyncio.TimeoutError:
             print(f"  ❌ 下载超时")
             return False
@@ -1,39 +1,64 @@
 #!/usr/bin/env python3
 """
 本地文生视频API模块
-基于局域网部署的T2V模型服务
+基于局域网部署的T2V模型服务（可配置多个GPU节点，见local_t2v_pool.py），
+节点在任务进行中失联时改投其他节点重新生成
 """
 
 import asyncio
 import json
 import time
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List
 from datetime import datetime
 
+from config.settings import LOCAL_T2V_BACKENDS
+
 try:
     import aiohttp
     HAS_AIOHTTP = True
 except ImportError:
     HAS_AIOHTTP = False
     
-try:
-    import aiofiles
-    HAS_AIOFILES = True
-except ImportError:
-    HAS_AIOFILES = False
+if HAS_AIOHTTP:
+    from api.media_download import stream_download, DownloadError
+    from api.local_t2v_pool import LocalT2VBackendPool
+    from api.provider_errors import report_provider_failure
 
 
 class LocalT2VAPIError(Exception):
     """本地T2V API错误"""
-    pass
+    # 是否属于服务端故障（计入模型熔断），参数错误等调用方问题为False
+    provider_failure = False
+
+
+class LocalT2VBackendError(LocalT2VAPIError):
+    """节点失联或丢失任务（可改投其他节点）"""
+    provider_failure = True
+
+
+class LocalT2VTaskFailedError(LocalT2VAPIError):
+    """任务在节点上执行失败"""
+    provider_failure = True
 
 
 class QwenLocalT2VAPI:
     """本地文生视频API"""
-    
-    def __init__(self, base_url: str = "http://192.168.3.4:8888"):
-        self.base_url = base_url
+
+    # 节点失联时最多改投其他节点的次数
+    MAX_FAILOVERS = 2
+    # 轮询连续失败多少次视为节点失联
+    MAX_POLL_FAILURES = 3
+
+    def __init__(self, base_url: str = None, backends: Optional[List[str]] = None):
+        """
+        Args:
+            base_url: 单个节点地址（兼容旧用法）
+            backends: 节点地址列表，不传则使用配置中的LOCAL_T2V_BACKENDS
+        """
+        backends = backends or ([base_url] if base_url else LOCAL_T2V_BACKENDS)
+        self.pool = LocalT2VBackendPool(backends) if HAS_AIOHTTP else None
+        self.base_url = backends[0]
         self.model = "local-t2v"
         self.output_dir = Path("./output/local_t2v")
         self.output_dir.mkdir(parents=True, exist_ok=True)
@@ -73,7 +98,7 @@ class QwenLocalT2VAPI:
         
         return width, height
     
-    async def _submit_task(self, request_body: Dict) -> str:
+    async def _submit_task(self, request_body: Dict, base_url: Optional[str] = None) -> str:
         """提交生成任务"""
         if not HAS_AIOHTTP:
             raise LocalT2VAPIError("需要安装aiohttp库")
@@ -82,7 +107,8 @@ class QwenLocalT2VAPI:
             "Content-Type": "application/json"
         }
         
-        url = f"{self.base_url}/generate_video_minimal"
+        base_url = base_url or self.base_url
+        url = f"{base_url}/generate_video_minimal"
         
         print(f"\n{'='*60}")
         print(f"🎬 开始本地T2V视频生成任务")
@@ -90,47 +116,50 @@ class QwenLocalT2VAPI:
         print(f"📝 提示词: {request_body['positive'][:50]}...")
         print(f"📐 分辨率: {request_body['width']}x{request_body['height']}")
         print(f"🎞️ 帧数: {request_body['length']}, 帧率: {request_body['fps']}fps")
-        print(f"🌐 服务地址: {self.base_url}")
+        print(f"🌐 服务地址: {base_url}")
         
-        # 创建会话时禁用代理，因为是局域网地址
-        connector = aiohttp.TCPConnector()
+        # 复用节点池的会话（不读取代理环境变量，因为是局域网地址）
+        session = self.pool.get_session()
         timeout = aiohttp.ClientTimeout(total=120)
         
         try:
-            async with aiohttp.ClientSession(connector=connector, trust_env=False, timeout=timeout) as session:
-                print(f"\n🔧 步骤1: 提交任务到本地服务...")
-                async with session.post(url, headers=headers, json=request_body) as response:
-                    response_text = await response.text()
-                    
-                    if response.status != 200:
-                        print(f"❌ API请求失败: HTTP {response.status}")
-                        print(f"错误响应: {response_text}")
-                        raise LocalT2VAPIError(f"API请求失败 ({response.status}): {response_text}")
-                    
-                    try:
-                        data = json.loads(response_text)
-                    except json.JSONDecodeError:
-                        raise LocalT2VAPIError(f"响应JSON解析失败: {response_text}")
-                    
-                    if data.get("detail"):
-                        # 处理验证错误
-                        error_msg = str(data["detail"])
-                        print(f"❌ API参数错误: {error_msg}")
-                        raise LocalT2VAPIError(f"API参数错误: {error_msg}")
-                    
-                    job_id = data.get("job_id")
-                    if not job_id:
-                        raise LocalT2VAPIError(f"未获取到job_id: {response_text}")
-                    
-                    print(f"✅ 任务提交成功")
-                    print(f"🆔 任务ID: {job_id}")
-                    return job_id
-                    
-        except aiohttp.ClientError as e:
+            print(f"\n🔧 步骤1: 提交任务到本地服务...")
+            async with session.post(url, headers=headers, json=request_body, timeout=timeout) as response:
+                response_text = await response.text()
+                
+                if response.status >= 500:
+                    print(f"❌ 节点错误: HTTP {response.status}")
+                    raise LocalT2VBackendError(f"节点错误 ({response.status}): {response_text[:200]}")
+                
+                if response.status != 200:
+                    print(f"❌ API请求失败: HTTP {response.status}")
+                    print(f"错误响应: {response_text}")
+                    raise LocalT2VAPIError(f"API请求失败 ({response.status}): {response_text}")
+                
+                try:
+                    data = json.loads(response_text)
+                except json.JSONDecodeError:
+                    raise LocalT2VAPIError(f"响应JSON解析失败: {response_text}")
+                
+                if data.get("detail"):
+                    # 处理验证错误
+                    error_msg = str(data["detail"])
+                    print(f"❌ API参数错误: {error_msg}")
+                    raise LocalT2VAPIError(f"API参数错误: {error_msg}")
+                
+                job_id = data.get("job_id")
+                if not job_id:
+                    raise LocalT2VAPIError(f"未获取到job_id: {response_text}")
+                
+                print(f"✅ 任务提交成功")
+                print(f"🆔 任务ID: {job_id}")
+                return job_id
+                
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             print(f"❌ 网络连接失败: {e}")
-            raise LocalT2VAPIError(f"无法连接到本地服务 {self.base_url}: {e}")
+            raise LocalT2VBackendError(f"无法连接到本地服务 {base_url}: {e}")
     
-    async def _poll_task_status(self, job_id: str) -> Dict[str, Any]:
+    async def _poll_task_status(self, job_id: str, base_url: Optional[str] = None) -> Dict[str, Any]:
         """轮询任务状态直到完成"""
         if not HAS_AIOHTTP:
             raise LocalT2VAPIError("需要安装aiohttp库")
@@ -138,74 +167,94 @@ class QwenLocalT2VAPI:
         max_polls = 600  # 最多轮询20分钟
         poll_interval = 5  # 每5秒轮询一次
         
-        url = f"{self.base_url}/task_status/{job_id}"
+        base_url = base_url or self.base_url
+        url = f"{base_url}/task_status/{job_id}"
         
         print(f"\n🔧 步骤2: 轮询任务状态...")
         start_time = time.time()
         
-        # 创建会话时禁用代理
-        connector = aiohttp.TCPConnector()
+        session = self.pool.get_session()
         timeout = aiohttp.ClientTimeout(total=30)
+        # 连续的网络错误次数，超过上限视为节点失联
+        failures = 0
         
-        try:
-            async with aiohttp.ClientSession(connector=connector, trust_env=False, timeout=timeout) as session:
-                for i in range(max_polls):
-                    try:
-                        async with session.get(url) as response:
-                            if response.status != 200:
-                                await asyncio.sleep(poll_interval)
-                                continue
-                            
-                            response_text = await response.text()
-                            data = json.loads(response_text)
-                            
-                            status = data.get("status")
-                            elapsed_time = int(time.time() - start_time)
-                            
-                            if status == "completed":
-                                print(f"\n{'='*60}")
-                                print(f"🎉 视频生成完成!")
-                                print(f"⏱️ 总耗时: {elapsed_time}秒")
-                                if data.get("execution_time"):
-                                    print(f"🔥 实际生成时间: {data['execution_time']:.2f}秒")
-                                print(f"✅ 完成时间: {data.get('completed_at', '未知')}")
-                                print(f"{'='*60}")
-                                
-                                return {
-                                    "status": "success",
-                                    "job_id": job_id,
-                                    "outputs": data.get("outputs", []),
-                                    "execution_time": data.get("execution_time"),
-                                    "completed_at": data.get("completed_at")
-                                }
-                            
-                            elif status == "not_found":
-                                print(f"\n❌ 任务未找到: {data.get('message', '')}")
-                                raise LocalT2VAPIError(f"任务未找到: {job_id}")
-                            
-                            elif status == "pending":
-                                queue_position = data.get("queue_position", "未知")
-                                print(f"⏳ 排队中... 位置: {queue_position} | 已等待 {elapsed_time}秒", end='\r')
-                            
-                            elif status == "running":
-                                progress = data.get("progress", "进行中")
-                                print(f"⏳ 生成中... {progress} | 已等待 {elapsed_time}秒", end='\r')
-                            
-                    except Exception as e:
-                        # 如果查询失败，继续重试
-                        print(f"⚠️ 状态查询失败，重试中... ({str(e)})", end='\r')
+        for i in range(max_polls):
+            try:
+                async with session.get(url, timeout=timeout) as response:
+                    if response.status != 200:
+                        failures = failures + 1 if response.status >= 500 else 0
+                        if failures >= self.MAX_POLL_FAILURES:
+                            raise LocalT2VBackendError(f"节点连续返回错误 ({response.status})")
+                        await asyncio.sleep(poll_interval)
+                        continue
                     
-                    await asyncio.sleep(poll_interval)
+                    response_text = await response.text()
+                failures = 0
+                data = json.loads(response_text)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                failures += 1
+                print(f"⚠️ 状态查询失败，重试中... ({str(e)})", end='\r')
+                if failures >= self.MAX_POLL_FAILURES:
+                    raise LocalT2VBackendError(f"轮询过程中节点失联: {e}")
+                await asyncio.sleep(poll_interval)
+                continue
+            except json.JSONDecodeError:
+                # 响应不完整，继续重试
+                await asyncio.sleep(poll_interval)
+                continue
             
-            raise TimeoutError(f"视频生成超时 (任务ID: {job_id})")
+            status = data.get("status")
+            elapsed_time = int(time.time() - start_time)
             
-        except aiohttp.ClientError as e:
-            print(f"❌ 轮询过程中网络错误: {e}")
-            raise LocalT2VAPIError(f"轮询过程中网络错误: {e}")
+            if status == "completed":
+                print(f"\n{'='*60}")
+                print(f"🎉 视频生成完成!")
+                print(f"⏱️ 总耗时: {elapsed_time}秒")
+                if data.get("execution_time"):
+                    print(f"🔥 实际生成时间: {data['execution_time']:.2f}秒")
+                print(f"✅ 完成时间: {data.get('completed_at', '未知')}")
+                print(f"{'='*60}")
+                
+                return {
+                    "status": "success",
+                    "job_id": job_id,
+                    "outputs": data.get("outputs", []),
+                    "execution_time": data.get("execution_time"),
+                    "completed_at": data.get("completed_at")
+                }
+            
+            elif status == "not_found":
+                # 节点重启后任务丢失，改投其他节点
+                print(f"\n❌ 任务未找到: {data.get('message', '')}")
+                raise LocalT2VBackendError(f"任务未找到: {job_id}")
+            
+            elif status == "failed":
+                print(f"\n❌ 任务失败: {data.get('message', '')}")
+                raise LocalT2VTaskFailedError(f"任务失败: {data.get('message', job_id)}")
+            
+            elif status == "pending":
+                queue_position = data.get("queue_position", "未知")
+                if isinstance(queue_position, int):
+                    self.pool.update_queue_depth(base_url, queue_position)
+                print(f"⏳ 排队中... 位置: {queue_position} | 已等待 {elapsed_time}秒", end='\r')
+            
+            elif status == "running":
+                progress = data.get("progress", "进行中")
+                print(f"⏳ 生成中... {progress} | 已等待 {elapsed_time}秒", end='\r')
+            
+            await asyncio.sleep(poll_interval)
+        
+        raise TimeoutError(f"视频生成超时 (任务ID: {job_id})")
     
     async def _download_video(self, job_id: str, filename: str, output_path: Path,
-                            file_type: str = "output", subfolder: str = "") -> None:
-        """下载生成的视频文件"""
+                            file_type: str = "output", subfolder: str = "",
+                            base_url: Optional[str] = None) -> int:
+        """
+        下载生成的视频文件，返回字节数
+
+        任务已在节点上完成，下载失败（链接失效、重试耗尽等）按任务失败处理：
+        不标记节点不可用，也不改投其他节点重新生成
+        """
         if not HAS_AIOHTTP:
             raise LocalT2VAPIError("需要安装aiohttp库")
         
@@ -217,48 +266,61 @@ class QwenLocalT2VAPI:
         if subfolder:
             params["subfolder"] = subfolder
             
-        url = f"{self.base_url}/proxy_video/{job_id}"
+        url = f"{base_url or self.base_url}/proxy_video/{job_id}"
         
         print(f"\n🔧 步骤3: 下载视频文件...")
         print(f"📥 下载文件: {filename}")
         
-        # 创建会话时禁用代理
-        connector = aiohttp.TCPConnector()
-        timeout = aiohttp.ClientTimeout(total=300)  # 下载可能需要更长时间
-        
+        # 流式写入临时文件，中断时按Range续传
         try:
-            async with aiohttp.ClientSession(connector=connector, trust_env=False, timeout=timeout) as session:
-                async with session.get(url, params=params) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        print(f"❌ 视频下载失败: HTTP {response.status}")
-                        print(f"错误信息: {error_text}")
-                        raise LocalT2VAPIError(f"视频下载失败 ({response.status}): {error_text}")
-                    
-                    # 获取文件大小
-                    total_size = int(response.headers.get('content-length', 0))
-                    if total_size:
-                        print(f"📊 文件大小: {total_size / 1024 / 1024:.2f} MB")
-                    
-                    # 下载文件
-                    content = await response.read()
-                    
-                    # 保存文件
-                    if HAS_AIOFILES:
-                        async with aiofiles.open(output_path, 'wb') as f:
-                            await f.write(content)
-                    else:
-                        # 同步写入文件
-                        with open(output_path, 'wb') as f:
-                            f.write(content)
-                    
-                    file_size = len(content) / 1024 / 1024
-                    print(f"✅ 下载完成: {file_size:.2f} MB")
-                    print(f"📁 保存到: {output_path}")
+            result = await stream_download(self.pool.get_session(), url, output_path, params=params,
+                                           timeout=300)  # 下载可能需要更长时间
+            print(f"✅ 下载完成: {result['bytes'] / 1024 / 1024:.2f} MB")
+            print(f"📁 保存到: {output_path}")
+            return result["bytes"]
                     
+        except DownloadError as e:
+            print(f"❌ 视频下载失败: {e}")
+            raise LocalT2VTaskFailedError(f"视频下载失败: {e}")
         except aiohttp.ClientError as e:
             print(f"❌ 下载过程中网络错误: {e}")
-            raise LocalT2VAPIError(f"下载过程中网络错误: {e}")
+            raise LocalT2VTaskFailedError(f"下载过程中网络错误: {e}")
+    
+    async def _run_on_backend(self, request_body: Dict, base_url: str) -> Dict[str, Any]:
+        """在指定节点上提交、轮询并下载视频"""
+        # 提交任务
+        job_id = await self._submit_task(request_body, base_url)
+        
+        # 轮询状态
+        result = await self._poll_task_status(job_id, base_url)
+        
+        # 下载视频文件
+        if result["status"] == "success":
+            outputs = result.get("outputs", [])
+            if outputs:
+                # 获取第一个输出文件
+                output_file = outputs[0]
+                filename = output_file.get("filename")
+                file_type = output_file.get("type", "output")
+                subfolder = output_file.get("subfolder", "")
+                
+                if filename:
+                    # 生成本地文件名
+                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    local_filename = f"local_t2v_{timestamp}_{str(job_id)[:8]}.mp4"
+                    output_path = self.output_dir / local_filename
+                    
+                    # 下载视频到本地
+                    result["bytes"] = await self._download_video(job_id, filename, output_path,
+                                                                 file_type, subfolder, base_url)
+                    result["local_path"] = str(output_path)
+                    result["filename"] = local_filename
+                else:
+                    print(f"⚠️ 未找到输出文件名")
+            else:
+                print(f"⚠️ 未找到输出文件信息")
+        
+        return result
     
     async def generate_text_to_video(self, prompt: str, negative_prompt: Optional[str] = None,
                                    duration: int = 5, fps: int = 24, resolution: str = "1920*1080",
@@ -307,40 +369,33 @@ class QwenLocalT2VAPI:
             if seed is not None:
                 request_body["seed"] = seed
             
-            # 提交任务
-            job_id = await self._submit_task(request_body)
-            
-            # 轮询状态
-            result = await self._poll_task_status(job_id)
-            
-            # 下载视频文件
-            if result["status"] == "success":
-                outputs = result.get("outputs", [])
-                if outputs:
-                    # 获取第一个输出文件
-                    output_file = outputs[0]
-                    filename = output_file.get("filename")
-                    file_type = output_file.get("type", "output")
-                    subfolder = output_file.get("subfolder", "")
-                    
-                    if filename:
-                        # 生成本地文件名
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        local_filename = f"local_t2v_{timestamp}.mp4"
-                        output_path = self.output_dir / local_filename
-                        
-                        # 下载视频到本地
-                        await self._download_video(job_id, filename, output_path, file_type, subfolder)
-                        result["local_path"] = str(output_path)
-                        result["filename"] = local_filename
-                    else:
-                        print(f"⚠️ 未找到输出文件名")
-                else:
-                    print(f"⚠️ 未找到输出文件信息")
+            if not HAS_AIOHTTP:
+                raise LocalT2VAPIError("需要安装aiohttp库")
             
-            return result
+            # 在节点池中选择节点执行；节点失联时改投其他节点重新生成
+            for attempt in range(self.MAX_FAILOVERS + 1):
+                base_url = await self.pool.acquire()
+                started = time.monotonic()
+                try:
+                    result = await self._run_on_backend(request_body, base_url)
+                except LocalT2VBackendError as e:
+                    self.pool.release(base_url, time.monotonic() - started, failover=True)
+                    self.pool.mark_down(base_url, str(e))
+                    if attempt >= self.MAX_FAILOVERS:
+                        raise
+                    print(f"🔁 节点 {base_url} 失联，改投其他节点 ({attempt + 1}/{self.MAX_FAILOVERS})")
+                    continue
+                except BaseException:
+                    self.pool.release(base_url, time.monotonic() - started, failed=True)
+                    raise
+                self.pool.release(base_url, time.monotonic() - started, size=result.pop("bytes", 0))
+                result["backend"] = base_url
+                result["failovers"] = attempt
+                return result
             
         except Exception as e:
+            if HAS_AIOHTTP:
+                report_provider_failure(e)
             print(f"\n❌ 生成失败: {str(e)}")
             import traceback
             print(f"📍 错误详情: {traceback.format_exc()}")
@@ -5,29 +5,25 @@
 """
 
 import asyncio
-import json
-import os
 import time
+import uuid
 from pathlib import Path
 from typing import Optional, Dict, Any, List
-import aiohttp
 
-class QwenAPITester:
+from api.dashscope_client import DashScopeTaskClient
+
+class QwenAPITester(DashScopeTaskClient):
     """千问API测试器"""
     
-    def __init__(self):
+    ENDPOINT = "/services/aigc/text2image/image-synthesis"
+    MODEL = "wan2.2-t2i-flash"  # 通义万象模型
+    OUTPUT_DIR = "./qwen_test_output"  # 测试输出目录
+    EXPECTED_DURATION = 15  # 文生图通常十几秒完成
+    MAX_WAIT = 240  # 最多等待4分钟
+    
+    def __init__(self, api_key: str = None):
         # 从环境变量获取API密钥
-        self.api_key = os.getenv('DASHSCOPE_API_KEY')
-        if not self.api_key:
-            raise ValueError("API key is required. Please set DASHSCOPE_API_KEY in .env file")
-        
-        # API配置
-        self.base_url = "https://dashscope.aliyuncs.com/api/v1"
-        self.model = "wan2.2-t2i-flash"  # 通义万象模型
-        
-        # 测试输出目录
-        self.output_dir = Path("./qwen_test_output")
-        self.output_dir.mkdir(exist_ok=True)
+        super().__init__(api_key)
         
         # 支持的分辨率列表
         self.supported_sizes = [
@@ -92,14 +88,9 @@ class QwenAPITester:
             result = await self._poll_task_status(task_id)
             print(f"✅ 任务完成，生成了 {len(result['images'])} 张图像")
             
-            # 步骤3: 下载图像
+            # 步骤3: 并发下载所有图像
             print("3️⃣ 下载生成的图像...")
-            downloaded_files = []
-            for idx, image_url in enumerate(result['images']):
-                output_path = self.output_dir / f"test_image_{int(time.time())}_{idx+1}.png"
-                await self._download_image(image_url, output_path)
-                downloaded_files.append(output_path)
-                print(f"  📸 图像 {idx+1} 已保存: {output_path.name}")
+            downloaded_files = [Path(path) for path in await self._download_images(result['images'], "test_image")]
             
             print("-" * 50)
             print("🎉 测试完成!")
@@ -135,11 +126,21 @@ class QwenAPITester:
         seed: Optional[int] = None
     ) -> str:
         """提交图像生成任务"""
-        
+        return await self.submit_task(self.build_request(prompt, negative_prompt, size, n, style, seed))
+    
+    def build_request(
+        self,
+        prompt: str,
+        negative_prompt: str = "",
+        size: str = "1920*1080",
+        n: int = 1,
+        style: str = "auto",
+        seed: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """构建文生图请求体"""
         # 验证分辨率格式
         size = self._validate_size(size)
         
-        # 构建请求体
         request_body = {
             "model": self.model,
             "input": {
@@ -158,122 +159,78 @@ class QwenAPITester:
         if seed is not None:
             request_body["parameters"]["seed"] = seed
         
-        # 设置请求头
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-            "X-DashScope-Async": "enable"  # 启用异步模式
-        }
-        
-        print(f"  📤 发送请求到: {self.base_url}/services/aigc/text2image/image-synthesis")
-        print(f"  📋 请求体: {json.dumps(request_body, indent=2, ensure_ascii=False)}")
-        
-        # 发送请求
-        async with aiohttp.ClientSession() as session:
-            url = f"{self.base_url}/services/aigc/text2image/image-synthesis"
-            
-            async with session.post(url, headers=headers, json=request_body) as response:
-                response_text = await response.text()
-                
-                print(f"  📥 响应状态: {response.status}")
-                print(f"  📄 响应内容: {response_text}")
-                
-                if response.status != 200:
-                    raise RuntimeError(f"API请求失败 ({response.status}): {response_text}")
-                
-                data = json.loads(response_text)
-                
-                # 检查响应
-                if data.get("code") and data["code"] != "200":
-                    raise RuntimeError(f"API错误: {data.get('message', 'Unknown error')}")
-                
-                # 返回任务ID
-                task_id = data["output"]["task_id"]
-                return task_id
+        return request_body
     
     async def _poll_task_status(self, task_id: str) -> Dict[str, Any]:
         """轮询任务状态直到完成"""
+        data = await self.poll_task(task_id)
+        image_urls = self.extract_image_urls(data)
+        print(f"  ✅ 任务成功完成，生成 {len(image_urls)} 张图像")
         
-        max_polls = 120  # 最多轮询120次
-        poll_interval = 2  # 每2秒轮询一次
-        
-        headers = {
-            "Authorization": f"Bearer {self.api_key}"
+        return {
+            "status": "success",
+            "images": image_urls,
+            "task_metrics": data["output"].get("task_metrics", {})
         }
-        
-        url = f"{self.base_url}/tasks/{task_id}"
-        print(f"  🔄 轮询URL: {url}")
-        
-        async with aiohttp.ClientSession() as session:
-            for i in range(max_polls):
-                print(f"  ⏱️  轮询 {i+1}/{max_polls}...")
-                
-                # 查询任务状态
-                async with session.get(url, headers=headers) as response:
-                    response_text = await response.text()
-                    
-                    if response.status != 200:
-                        print(f"  ⚠️  状态查询失败: {response_text}")
-                        await asyncio.sleep(poll_interval)
-                        continue
-                    
-                    data = json.loads(response_text)
-                    print(f"  📊 轮询响应: {json.dumps(data, indent=2, ensure_ascii=False)}")
-                    
-                    # 获取任务状态
-                    status = data["output"]["task_status"]
-                    print(f"  📈 任务状态: {status}")
-                    
-                    if status == "SUCCEEDED":
-                        # 任务成功完成
-                        results = data["output"]["results"]
-                        image_urls = [result["url"] for result in results]
-                        
-                        print(f"  ✅ 任务成功完成，生成 {len(image_urls)} 张图像")
-                        for idx, url in enumerate(image_urls):
-                            print(f"    🖼️  图像 {idx+1}: {url}")
-                        
-                        return {
-                            "status": "success",
-                            "images": image_urls,
-                            "task_metrics": data["output"].get("task_metrics", {})
-                        }
-                    
-                    elif status == "FAILED":
-                        # 任务失败
-                        error_msg = data["output"].get("message", "Unknown error")
-                        raise RuntimeError(f"生成任务失败: {error_msg}")
-                    
-                    elif status == "RUNNING" or status == "PENDING":
-                        # 任务进行中
-                        progress = min(100, (i + 1) * 100 // 30)  # 估算进度
-                        print(f"  🔄 生成进度: {progress}% (状态: {status})")
-                    
-                    else:
-                        print(f"  ❓ 未知状态: {status}")
-                
-                await asyncio.sleep(poll_interval)
-        
-        raise TimeoutError(f"图像生成超时 (任务ID: {task_id})")
     
     async def _download_image(self, image_url: str, output_path: Path):
         """下载生成的图像"""
+        await self.download(image_url, output_path)
+    
+    async def _download_images(self, image_urls: List[str], prefix: str = "gen") -> List[str]:
+        """
+        并发下载一个任务生成的所有图像，返回下载成功的文件路径
         
-        print(f"  📥 下载图像: {image_url}")
-        print(f"  💾 保存到: {output_path}")
+        部分图像下载失败时保留其余图像，全部失败时抛出第一个错误
+        """
+        # 文件名带随机后缀，避免同一秒内并发生成的图片互相覆盖
+        batch = f"{prefix}_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+        output_paths = [self.output_dir / f"{batch}_{idx+1}.png" for idx in range(len(image_urls))]
+        outcomes = await asyncio.gather(
+            *(self._download_image(url, path) for url, path in zip(image_urls, output_paths)),
+            return_exceptions=True
+        )
+        
+        downloaded = []
+        errors = []
+        for idx, (path, outcome) in enumerate(zip(output_paths, outcomes)):
+            if isinstance(outcome, Exception):
+                print(f"  ⚠️ 图像 {idx+1} 下载失败: {outcome}")
+                errors.append(outcome)
+            elif isinstance(outcome, BaseException):
+                raise outcome
+            else:
+                print(f"  📸 图像 {idx+1} 已保存: {path.name}")
+                downloaded.append(str(path))
+        if errors and not downloaded:
+            raise errors[0]
+        return downloaded
+    
+    async def generate_images(
+        self,
+        prompt: str,
+        negative_prompt: str = "",
+        size: str = "1920*1080",
+        n: int = 1,
+        style: str = "auto",
+        seed: Optional[int] = None
+    ) -> List[str]:
+        """
+        一次任务生成n张图像并并发下载，返回本地文件路径列表
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(image_url) as response:
-                if response.status != 200:
-                    raise RuntimeError(f"图像下载失败 ({response.status})")
-                
-                # 保存图像
-                content = await response.read()
-                with open(output_path, 'wb') as f:
-                    f.write(content)
-                
-                file_size = len(content) / 1024 / 1024  # MB
-                print(f"  ✅ 图像已保存: {output_path.name} ({file_size:.2f} MB)")
+        Args:
+            prompt: 提示词
+            negative_prompt: 负向提示词
+            size: 分辨率
+            n: 生成数量（1-4）
+            style: 风格
+            seed: 随机种子
+        """
+        task_id = await self._submit_generation_task(prompt, negative_prompt, size, n, style, seed)
+        result = await self._poll_task_status(task_id)
+        if not result.get("images"):
+            return []
+        return await self._download_images(result["images"])
 
 async def main():
     """主函数"""
@@ -5,24 +5,20 @@
 
 import asyncio
 import json
-import os
 import time
 from pathlib import Path
 from typing import Optional, Dict, Any
-import aiohttp
-import aiofiles
 
-class QwenT2VPlusAPI:
+from api.dashscope_client import DashScopeTaskClient
+
+class QwenT2VPlusAPI(DashScopeTaskClient):
     """通义万相2.2-文生视频-Plus模型API"""
     
-    def __init__(self, api_key: str = None):
-        self.api_key = api_key or os.getenv('DASHSCOPE_API_KEY')
-        if not self.api_key:
-            raise ValueError("API key is required. Please set DASHSCOPE_API_KEY in .env file")
-        self.base_url = "https://dashscope.aliyuncs.com/api/v1"
-        self.model = "wan2.2-t2v-plus"
-        self.output_dir = Path("./output/t2v_plus")
-        self.output_dir.mkdir(parents=True, exist_ok=True)
+    ENDPOINT = "/services/aigc/video-generation/video-synthesis"
+    MODEL = "wan2.2-t2v-plus"
+    OUTPUT_DIR = "./output/t2v_plus"
+    EXPECTED_DURATION = 180
+    MAX_WAIT = 600  # 最多等待10分钟（文生视频较复杂）
     
     def _format_resolution(self, resolution: str) -> str:
         """格式化分辨率为API支持的格式"""
@@ -135,7 +131,7 @@ class QwenT2VPlusAPI:
             if result["status"] == "success" and result.get("video_url"):
                 print(f"📥 开始下载视频...")
                 timestamp = int(time.time())
-                output_path = self.output_dir / f"t2v_plus_{timestamp}.mp4"
+                output_path = self.output_dir / f"t2v_plus_{timestamp}_{task_id[:8]}.mp4"
                 await self._download_video(result["video_url"], output_path)
                 result["local_path"] = str(output_path)
                 print(f"✅ 视频已保存: {output_path}")
@@ -153,151 +149,28 @@ class QwenT2VPlusAPI:
     
     async def _submit_task(self, request_body: Dict) -> str:
         """提交生成任务"""
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-            "X-DashScope-Async": "enable"
-        }
-        
-        url = f"{self.base_url}/services/aigc/video-generation/video-synthesis"
-        
-        print(f"📤 发送请求到: {url}")
-        print(f"📋 请求体大小: {len(json.dumps(request_body))} 字符")
-        print(f"🔑 Authorization头: Bearer {self.api_key[:10]}...")
-        print(f"📦 模型名称: {request_body['model']}")
-        print(f"📋 请求体: {json.dumps(request_body, indent=2, ensure_ascii=False)}")
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=request_body) as response:
-                response_text = await response.text()
-                
-                print(f"📥 HTTP响应状态: {response.status}")
-                print(f"📄 响应头: {dict(response.headers)}")
-                print(f"📄 响应内容: {response_text}")
-                
-                if response.status != 200:
-                    print(f"❌ API请求失败，状态码: {response.status}")
-                    raise RuntimeError(f"API请求失败 ({response.status}): {response_text}")
-                
-                try:
-                    data = json.loads(response_text)
-                    print(f"✅ JSON解析成功")
-                except json.JSONDecodeError as e:
-                    print(f"❌ JSON解析失败: {e}")
-                    raise RuntimeError(f"响应JSON解析失败: {response_text}")
-                
-                if data.get("code") and data["code"] != "200":
-                    print(f"❌ API返回错误代码: {data.get('code')}")
-                    print(f"❌ 错误消息: {data.get('message', 'Unknown error')}")
-                    raise RuntimeError(f"API错误: {data.get('message', 'Unknown error')}")
-                
-                task_id = data["output"]["task_id"]
-                print(f"✅ 成功获取任务ID: {task_id}")
-                return task_id
+        return await self.submit_task(request_body)
     
     async def _poll_task_status(self, task_id: str) -> Dict[str, Any]:
         """轮询任务状态"""
-        max_polls = 300  # 最多轮询10分钟（文生视频较复杂）
-        poll_interval = 2
+        data = await self.poll_task(task_id)
         
-        headers = {
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        
-        url = f"{self.base_url}/tasks/{task_id}"
-        print(f"🔄 轮询URL: {url}")
-        
-        async with aiohttp.ClientSession() as session:
-            for i in range(max_polls):
-                print(f"⏳ 轮询进度: {i+1}/{max_polls}...")
-                
-                async with session.get(url, headers=headers) as response:
-                    if response.status != 200:
-                        print(f"⚠️ 状态查询失败，继续重试...")
-                        await asyncio.sleep(poll_interval)
-                        continue
-                    
-                    response_text = await response.text()
-                    data = json.loads(response_text)
-                    
-                    print(f"📊 轮询响应: {json.dumps(data, indent=2, ensure_ascii=False)}")
-                    
-                    status = data["output"]["task_status"]
-                    print(f"📈 任务状态: {status}")
-                    
-                    if status == "SUCCEEDED":
-                        # 处理成功结果 - 检查是否有 video_url 字段
-                        video_url = data["output"].get("video_url")
-                        if video_url:
-                            print(f"✅ 任务成功完成，视频URL: {video_url}")
-                            
-                            return {
-                                "status": "success",
-                                "video_url": video_url,
-                                "task_metrics": data["output"].get("task_metrics", {}),
-                                "usage": data["output"].get("usage", {})
-                            }
-                        else:
-                            # 兼容旧格式：检查是否有 results 数组
-                            results = data["output"].get("results")
-                            if results and len(results) > 0:
-                                video_url = results[0]["url"]
-                                print(f"✅ 任务成功完成，视频URL: {video_url}")
-                                
-                                return {
-                                    "status": "success",
-                                    "video_url": video_url,
-                                    "task_metrics": data["output"].get("task_metrics", {}),
-                                    "usage": data["output"].get("usage", {})
-                                }
-                            else:
-                                raise RuntimeError(f"任务成功但未找到视频URL，响应: {json.dumps(data, ensure_ascii=False)}")
-                    
-                    elif status == "FAILED":
-                        error_msg = data["output"].get("message", "Unknown error")
-                        raise RuntimeError(f"生成任务失败: {error_msg}")
-                    
-                    elif status in ["RUNNING", "PENDING"]:
-                        progress = min(100, (i + 1) * 100 // 120)  # 估算进度
-                        print(f"  🔄 生成进度: {progress}% (状态: {status})")
-                    
-                    else:
-                        print(f"  ❓ 未知状态: {status}")
-                
-                await asyncio.sleep(poll_interval)
+        video_url = self.extract_video_url(data)
+        if not video_url:
+            raise RuntimeError(f"任务成功但未找到视频URL，响应: {json.dumps(data, ensure_ascii=False)}")
         
-        raise TimeoutError(f"视频生成超时 (任务ID: {task_id})")
+        print(f"✅ 任务成功完成，视频URL: {video_url}")
+        return {
+            "status": "success",
+            "video_url": video_url,
+            "task_metrics": data["output"].get("task_metrics", {}),
+            "usage": data.get("usage", {})
+        }
     
     async def _download_video(self, video_url: str, output_path: Path):
         """下载生成的视频"""
-        print(f"📥 开始下载视频...")
         print(f"🔗 视频URL: {video_url}")
-        print(f"💾 保存路径: {output_path}")
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(video_url) as response:
-                print(f"📥 下载响应状态: {response.status}")
-                
-                if response.status != 200:
-                    print(f"❌ 视频下载失败，HTTP状态: {response.status}")
-                    raise RuntimeError(f"视频下载失败 ({response.status})")
-                
-                # 获取文件大小
-                content_length = response.headers.get('content-length')
-                if content_length:
-                    total_size = int(content_length)
-                    print(f"📊 视频文件大小: {total_size / 1024 / 1024:.2f} MB")
-                
-                print(f"📥 开始读取视频内容...")
-                content = await response.read()
-                print(f"📥 视频内容读取完成，实际大小: {len(content)} 字节")
-                
-                print(f"💾 开始保存到文件...")
-                async with aiofiles.open(output_path, 'wb') as f:
-                    await f.write(content)
-                
-                file_size = len(content) / 1024 / 1024
-                print(f"✅ 视频已成功保存: {output_path.name} ({file_size:.2f} MB)")
+        await self.download(video_url, output_path)
 
 async def test():
     """测试函数"""
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+异步任务耗时预估与轮询节奏
+按模型学习历史任务的完成耗时（指数滑动平均），据此安排状态查询：
+离预计完成时间较远时稀疏查询，接近预计完成时间时密集查询，
+超过预计时间后逐步放宽间隔，并加入随机抖动避免多个任务同时查询
+"""
+
+import random
+import threading
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+
+class TaskDurationEstimator:
+    """按模型聚合的任务耗时估计与轮询统计"""
+
+    # 滑动平均系数（越大越偏向最近的任务）
+    ALPHA = 0.3
+    # 未知模型的默认预期耗时（秒）
+    DEFAULT_EXPECTED = 60.0
+    # 首次密集查询点 = 均值 - DEVIATION_FACTOR × 平均偏差
+    DEVIATION_FACTOR = 1.0
+    # 距离预计完成时间的剩余比例，每次查询等待剩余时间的一半
+    APPROACH_RATIO = 0.5
+    # 随机抖动比例
+    JITTER = 0.1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, Any]] = {}
+
+    def _bucket(self, model: str, default: Optional[float] = None) -> Dict[str, Any]:
+        if model not in self._stats:
+            expected = float(default or self.DEFAULT_EXPECTED)
+            self._stats[model] = {
+                "mean": expected,
+                "deviation": expected * 0.25,
+                "samples": 0,
+                "tasks": 0,
+                "status_calls": 0,
+                "timeouts": 0
+            }
+        return self._stats[model]
+
+    def expected(self, model: str, default: Optional[float] = None) -> Dict[str, float]:
+        """返回模型的预期耗时 {"mean", "deviation"}（秒）"""
+        with self._lock:
+            bucket = self._bucket(model, default)
+            return {"mean": bucket["mean"], "deviation": bucket["deviation"]}
+
+    def record(self, model: str, duration: float, status_calls: int = 0,
+               default: Optional[float] = None) -> None:
+        """记录一次完成的任务耗时及其查询次数"""
+        with self._lock:
+            bucket = self._bucket(model, default)
+            bucket["tasks"] += 1
+            bucket["status_calls"] += status_calls
+            if duration <= 0:
+                return
+            if bucket["samples"] == 0:
+                # 第一个真实样本直接替换种子值
+                bucket["mean"] = duration
+                bucket["deviation"] = duration * 0.25
+            else:
+                error = duration - bucket["mean"]
+                bucket["mean"] += self.ALPHA * error
+                bucket["deviation"] += self.ALPHA * (abs(error) - bucket["deviation"])
+            bucket["samples"] += 1
+
+    def record_timeout(self, model: str, status_calls: int = 0, default: Optional[float] = None) -> None:
+        """记录一次等待超时的任务"""
+        with self._lock:
+            bucket = self._bucket(model, default)
+            bucket["tasks"] += 1
+            bucket["timeouts"] += 1
+            bucket["status_calls"] += status_calls
+
+    def next_delay(self, model: str, elapsed: float, min_interval: float, max_interval: float,
+                   default: Optional[float] = None) -> float:
+        """
+        计算下一次状态查询前的等待时间
+
+        Args:
+            model: 模型名称
+            elapsed: 任务提交至今的时间（秒）
+            min_interval: 最小查询间隔
+            max_interval: 最大查询间隔
+            default: 模型尚无样本时使用的预期耗时
+        """
+        estimate = self.expected(model, default)
+        target = max(0.0, estimate["mean"] - self.DEVIATION_FACTOR * estimate["deviation"])
+
+        if elapsed < target:
+            # 预计完成前：每次等待剩余时间的一半，越接近越密集
+            delay = (target - elapsed) * self.APPROACH_RATIO
+        else:
+            # 已进入预计完成区间：从最小间隔开始，超出越久间隔越大
+            overdue = elapsed - target
+            delay = min_interval + overdue * 0.1
+
+        delay = min(max(delay, min_interval), max_interval)
+        return delay * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """导出各模型的预估耗时和平均查询次数"""
+        with self._lock:
+            result = {}
+            for model, bucket in self._stats.items():
+                result[model] = {
+                    "expected_duration": round(bucket["mean"], 2),
+                    "deviation": round(bucket["deviation"], 2),
+                    "samples": bucket["samples"],
+                    "tasks": bucket["tasks"],
+                    "timeouts": bucket["timeouts"],
+                    "status_calls": bucket["status_calls"],
+                    "avg_status_calls": round(bucket["status_calls"] / bucket["tasks"], 2) if bucket["tasks"] else 0.0
+                }
+            return result
+
+
+def server_duration(output: Dict[str, Any]) -> Optional[float]:
+    """根据DashScope返回的submit_time/end_time计算服务端耗时（秒），缺失时返回None"""
+    submit_time = output.get("submit_time")
+    end_time = output.get("end_time")
+    if not submit_time or not end_time:
+        return None
+    times = []
+    for value in (submit_time, end_time):
+        for fmt in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+            try:
+                times.append(datetime.strptime(value, fmt))
+                break
+            except ValueError:
+                continue
+    if len(times) != 2:
+        return None
+    duration = (times[1] - times[0]).total_seconds()
+    return duration if duration > 0 else None
+
+
+# 进程级耗时估计器
+task_eta = TaskDurationEstimator()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+已提交任务日志
+提交DashScope异步任务后立即把任务ID、模型、请求指纹和目标项目写入SQLite，
+任务完成（结果已下载）或失败后更新状态；服务重启时据此找出仍在服务端运行或已完成但未下载的任务
+"""
+
+import sqlite3
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+from config.settings import TASK_JOURNAL
+
+# 当前生成请求的上下文（task_type/model/fingerprint/project_id），
+# 由GenerationService在调用API前设置；submit_task在该上下文中提交的任务会写入日志，
+# 任务ID追加到上下文的task_ids中
+journal_context: ContextVar[Optional[Dict[str, Any]]] = ContextVar("journal_context", default=None)
+
+
+class TaskJournal:
+    """SQLite持久化的任务日志"""
+
+    # 未结束的任务状态
+    PENDING_STATUSES = ("submitted",)
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        Args:
+            path: SQLite文件路径，不传则使用配置中的TASK_JOURNAL["path"]
+        """
+        self.path = Path(path or TASK_JOURNAL["path"])
+        # 本进程的标识：本进程提交的任务仍由提交它的请求负责，不参与恢复
+        self.owner = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        # 首次读写时才创建目录并打开数据库，导入模块不产生文件
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        """数据库连接（调用方持有锁）"""
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    task_id TEXT PRIMARY KEY,
+                    task_type TEXT,
+                    model TEXT,
+                    provider_model TEXT,
+                    base_url TEXT,
+                    key_id TEXT,
+                    fingerprint TEXT,
+                    project_id TEXT,
+                    owner TEXT,
+                    status TEXT NOT NULL,
+                    submitted_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    result_path TEXT,
+                    error TEXT
+                )
+            """)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(tasks)")}
+            if "key_id" not in columns:
+                # 旧版本日志没有记录提交任务的Key
+                conn.execute("ALTER TABLE tasks ADD COLUMN key_id TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status)")
+            self._conn = conn
+        return self._conn
+
+    def record_submit(self, task_id: str, **fields) -> None:
+        """
+        记录刚提交的任务
+
+        Args:
+            task_id: DashScope任务ID
+            fields: task_type、model、provider_model、base_url、key_id（提交任务的Key标识）、fingerprint、project_id
+        """
+        now = time.time()
+        with self._lock:
+            self._db().execute(
+                "INSERT OR REPLACE INTO tasks (task_id, task_type, model, provider_model, base_url, key_id, "
+                "fingerprint, project_id, owner, status, submitted_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'submitted', ?, ?)",
+                (task_id, fields.get("task_type"), fields.get("model"), fields.get("provider_model"),
+                 fields.get("base_url"), fields.get("key_id"), fields.get("fingerprint"), fields.get("project_id"),
+                 self.owner, now, now)
+            )
+
+    def mark(self, task_id: str, status: str,
+             result_path: Optional[str] = None, error: Optional[str] = None) -> None:
+        """
+        更新任务状态
+
+        Args:
+            task_id: DashScope任务ID
+            status: done（结果已下载）/ failed / cancelled / expired（超过有效期未能恢复）
+            result_path: 下载的结果文件
+            error: 失败原因
+        """
+        with self._lock:
+            self._db().execute(
+                "UPDATE tasks SET status = ?, updated_at = ?, result_path = COALESCE(?, result_path), error = ? "
+                "WHERE task_id = ?",
+                (status, time.time(), result_path, error, task_id)
+            )
+
+    def pending(self, orphaned_only: bool = False) -> List[Dict[str, Any]]:
+        """
+        未结束的任务（按提交时间排序）
+
+        Args:
+            orphaned_only: 只返回之前的进程提交、需要恢复的任务
+        """
+        placeholders = ", ".join("?" for _ in self.PENDING_STATUSES)
+        query = f"SELECT * FROM tasks WHERE status IN ({placeholders})"
+        args = list(self.PENDING_STATUSES)
+        if orphaned_only:
+            query += " AND (owner IS NULL OR owner != ?)"
+            args.append(self.owner)
+        with self._lock:
+            rows = self._db().execute(query + " ORDER BY submitted_at", args).fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db().execute("SELECT * FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return dict(row) if row else None
+
+    def prune(self, max_age: Optional[float] = None) -> int:
+        """删除超过保留时长的已结束任务，返回删除条数"""
+        cutoff = time.time() - (max_age or TASK_JOURNAL["max_age"])
+        placeholders = ", ".join("?" for _ in self.PENDING_STATUSES)
+        with self._lock:
+            cursor = self._db().execute(
+                f"DELETE FROM tasks WHERE status NOT IN ({placeholders}) AND updated_at < ?",
+                (*self.PENDING_STATUSES, cutoff)
+            )
+        return cursor.rowcount
+
+    def stats(self) -> Dict[str, Any]:
+        """各状态的任务数"""
+        with self._lock:
+            rows = self._db().execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+        return {"path": str(self.path), "tasks": {status: count for status, count in rows}}
+
+
+# 进程级任务日志
+task_journal = TaskJournal()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+DashScope任务状态的集中轮询
+所有在途任务放进按下次查询时间排序的小顶堆，由每个事件循环上的单个调度协程统一发起
+GET /tasks/<id>，共享同一个连接池会话并受全局速率上限约束；任务结束时完成对应的Future。
+状态查询量取决于速率预算，而不是在途任务数
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from typing import Dict, Any, Optional
+import aiohttp
+
+from api.task_eta import task_eta, server_duration
+from api.provider_errors import DashScopeTaskFailedError
+
+
+class DashScopeTaskPoller:
+    """多任务复用的状态轮询器"""
+
+    # 全局每秒状态查询上限（所有事件循环共享）
+    RATE_LIMIT = float(os.getenv("DASHSCOPE_POLL_RATE", "10"))
+    # 同时进行中的状态查询数
+    MAX_IN_FLIGHT = 16
+    # 单次状态查询超时（秒）
+    STATUS_TIMEOUT = 30
+
+    def __init__(self, session_pool, rate_limit: Optional[float] = None, max_in_flight: Optional[int] = None):
+        """
+        Args:
+            session_pool: 提供get_session()的连接池（DashScopeSessionPool）
+            rate_limit: 每秒状态查询上限
+            max_in_flight: 同时进行中的状态查询数
+        """
+        self.session_pool = session_pool
+        self.rate_limit = rate_limit or self.RATE_LIMIT
+        self.max_in_flight = max_in_flight or self.MAX_IN_FLIGHT
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        # 每个事件循环一份调度状态
+        self._states: Dict[asyncio.AbstractEventLoop, Dict[str, Any]] = {}
+        # 令牌桶（跨事件循环共享）
+        self._tokens = self.rate_limit
+        self._refilled_at = time.monotonic()
+        self._stats = {
+            "tasks": 0,
+            "status_calls": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "timeouts": 0,
+            "cancelled": 0,
+            "max_lag": 0.0
+        }
+
+    def _state(self) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            for old_loop in [l for l in self._states if l.is_closed()]:
+                del self._states[old_loop]
+            if loop not in self._states:
+                self._states[loop] = {
+                    "heap": [],
+                    "wakeup": asyncio.Event(),
+                    "slots": asyncio.Semaphore(self.max_in_flight),
+                    "checks": set(),
+                    "runner": None
+                }
+            return self._states[loop]
+
+    def _take_token(self) -> float:
+        """取一个查询令牌，成功返回0，否则返回需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled_at) * self.rate_limit)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate_limit
+
+    def _count(self, field: str, value: float = 1) -> None:
+        with self._lock:
+            if field == "max_lag":
+                self._stats[field] = max(self._stats[field], value)
+            else:
+                self._stats[field] += value
+
+    async def wait(self,
+                   client,
+                   task_id: str,
+                   submitted_at: float,
+                   max_wait: float,
+                   poll_interval: Optional[float] = None,
+                   api_key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        登记一个任务并等待其结束，返回成功任务的完整响应
+
+        Args:
+            client: 提交该任务的DashScopeTaskClient（提供base_url、api_key、模型与轮询参数）
+            task_id: 任务ID
+            submitted_at: 提交时刻（事件循环时间）
+            max_wait: 自提交起的最长等待时间（秒）
+            poll_interval: 固定查询间隔，不传则按模型预估耗时自适应
+            api_key: 提交该任务的Key（任务只能用提交它的Key查询），不传则使用client.api_key
+        """
+        loop = asyncio.get_running_loop()
+        entry = {
+            "task_id": task_id,
+            "url": f"{client.base_url}/tasks/{task_id}",
+            "headers": {"Authorization": f"Bearer {api_key or client.api_key}"},
+            "model": client.model,
+            "expected": client.EXPECTED_DURATION,
+            "min_interval": client.MIN_POLL_INTERVAL,
+            "max_interval": client.MAX_POLL_INTERVAL,
+            "poll_interval": poll_interval,
+            "submitted_at": submitted_at,
+            "deadline": submitted_at + max_wait,
+            "future": loop.create_future(),
+            "status_calls": 0,
+            "last_status": None,
+            "last_delay": 0.0
+        }
+        self._count("tasks")
+        self._schedule(entry)
+        return await entry["future"]
+
+    def _next_delay(self, entry: Dict[str, Any], now: float) -> float:
+        if entry["poll_interval"]:
+            return entry["poll_interval"]
+        return task_eta.next_delay(
+            entry["model"], now - entry["submitted_at"],
+            entry["min_interval"], entry["max_interval"], entry["expected"]
+        )
+
+    def _schedule(self, entry: Dict[str, Any]) -> None:
+        """按预估耗时安排下一次查询（不越过截止时间），必要时启动调度协程"""
+        state = self._state()
+        now = asyncio.get_running_loop().time()
+        delay = max(0.0, min(self._next_delay(entry, now), entry["deadline"] - now))
+        entry["last_delay"] = delay
+        entry["due"] = now + delay
+        heapq.heappush(state["heap"], (entry["due"], next(self._seq), entry))
+        state["wakeup"].set()
+        if state["runner"] is None or state["runner"].done():
+            state["runner"] = asyncio.ensure_future(self._run(state))
+
+    async def _run(self, state: Dict[str, Any]) -> None:
+        """调度协程：按到期顺序发起状态查询"""
+        loop = asyncio.get_running_loop()
+        heap = state["heap"]
+        while heap:
+            due, _, entry = heap[0]
+            if entry["future"].done():
+                # 等待方已取消
+                heapq.heappop(heap)
+                continue
+
+            now = loop.time()
+            if due > now:
+                state["wakeup"].clear()
+                try:
+                    await asyncio.wait_for(state["wakeup"].wait(), timeout=due - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            wait = self._take_token()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            await state["slots"].acquire()
+            heapq.heappop(heap)
+            self._count("max_lag", loop.time() - due)
+            check = asyncio.ensure_future(self._check(state, entry))
+            state["checks"].add(check)
+            check.add_done_callback(state["checks"].discard)
+
+    async def _check(self, state: Dict[str, Any], entry: Dict[str, Any]) -> None:
+        """查询一个任务的状态，结束则完成Future，否则重新排期"""
+        loop = asyncio.get_running_loop()
+        data = None
+        try:
+            entry["status_calls"] += 1
+            self._count("status_calls")
+            session = self.session_pool.get_session()
+            async with session.get(entry["url"], headers=entry["headers"],
+                                   timeout=aiohttp.ClientTimeout(total=self.STATUS_TIMEOUT)) as response:
+                response_text = await response.text()
+                if response.status == 200:
+                    data = json.loads(response_text)
+                else:
+                    print(f"⚠️ 状态查询失败，HTTP状态: {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"⚠️ 状态查询出错: {e}")
+        except json.JSONDecodeError:
+            pass
+        finally:
+            state["slots"].release()
+
+        future = entry["future"]
+        if future.done():
+            return
+
+        if data is not None:
+            output = data.get("output", {})
+            status = output.get("task_status", "UNKNOWN")
+            # 只在状态变化时打印
+            if status != entry["last_status"]:
+                print(f"📈 任务 {entry['task_id']} 状态: {status}")
+                entry["last_status"] = status
+
+            if status == "SUCCEEDED":
+                # 优先使用服务端耗时；否则以本次检测时刻减去半个查询间隔近似
+                duration = server_duration(output) or (loop.time() - entry["submitted_at"] - entry["last_delay"] / 2)
+                task_eta.record(entry["model"], duration, entry["status_calls"], entry["expected"])
+                self._count("succeeded")
+                future.set_result(data)
+                return
+            if status == "FAILED":
+                task_eta.record(entry["model"], 0, entry["status_calls"], entry["expected"])
+                self._count("failed")
+                future.set_exception(DashScopeTaskFailedError(
+                    f"生成任务失败: {output.get('message', 'Unknown error')}", code=output.get("code")
+                ))
+                return
+            if status == "CANCELED":
+                self._count("cancelled")
+                future.set_exception(RuntimeError(f"任务已取消 (任务ID: {entry['task_id']})"))
+                return
+            if status == "UNKNOWN":
+                self._count("failed")
+                future.set_exception(RuntimeError("任务不存在或已过期"))
+                return
+
+        if loop.time() >= entry["deadline"]:
+            task_eta.record_timeout(entry["model"], entry["status_calls"], entry["expected"])
+            self._count("timeouts")
+            future.set_exception(TimeoutError(f"生成超时 (任务ID: {entry['task_id']})"))
+            return
+
+        self._schedule(entry)
+
+    def stats(self) -> Dict[str, Any]:
+        """轮询统计：待查询任务数、状态查询总数、最大调度延迟等"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["scheduled_tasks"] = sum(
+                1 for state in self._states.values()
+                for _, _, entry in list(state["heap"]) if not entry["future"].done()
+            )
+        stats["rate_limit"] = self.rate_limit
+        stats["max_lag"] = round(stats["max_lag"], 3)
+        stats["status_calls_per_task"] = round(stats["status_calls"] / stats["tasks"], 2) if stats["tasks"] else 0.0
+        return stats
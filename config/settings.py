@@ -20,18 +20,80 @@ TEMP_DIR.mkdir(exist_ok=True)
 # API配置
 API_CONFIG = {
     "qwen": {
-        "base_url": "https://dashscope.aliyuncs.com/api/v1/services/aigc",
+        "base_url": os.getenv("DASHSCOPE_BASE_URL", "https://dashscope.aliyuncs.com/api/v1"),
         "api_key": os.getenv("DASHSCOPE_API_KEY"),
         "timeout": 300  # 5分钟超时
     }
 }
 
+# 本地T2V服务节点（LOCAL_T2V_BASE_URLS以逗号分隔多个GPU节点，未设置时使用单节点LOCAL_T2V_BASE_URL）
+LOCAL_T2V_BACKENDS = [
+    url.strip().rstrip("/")
+    for url in (os.getenv("LOCAL_T2V_BASE_URLS") or os.getenv("LOCAL_T2V_BASE_URL", "http://192.168.3.4:8888")).split(",")
+    if url.strip()
+]
+
+# DashScope API Key（DASHSCOPE_API_KEYS以逗号分隔多个Key，未设置时使用单个DASHSCOPE_API_KEY）
+DASHSCOPE_API_KEYS = [
+    key.strip()
+    for key in (os.getenv("DASHSCOPE_API_KEYS") or os.getenv("DASHSCOPE_API_KEY") or "").split(",")
+    if key.strip()
+]
+
+# 单个API Key下每个模型同时进行的任务数（服务商按Key分配并发配额）
+DASHSCOPE_KEY_CONCURRENCY = int(os.getenv("DASHSCOPE_KEY_CONCURRENCY", "2"))
+
+# 每个图像/视频模型同时进行的生成任务数（DashScope模型为单Key配额乘以Key数）
+MODEL_CONCURRENCY = {
+    **{
+        model: DASHSCOPE_KEY_CONCURRENCY * max(1, len(DASHSCOPE_API_KEYS))
+        for model in ("default", "wanx-v1", "wanx-i2v-flash", "wanx-t2v-plus", "wanx-kf2v-plus", "qwen-image-edit")
+    },
+    "local-t2v": len(LOCAL_T2V_BACKENDS)  # 每个本地GPU节点一次只跑一个任务
+}
+
+# 各任务类型的模型降级顺序：请求的模型熔断或失败时依次改用后面的模型（只使用已注册的模型）
+FALLBACK_CHAINS = {
+    "text-to-video": ["wanx-t2v-plus", "local-t2v"]
+}
+
+# 模型熔断：最近window次调用（至少min_calls次）中失败率或慢调用率超过阈值时熔断open_seconds秒，
+# 之后放行一次试探调用，成功则恢复
+CIRCUIT_BREAKER = {
+    "window": 20,
+    "min_calls": 5,
+    "failure_rate": 0.5,
+    "slow_call_rate": 0.8,
+    "open_seconds": 60,
+    # 单次调用超过该耗时（秒）视为慢调用
+    "slow_call_seconds": {
+        "default": 600,
+        "wanx-v1": 120,
+        "qwen-image-edit": 120
+    }
+}
+
+# 生成结果缓存（相同模型与参数的请求直接复用已生成的文件）
+GENERATION_CACHE = {
+    "dir": BASE_DIR / "cache" / "generation",
+    "max_bytes": int(os.getenv("GENERATION_CACHE_MB", "2048")) * 1024 * 1024,
+    # 未指定seed的请求结果不确定，默认不复用（请求中可用reuse_unseeded单独开启）
+    "reuse_unseeded": os.getenv("GENERATION_CACHE_REUSE_UNSEEDED", "false").lower() == "true"
+}
+
+# 已提交的DashScope任务日志（服务重启后继续轮询、下载未完成的任务）
+TASK_JOURNAL = {
+    "path": Path(os.getenv("TASK_JOURNAL_PATH", BASE_DIR / "cache" / "task_journal.db")),
+    # 超过该时长（秒）的任务不再恢复：DashScope任务结果和下载链接的有效期为24小时
+    "max_age": 24 * 3600
+}
+
 # LLM配置
 LLM_CONFIG = {
     "default_provider": os.getenv("LLM_PROVIDER", "dashscope"),  # claude, dashscope, openai
     "claude": {
         "api_key": os.getenv("CLAUDE_API_KEY"),
-        "model": "claude-3-sonnet-20240229",
+        "model": "claude-3-5-sonnet-20241022",
         "max_tokens": 4000,
         "temperature": 0.7
     },
@@ -4,7 +4,7 @@ LLM基类定义
 """
 
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 import json
 
 
@@ -16,6 +16,9 @@ class BaseLLM(ABC):
         self.model = model
         self.default_temperature = 0.7
         self.default_max_tokens = 2000
+        # 限流/服务端错误的重试次数与退避基数（秒）
+        self.max_retries = 2
+        self.retry_backoff = 1.0
     
     @abstractmethod
     async def generate(self, 
@@ -23,8 +26,14 @@ class BaseLLM(ABC):
                        system_prompt: Optional[str] = None,
                        temperature: Optional[float] = None,
                        max_tokens: Optional[int] = None,
-                       response_format: Optional[str] = None) -> str:
-        """生成文本响应"""
+                       response_format: Optional[str] = None,
+                       cache_prefix: Optional[str] = None) -> str:
+        """
+        生成文本响应
+        
+        cache_prefix为用户消息中稳定不变的前缀（会拼接在prompt之前），
+        支持提示词缓存的提供商会将其标记为可缓存
+        """
         pass
     
     @abstractmethod
@@ -33,17 +42,31 @@ class BaseLLM(ABC):
                            system_prompt: Optional[str] = None,
                            schema: Optional[Dict[str, Any]] = None,
                            temperature: Optional[float] = None,
-                           max_tokens: Optional[int] = None) -> Dict[str, Any]:
+                           max_tokens: Optional[int] = None,
+                           cache_prefix: Optional[str] = None) -> Dict[str, Any]:
         """生成JSON格式响应"""
         pass
     
     def format_agent_prompt(self, agent_name: str, agent_description: str, 
                            input_data: Dict[str, Any], output_format: str) -> str:
         """格式化Agent prompt"""
-        prompt = f"""你是{agent_name}，{agent_description}
-
-**输入数据**:
-{json.dumps(input_data, indent=2, ensure_ascii=False)}
+        prefix, body = self.format_agent_prompt_parts(
+            agent_name=agent_name,
+            agent_description=agent_description,
+            input_data=input_data,
+            output_format=output_format
+        )
+        return prefix + body
+    
+    def format_agent_prompt_parts(self, agent_name: str, agent_description: str,
+                                  input_data: Dict[str, Any], output_format: str) -> Tuple[str, str]:
+        """
+        格式化Agent prompt，拆分为稳定前缀和可变部分
+        
+        稳定前缀（角色、任务要求、输出格式）在同一Agent的多次调用间保持不变，
+        放在最前面以便提供商缓存；输入数据放在最后
+        """
+        prefix = f"""你是{agent_name}，{agent_description}
 
 **任务要求**:
 请根据输入数据完成你的任务。
@@ -51,9 +74,13 @@ class BaseLLM(ABC):
 **输出格式**:
 {output_format}
 
+"""
+        body = f"""**输入数据**:
+{json.dumps(input_data, indent=2, ensure_ascii=False)}
+
 请严格按照输出格式要求生成结果。
 """
-        return prompt
+        return prefix, body
     
     def parse_json_response(self, response: str) -> Dict[str, Any]:
         """解析JSON响应"""
@@ -88,6 +115,39 @@ class BaseLLM(ABC):
         # 如果都失败了，返回原始文本包装
         return {"raw_response": response}
     
+    def build_call_record(self,
+                          provider: str,
+                          timer: Any,
+                          usage: Optional[Dict[str, int]],
+                          prompt_text: str,
+                          response_text: str,
+                          retries: int,
+                          error: Optional[str] = None) -> Dict[str, Any]:
+        """
+        构建单次调用的遥测记录
+        
+        提供商未返回token用量时使用estimate_tokens估算
+        """
+        usage = dict(usage or {})
+        estimated = not usage.get("input_tokens") and not usage.get("output_tokens")
+        if estimated:
+            usage["input_tokens"] = self.estimate_tokens(prompt_text)
+            usage["output_tokens"] = self.estimate_tokens(response_text or "")
+        
+        return {
+            "provider": provider,
+            "model": self.model,
+            "ttfb": round(timer.ttfb, 4),
+            "latency": round(timer.elapsed, 4),
+            "input_tokens": usage.get("input_tokens", 0),
+            "output_tokens": usage.get("output_tokens", 0),
+            "cache_creation_input_tokens": usage.get("cache_creation_input_tokens", 0),
+            "cache_read_input_tokens": usage.get("cache_read_input_tokens", 0),
+            "tokens_estimated": estimated,
+            "retries": retries,
+            "error": error
+        }
+    
     def estimate_tokens(self, text: str) -> int:
         """估算token数量"""
         # 简单估算：中文约1.5字符/token，英文约4字符/token
@@ -5,14 +5,18 @@ Claude API接口实现
 
 import os
 import json
+import time
 import asyncio
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 from .base_llm import BaseLLM
+from .telemetry import CallTimer, record_call, mark_parse_result
 
 try:
     import anthropic
     from anthropic import AsyncAnthropic
     ANTHROPIC_AVAILABLE = True
+    # 可重试的错误：限流、连接/超时、服务端错误
+    RETRYABLE_ERRORS = (anthropic.RateLimitError, anthropic.APIConnectionError, anthropic.InternalServerError)
 except ImportError:
     ANTHROPIC_AVAILABLE = False
 
@@ -26,47 +30,66 @@ class ClaudeLLM(BaseLLM):
             
         # 使用提供的API key或从环境变量读取
         api_key = api_key or os.getenv("CLAUDE_API_KEY")
-        model = model or "claude-3-sonnet-20240229"
+        model = model or "claude-3-5-sonnet-20241022"  # 支持提示词缓存的模型
         
         super().__init__(api_key, model)
         
         if not self.api_key:
             raise ValueError("Claude API key not provided. Set CLAUDE_API_KEY environment variable or pass api_key parameter.")
         
-        self.client = AsyncAnthropic(api_key=self.api_key)
-        self.sync_client = anthropic.Anthropic(api_key=self.api_key)
+        # 可通过CLAUDE_BASE_URL指向本地桩服务
+        base_url = os.getenv("CLAUDE_BASE_URL") or None
+        # 重试由本类处理，以便统计重试次数
+        self.client = AsyncAnthropic(api_key=self.api_key, base_url=base_url, max_retries=0)
+        self.sync_client = anthropic.Anthropic(api_key=self.api_key, base_url=base_url, max_retries=0)
     
     async def generate(self, 
                       prompt: str, 
                       system_prompt: Optional[str] = None,
                       temperature: Optional[float] = None,
                       max_tokens: Optional[int] = None,
-                      response_format: Optional[str] = None) -> str:
+                      response_format: Optional[str] = None,
+                      cache_prefix: Optional[str] = None) -> str:
         """生成文本响应"""
         
         temperature = temperature or self.default_temperature
         max_tokens = max_tokens or self.default_max_tokens
         
-        messages = [{"role": "user", "content": prompt}]
+        system, messages = self._build_messages(prompt, system_prompt, response_format, cache_prefix)
         
-        if response_format == "json":
-            if system_prompt:
-                system_prompt += "\n\n请以有效的JSON格式响应。"
-            else:
-                system_prompt = "请以有效的JSON格式响应。"
+        prompt_text = (system_prompt or "") + (cache_prefix or "") + prompt
+        timer = CallTimer()
+        retries = 0
         
         try:
-            response = await self.client.messages.create(
-                model=self.model,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                system=system_prompt,
-                messages=messages
-            )
+            while True:
+                text_parts, usage = [], {}
+                try:
+                    # 流式请求：收到第一个事件即为首字节时间
+                    stream = await self.client.messages.create(
+                        model=self.model,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        system=system,
+                        messages=messages,
+                        stream=True
+                    )
+                    async for event in stream:
+                        timer.mark_first_byte()
+                        self._consume_event(event, text_parts, usage)
+                    break
+                except RETRYABLE_ERRORS:
+                    if retries >= self.max_retries:
+                        raise
+                    retries += 1
+                    await asyncio.sleep(self.retry_backoff * (2 ** (retries - 1)))
             
-            return response.content[0].text
+            text = "".join(text_parts)
+            record_call(self.build_call_record("claude", timer, usage, prompt_text, text, retries))
+            return text
             
         except Exception as e:
+            record_call(self.build_call_record("claude", timer, None, prompt_text, "", retries, error=str(e)))
             print(f"Claude API error: {str(e)}")
             raise
     
@@ -75,7 +98,8 @@ class ClaudeLLM(BaseLLM):
                           system_prompt: Optional[str] = None,
                           schema: Optional[Dict[str, Any]] = None,
                           temperature: Optional[float] = None,
-                          max_tokens: Optional[int] = None) -> Dict[str, Any]:
+                          max_tokens: Optional[int] = None,
+                          cache_prefix: Optional[str] = None) -> Dict[str, Any]:
         """生成JSON格式响应"""
         
         # 添加JSON格式要求到prompt
@@ -88,42 +112,61 @@ class ClaudeLLM(BaseLLM):
             system_prompt=system_prompt,
             temperature=temperature,
             max_tokens=max_tokens,
-            response_format="json"
+            response_format="json",
+            cache_prefix=cache_prefix
         )
         
-        return self.parse_json_response(response)
+        result = self.parse_json_response(response)
+        mark_parse_result(result)
+        return result
     
     def generate_sync(self, 
                      prompt: str, 
                      system_prompt: Optional[str] = None,
                      temperature: Optional[float] = None,
                      max_tokens: Optional[int] = None,
-                     response_format: Optional[str] = None) -> str:
+                     response_format: Optional[str] = None,
+                     cache_prefix: Optional[str] = None) -> str:
         """同步生成文本响应"""
         
         temperature = temperature or self.default_temperature
         max_tokens = max_tokens or self.default_max_tokens
         
-        messages = [{"role": "user", "content": prompt}]
+        system, messages = self._build_messages(prompt, system_prompt, response_format, cache_prefix)
         
-        if response_format == "json":
-            if system_prompt:
-                system_prompt += "\n\n请以有效的JSON格式响应。"
-            else:
-                system_prompt = "请以有效的JSON格式响应。"
+        prompt_text = (system_prompt or "") + (cache_prefix or "") + prompt
+        timer = CallTimer()
+        retries = 0
         
         try:
-            response = self.sync_client.messages.create(
-                model=self.model,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                system=system_prompt,
-                messages=messages
-            )
+            while True:
+                text_parts, usage = [], {}
+                try:
+                    # 流式请求：收到第一个事件即为首字节时间
+                    stream = self.sync_client.messages.create(
+                        model=self.model,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        system=system,
+                        messages=messages,
+                        stream=True
+                    )
+                    for event in stream:
+                        timer.mark_first_byte()
+                        self._consume_event(event, text_parts, usage)
+                    break
+                except RETRYABLE_ERRORS:
+                    if retries >= self.max_retries:
+                        raise
+                    retries += 1
+                    time.sleep(self.retry_backoff * (2 ** (retries - 1)))
             
-            return response.content[0].text
+            text = "".join(text_parts)
+            record_call(self.build_call_record("claude", timer, usage, prompt_text, text, retries))
+            return text
             
         except Exception as e:
+            record_call(self.build_call_record("claude", timer, None, prompt_text, "", retries, error=str(e)))
             print(f"Claude API error: {str(e)}")
             raise
     
@@ -132,7 +175,8 @@ class ClaudeLLM(BaseLLM):
                          system_prompt: Optional[str] = None,
                          schema: Optional[Dict[str, Any]] = None,
                          temperature: Optional[float] = None,
-                         max_tokens: Optional[int] = None) -> Dict[str, Any]:
+                         max_tokens: Optional[int] = None,
+                         cache_prefix: Optional[str] = None) -> Dict[str, Any]:
         """同步生成JSON格式响应"""
         
         # 添加JSON格式要求到prompt
@@ -145,10 +189,61 @@ class ClaudeLLM(BaseLLM):
             system_prompt=system_prompt,
             temperature=temperature,
             max_tokens=max_tokens,
-            response_format="json"
+            response_format="json",
+            cache_prefix=cache_prefix
         )
         
-        return self.parse_json_response(response)
+        result = self.parse_json_response(response)
+        mark_parse_result(result)
+        return result
+    
+    def _build_messages(self,
+                        prompt: str,
+                        system_prompt: Optional[str],
+                        response_format: Optional[str],
+                        cache_prefix: Optional[str]) -> Tuple[Any, List[Dict[str, Any]]]:
+        """
+        构建请求的system和messages
+        
+        系统提示词与cache_prefix是稳定内容，标记cache_control以启用提示词缓存；
+        可变的prompt作为最后一个内容块，不参与缓存
+        """
+        if response_format == "json":
+            if system_prompt:
+                system_prompt += "\n\n请以有效的JSON格式响应。"
+            else:
+                system_prompt = "请以有效的JSON格式响应。"
+        
+        if system_prompt:
+            system = [{
+                "type": "text",
+                "text": system_prompt,
+                "cache_control": {"type": "ephemeral"}
+            }]
+        else:
+            system = anthropic.NOT_GIVEN
+        
+        if cache_prefix:
+            content = [
+                {"type": "text", "text": cache_prefix, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": prompt}
+            ]
+        else:
+            content = prompt
+        
+        return system, [{"role": "user", "content": content}]
+    
+    def _consume_event(self, event: Any, text_parts: List[str], usage: Dict[str, int]) -> None:
+        """处理一个流式事件，累积文本和token用量（包括缓存写入/读取）"""
+        if event.type == "message_start":
+            message_usage = event.message.usage
+            for field in ["input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"]:
+                usage[field] = getattr(message_usage, field, 0) or 0
+        elif event.type == "content_block_delta":
+            if getattr(event.delta, "type", None) == "text_delta":
+                text_parts.append(event.delta.text)
+        elif event.type == "message_delta":
+            usage["output_tokens"] = getattr(event.usage, "output_tokens", 0) or 0
     
     async def generate_agent_response(self, 
                                      agent_name: str,
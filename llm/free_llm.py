@@ -5,16 +5,30 @@
 
 import os
 import json
+import time
 import asyncio
 from typing import Dict, List, Optional, Any
 import aiohttp
 import requests
 from .base_llm import BaseLLM
+from .telemetry import CallTimer, record_call, mark_parse_result
+
+
+# 可重试的HTTP状态码（限流与服务端错误）
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
 
 
 class DashscopeLLM(BaseLLM):
     """Dashscope通义千问API接口"""
     
+    @staticmethod
+    def _parse_body(text: str) -> Any:
+        """解析响应JSON；网关返回的HTML或空响应体原样返回文本（按状态码决定是否重试）"""
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            return text[:500]
+    
     def __init__(self, api_key: Optional[str] = None, model: Optional[str] = None):
         # 使用提供的API key或从环境变量读取
         api_key = api_key or os.getenv("DASHSCOPE_API_KEY")
@@ -25,14 +39,16 @@ class DashscopeLLM(BaseLLM):
         if not self.api_key:
             raise ValueError("Dashscope API key not provided. Set DASHSCOPE_API_KEY environment variable or pass api_key parameter.")
         
-        self.base_url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+        base_url = os.getenv("DASHSCOPE_BASE_URL", "https://dashscope.aliyuncs.com/api/v1")
+        self.base_url = f"{base_url}/services/aigc/text-generation/generation"
     
     async def generate(self, 
                       prompt: str, 
                       system_prompt: Optional[str] = None,
                       temperature: Optional[float] = None,
                       max_tokens: Optional[int] = None,
-                      response_format: Optional[str] = None) -> str:
+                      response_format: Optional[str] = None,
+                      cache_prefix: Optional[str] = None) -> str:
         """生成文本响应"""
         
         temperature = temperature or self.default_temperature
@@ -41,7 +57,8 @@ class DashscopeLLM(BaseLLM):
         messages = []
         if system_prompt:
             messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": prompt})
+        # 稳定前缀放在用户消息开头，便于服务端前缀缓存命中
+        messages.append({"role": "user", "content": (cache_prefix or "") + prompt})
         
         if response_format == "json":
             if messages[0]["role"] == "system":
@@ -66,17 +83,39 @@ class DashscopeLLM(BaseLLM):
             "Content-Type": "application/json"
         }
         
+        prompt_text = "".join(m["content"] for m in messages)
+        timer = CallTimer()
+        retries = 0
+        
         try:
             async with aiohttp.ClientSession() as session:
-                async with session.post(self.base_url, json=payload, headers=headers) as response:
-                    result = await response.json()
+                while True:
+                    try:
+                        async with session.post(self.base_url, json=payload, headers=headers) as response:
+                            status = response.status
+                            if status == 200:
+                                timer.mark_first_byte()
+                            result = self._parse_body(await response.text())
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        status, result = None, str(e) or type(e).__name__
+                    
+                    if status == 200 and isinstance(result, dict):
+                        content = result["output"]["choices"][0]["message"]["content"]
+                        record_call(self.build_call_record(
+                            "dashscope", timer, self._parse_usage(result), prompt_text, content, retries
+                        ))
+                        return content
                     
-                    if response.status == 200:
-                        return result["output"]["choices"][0]["message"]["content"]
-                    else:
-                        raise Exception(f"Dashscope API error: {result}")
+                    # 限流、服务端错误和网络错误按指数退避重试
+                    if (status is None or status in RETRYABLE_STATUS) and retries < self.max_retries:
+                        retries += 1
+                        await asyncio.sleep(self.retry_backoff * (2 ** (retries - 1)))
+                        continue
+                    
+                    raise Exception(f"Dashscope API error: {result}")
                         
         except Exception as e:
+            record_call(self.build_call_record("dashscope", timer, None, prompt_text, "", retries, error=str(e)))
             print(f"Dashscope API error: {str(e)}")
             raise
     
@@ -85,7 +124,8 @@ class DashscopeLLM(BaseLLM):
                           system_prompt: Optional[str] = None,
                           schema: Optional[Dict[str, Any]] = None,
                           temperature: Optional[float] = None,
-                          max_tokens: Optional[int] = None) -> Dict[str, Any]:
+                          max_tokens: Optional[int] = None,
+                          cache_prefix: Optional[str] = None) -> Dict[str, Any]:
         """生成JSON格式响应"""
         
         # 添加JSON格式要求到prompt
@@ -98,17 +138,21 @@ class DashscopeLLM(BaseLLM):
             system_prompt=system_prompt,
             temperature=temperature,
             max_tokens=max_tokens,
-            response_format="json"
+            response_format="json",
+            cache_prefix=cache_prefix
         )
         
-        return self.parse_json_response(response)
+        result = self.parse_json_response(response)
+        mark_parse_result(result)
+        return result
     
     def generate_sync(self, 
                      prompt: str, 
                      system_prompt: Optional[str] = None,
                      temperature: Optional[float] = None,
                      max_tokens: Optional[int] = None,
-                     response_format: Optional[str] = None) -> str:
+                     response_format: Optional[str] = None,
+                     cache_prefix: Optional[str] = None) -> str:
         """同步生成文本响应"""
         
         temperature = temperature or self.default_temperature
@@ -117,7 +161,8 @@ class DashscopeLLM(BaseLLM):
         messages = []
         if system_prompt:
             messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": prompt})
+        # 稳定前缀放在用户消息开头，便于服务端前缀缓存命中
+        messages.append({"role": "user", "content": (cache_prefix or "") + prompt})
         
         if response_format == "json":
             if messages[0]["role"] == "system":
@@ -142,16 +187,38 @@ class DashscopeLLM(BaseLLM):
             "Content-Type": "application/json"
         }
         
+        prompt_text = "".join(m["content"] for m in messages)
+        timer = CallTimer()
+        retries = 0
+        
         try:
-            response = requests.post(self.base_url, json=payload, headers=headers)
-            result = response.json()
-            
-            if response.status_code == 200:
-                return result["output"]["choices"][0]["message"]["content"]
-            else:
+            while True:
+                try:
+                    # stream=True时收到响应头即返回，便于测量首字节时间
+                    response = requests.post(self.base_url, json=payload, headers=headers, stream=True)
+                    status = response.status_code
+                    if status == 200:
+                        timer.mark_first_byte()
+                    result = self._parse_body(response.text)
+                except requests.RequestException as e:
+                    status, result = None, str(e)
+                
+                if status == 200 and isinstance(result, dict):
+                    content = result["output"]["choices"][0]["message"]["content"]
+                    record_call(self.build_call_record(
+                        "dashscope", timer, self._parse_usage(result), prompt_text, content, retries
+                    ))
+                    return content
+                
+                if (status is None or status in RETRYABLE_STATUS) and retries < self.max_retries:
+                    retries += 1
+                    time.sleep(self.retry_backoff * (2 ** (retries - 1)))
+                    continue
+                
                 raise Exception(f"Dashscope API error: {result}")
                 
         except Exception as e:
+            record_call(self.build_call_record("dashscope", timer, None, prompt_text, "", retries, error=str(e)))
             print(f"Dashscope API error: {str(e)}")
             raise
     
@@ -160,7 +227,8 @@ class DashscopeLLM(BaseLLM):
                          system_prompt: Optional[str] = None,
                          schema: Optional[Dict[str, Any]] = None,
                          temperature: Optional[float] = None,
-                         max_tokens: Optional[int] = None) -> Dict[str, Any]:
+                         max_tokens: Optional[int] = None,
+                         cache_prefix: Optional[str] = None) -> Dict[str, Any]:
         """同步生成JSON格式响应"""
         
         # 添加JSON格式要求到prompt
@@ -173,10 +241,26 @@ class DashscopeLLM(BaseLLM):
             system_prompt=system_prompt,
             temperature=temperature,
             max_tokens=max_tokens,
-            response_format="json"
+            response_format="json",
+            cache_prefix=cache_prefix
         )
         
-        return self.parse_json_response(response)
+        result = self.parse_json_response(response)
+        mark_parse_result(result)
+        return result
+    
+    def _parse_usage(self, result: Dict[str, Any]) -> Dict[str, int]:
+        """解析响应中的token用量（cached_tokens计为缓存读取）"""
+        usage = result.get("usage") or {}
+        input_tokens = usage.get("input_tokens", 0) or 0
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0
+        
+        return {
+            "input_tokens": max(0, input_tokens - cached_tokens),
+            "output_tokens": usage.get("output_tokens", 0) or 0,
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": cached_tokens
+        }
     
     async def generate_agent_response(self, 
                                      agent_name: str,
@@ -228,14 +312,16 @@ class FreeLLM(BaseLLM):
                       system_prompt: Optional[str] = None,
                       temperature: Optional[float] = None,
                       max_tokens: Optional[int] = None,
-                      response_format: Optional[str] = None) -> str:
+                      response_format: Optional[str] = None,
+                      cache_prefix: Optional[str] = None) -> str:
         """生成文本响应"""
         return await self.llm_instance.generate(
             prompt=prompt,
             system_prompt=system_prompt,
             temperature=temperature,
             max_tokens=max_tokens,
-            response_format=response_format
+            response_format=response_format,
+            cache_prefix=cache_prefix
         )
     
     async def generate_json(self,
@@ -243,12 +329,14 @@ class FreeLLM(BaseLLM):
                           system_prompt: Optional[str] = None,
                           schema: Optional[Dict[str, Any]] = None,
                           temperature: Optional[float] = None,
-                          max_tokens: Optional[int] = None) -> Dict[str, Any]:
+                          max_tokens: Optional[int] = None,
+                          cache_prefix: Optional[str] = None) -> Dict[str, Any]:
         """生成JSON格式响应"""
         return await self.llm_instance.generate_json(
             prompt=prompt,
             system_prompt=system_prompt,
             schema=schema,
             temperature=temperature,
-            max_tokens=max_tokens
+            max_tokens=max_tokens,
+            cache_prefix=cache_prefix
         )
\ No newline at end of file
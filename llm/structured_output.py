@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+结构化输出校验
+从Agent的输出格式示例中推导schema，检查LLM返回的JSON缺失或无效的字段，
+并生成只针对这些字段的补全prompt
+"""
+
+import re
+import json
+from functools import lru_cache
+from typing import Dict, List, Any, Iterable
+
+
+# 路径中的一段：字段名或列表下标
+_PATH_TOKEN = re.compile(r"([^.\[\]]+)|\[(\d+)\]")
+
+
+@lru_cache(maxsize=64)
+def _parse_format(output_format: str) -> Any:
+    matches = re.findall(r"```json\s*(.*?)\s*```", output_format, re.DOTALL)
+    text = matches[0] if matches else output_format
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return None
+
+
+def schema_from_format(output_format: str) -> Any:
+    """
+    从输出格式示例推导schema
+
+    示例本身即作为schema：对象要求包含全部字段，数组按第一个元素校验每一项，
+    其余值要求为非空标量。示例不是合法JSON时返回None（不做校验）
+    """
+    return _parse_format(output_format or "")
+
+
+def validate_output(data: Any,
+                    schema: Any,
+                    optional_fields: Iterable[str] = (),
+                    path: str = "") -> List[str]:
+    """
+    校验数据，返回缺失或无效字段的路径列表（如 "story_analysis.genre"、"storyboard[2].visual_content"）
+
+    同一对象中超过一半字段有问题时只返回该对象自身的路径，让补全请求整体重新生成它
+
+    Args:
+        data: LLM返回的数据
+        schema: schema_from_format得到的schema
+        optional_fields: 可以缺失的字段名（如由后处理计算的字段）
+        path: 当前路径
+    """
+    optional = set(optional_fields)
+
+    if isinstance(schema, dict):
+        if not isinstance(data, dict):
+            return [path]
+        problems = []
+        invalid_keys = 0
+        for key, sub_schema in schema.items():
+            if key in optional:
+                continue
+            sub_path = f"{path}.{key}" if path else key
+            if key not in data:
+                problems.append(sub_path)
+                invalid_keys += 1
+                continue
+            sub_problems = validate_output(data[key], sub_schema, optional, sub_path)
+            if sub_problems:
+                problems.extend(sub_problems)
+                invalid_keys += 1
+        required = len([key for key in schema if key not in optional])
+        if path and required and invalid_keys * 2 > required:
+            return [path]
+        return problems
+
+    if isinstance(schema, list):
+        if not isinstance(data, list):
+            return [path]
+        if not schema:
+            return []
+        problems = []
+        for i, item in enumerate(data):
+            problems.extend(validate_output(item, schema[0], optional, f"{path}[{i}]"))
+        return problems
+
+    # 标量：不能是空值或容器
+    if data is None or isinstance(data, (dict, list)) or (isinstance(data, str) and not data.strip()):
+        return [path]
+    return []
+
+
+def _split_path(path: str) -> List[Any]:
+    tokens = []
+    for name, index in _PATH_TOKEN.findall(path):
+        tokens.append(int(index) if index else name)
+    return tokens
+
+
+def _lookup(data: Any, tokens: List[Any]) -> Any:
+    node = data
+    for token in tokens:
+        if isinstance(token, int):
+            node = node[token] if isinstance(node, list) and token < len(node) else None
+        else:
+            node = node.get(token) if isinstance(node, dict) else None
+        if node is None:
+            return None
+    return node
+
+
+def schema_at(schema: Any, path: str) -> Any:
+    """取出路径对应的schema片段"""
+    node = schema
+    for token in _split_path(path):
+        if isinstance(token, int):
+            node = node[0] if isinstance(node, list) and node else None
+        else:
+            node = node.get(token) if isinstance(node, dict) else None
+        if node is None:
+            return None
+    return node
+
+
+def apply_patch(data: Dict[str, Any], patch: Dict[str, Any], paths: List[str]) -> List[str]:
+    """
+    将补全结果按路径写回数据，返回成功写入的路径
+
+    Args:
+        data: 原始数据（原地修改）
+        patch: 补全结果，键为字段路径
+        paths: 本次请求补全的路径（只接受这些路径）
+    """
+    applied = []
+    for path in paths:
+        tokens = _split_path(path)
+        if not tokens:
+            continue
+        # 兼容模型按嵌套结构而不是字段路径返回
+        value = patch[path] if path in patch else _lookup(patch, tokens)
+        if value is None:
+            continue
+        node = data
+        for token, next_token in zip(tokens, tokens[1:]):
+            if isinstance(token, int):
+                if not isinstance(node, list) or token >= len(node):
+                    node = None
+                    break
+                if not isinstance(node[token], (dict, list)):
+                    node[token] = [] if isinstance(next_token, int) else {}
+                node = node[token]
+            else:
+                if not isinstance(node, dict):
+                    node = None
+                    break
+                if not isinstance(node.get(token), (dict, list)):
+                    node[token] = [] if isinstance(next_token, int) else {}
+                node = node[token]
+        last = tokens[-1]
+        if isinstance(last, int):
+            if isinstance(node, list) and last < len(node):
+                node[last] = value
+                applied.append(path)
+        elif isinstance(node, dict):
+            node[last] = value
+            applied.append(path)
+    return applied
+
+
+def build_repair_prompt(data: Dict[str, Any], schema: Any, paths: List[str]) -> str:
+    """构建只补全指定字段的prompt"""
+    fields = {path: schema_at(schema, path) for path in paths}
+    return f"""## 字段补全
+上面输入数据对应的输出中，以下字段缺失或格式不正确。其余字段已经完成，不要重新生成。
+
+### 已生成的结果
+```json
+{json.dumps(data, indent=2, ensure_ascii=False)}
+```
+
+### 需要补全的字段及格式
+```json
+{json.dumps(fields, indent=2, ensure_ascii=False)}
+```
+
+请输出一个JSON对象，键为上面的字段路径，值为该字段的完整内容，与已生成的结果保持一致。只输出JSON。"""
+
+
+def build_reformat_prompt(raw_response: str) -> str:
+    """构建将非JSON回答转换为JSON的prompt"""
+    return f"""## 格式修复
+下面是针对上述输入数据的一次回答，但它不是合法的JSON。
+请将其内容按输出格式整理为严格的JSON，不要增删内容，只输出JSON。
+
+### 原回答
+{raw_response}"""
+
+
+def is_raw_response(result: Any) -> bool:
+    """判断是否为JSON解析失败的原始文本包装"""
+    return isinstance(result, dict) and "raw_response" in result and len(result) == 1
+
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+LLM调用遥测
+记录每次LLM调用的首字节时间、总延迟、token用量、重试次数和JSON解析回退，
+并按 Agent/模型 在内存中聚合
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Any, Iterator, Tuple
+
+from .usage import record_usage
+
+
+# 当前所属的Agent名称
+_current_agent: ContextVar[Optional[str]] = ContextVar("llm_agent", default=None)
+
+# 当前协程最近一次LLM调用的记录（用于回填JSON解析结果）
+_last_call: ContextVar[Optional[Dict[str, Any]]] = ContextVar("llm_last_call", default=None)
+
+
+@contextmanager
+def agent_scope(agent_name: str) -> Iterator[None]:
+    """标记范围内的LLM调用属于指定Agent"""
+    token = _current_agent.set(agent_name)
+    try:
+        yield
+    finally:
+        _current_agent.reset(token)
+
+
+class LLMTelemetry:
+    """按 Agent/模型 聚合的LLM调用统计"""
+
+    def __init__(self, window: int = 500):
+        """
+        Args:
+            window: 每个聚合键保留的最近延迟样本数（用于计算分位数）
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        self._stats: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+    def _bucket(self, agent: str, model: str) -> Dict[str, Any]:
+        key = (agent, model)
+        if key not in self._stats:
+            self._stats[key] = {
+                "calls": 0,
+                "errors": 0,
+                "retries": 0,
+                "parse_fallbacks": 0,
+                "repairs": 0,
+                "repaired_fields": 0,
+                "repair_failures": 0,
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "cache_creation_input_tokens": 0,
+                "cache_read_input_tokens": 0,
+                "total_latency": 0.0,
+                "total_ttfb": 0.0,
+                "latencies": deque(maxlen=self.window)
+            }
+        return self._stats[key]
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        """记录一次调用"""
+        with self._lock:
+            bucket = self._bucket(entry.get("agent") or "-", entry.get("model") or "-")
+            bucket["calls"] += 1
+            bucket["retries"] += int(entry.get("retries") or 0)
+            if entry.get("error"):
+                bucket["errors"] += 1
+            for field in ["input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens"]:
+                bucket[field] += int(entry.get(field) or 0)
+            bucket["total_latency"] += float(entry.get("latency") or 0.0)
+            bucket["total_ttfb"] += float(entry.get("ttfb") or 0.0)
+            bucket["latencies"].append(float(entry.get("latency") or 0.0))
+
+    def record_parse_fallback(self, agent: Optional[str], model: Optional[str]) -> None:
+        """记录一次JSON解析回退到raw_response"""
+        with self._lock:
+            self._bucket(agent or "-", model or "-")["parse_fallbacks"] += 1
+
+    def record_repair(self, agent: Optional[str], model: Optional[str], fields: int, success: bool) -> None:
+        """记录一次结构化输出补全调用"""
+        with self._lock:
+            bucket = self._bucket(agent or "-", model or "-")
+            bucket["repairs"] += 1
+            bucket["repaired_fields"] += fields
+            if not success:
+                bucket["repair_failures"] += 1
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """导出聚合统计"""
+        rows = []
+        with self._lock:
+            for (agent, model), bucket in self._stats.items():
+                calls = bucket["calls"] or 1
+                latencies = sorted(bucket["latencies"])
+                rows.append({
+                    "agent": agent,
+                    "model": model,
+                    "calls": bucket["calls"],
+                    "errors": bucket["errors"],
+                    "retries": bucket["retries"],
+                    "parse_fallbacks": bucket["parse_fallbacks"],
+                    "repairs": bucket["repairs"],
+                    "repaired_fields": bucket["repaired_fields"],
+                    "repair_failures": bucket["repair_failures"],
+                    "input_tokens": bucket["input_tokens"],
+                    "output_tokens": bucket["output_tokens"],
+                    "cache_creation_input_tokens": bucket["cache_creation_input_tokens"],
+                    "cache_read_input_tokens": bucket["cache_read_input_tokens"],
+                    "avg_latency": round(bucket["total_latency"] / calls, 3),
+                    "avg_ttfb": round(bucket["total_ttfb"] / calls, 3),
+                    "p50_latency": round(_percentile(latencies, 0.5), 3),
+                    "p95_latency": round(_percentile(latencies, 0.95), 3)
+                })
+        return rows
+
+    def reset(self) -> None:
+        """清空统计"""
+        with self._lock:
+            self._stats.clear()
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+# 进程级统计实例
+llm_telemetry = LLMTelemetry()
+
+
+class CallTimer:
+    """单次LLM调用计时器"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.first_byte_at: Optional[float] = None
+
+    def mark_first_byte(self) -> None:
+        """标记收到首字节（只记录第一次）"""
+        if self.first_byte_at is None:
+            self.first_byte_at = time.perf_counter()
+
+    @property
+    def ttfb(self) -> float:
+        end = self.first_byte_at if self.first_byte_at is not None else time.perf_counter()
+        return end - self.started_at
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+
+def record_call(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    记录一次LLM调用
+
+    写入进程级聚合统计和当前Agent执行范围的用量列表，
+    并作为当前协程的"最近一次调用"以便回填解析结果
+    """
+    entry.setdefault("agent", _current_agent.get())
+    entry.setdefault("parse_fallback", False)
+    llm_telemetry.record(entry)
+    record_usage(entry)
+    _last_call.set(entry)
+    return entry
+
+
+def mark_parse_result(result: Dict[str, Any]) -> None:
+    """回填最近一次调用的JSON解析结果"""
+    entry = _last_call.get()
+    if entry is None:
+        return
+    if isinstance(result, dict) and "raw_response" in result and len(result) == 1:
+        entry["parse_fallback"] = True
+        llm_telemetry.record_parse_fallback(entry.get("agent"), entry.get("model"))
+
+
+def mark_repair(kind: str, fields: List[str], repaired: List[str]) -> None:
+    """
+    标记最近一次调用为结构化输出补全调用
+
+    Args:
+        kind: 补全类型（reformat：非JSON回答转JSON；fields：补全缺失字段）
+        fields: 请求补全的字段路径
+        repaired: 成功补全的字段路径
+    """
+    entry = _last_call.get()
+    if entry is None:
+        return
+    success = bool(repaired) and len(repaired) == len(fields)
+    entry["repair"] = kind
+    entry["repair_fields"] = fields
+    entry["repair_success"] = success
+    llm_telemetry.record_repair(entry.get("agent"), entry.get("model"), len(repaired), success)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+LLM用量记录
+在一次Agent执行范围内收集每次LLM调用的token用量（含缓存命中）
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Any, Iterator
+
+
+# 当前执行范围内的用量记录列表；子任务继承同一个列表对象
+_current_usage: ContextVar[Optional[List[Dict[str, Any]]]] = ContextVar("llm_usage", default=None)
+
+# 汇总时累加的数值字段
+USAGE_FIELDS = [
+    "input_tokens",
+    "output_tokens",
+    "cache_creation_input_tokens",
+    "cache_read_input_tokens"
+]
+
+
+@contextmanager
+def track_usage() -> Iterator[List[Dict[str, Any]]]:
+    """开启一个用量记录范围，返回该范围内的记录列表"""
+    records: List[Dict[str, Any]] = []
+    token = _current_usage.set(records)
+    try:
+        yield records
+    finally:
+        _current_usage.reset(token)
+
+
+def record_usage(entry: Dict[str, Any]) -> None:
+    """记录一次LLM调用的用量（不在记录范围内时忽略）"""
+    records = _current_usage.get()
+    if records is not None:
+        records.append(entry)
+
+
+def summarize_usage(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """汇总用量记录"""
+    summary = {"calls": len(records)}
+    for field in USAGE_FIELDS:
+        summary[field] = sum(int(r.get(field) or 0) for r in records)
+
+    # 缓存命中率 = 缓存读取token / 全部输入token
+    total_input = (summary["input_tokens"]
+                   + summary["cache_creation_input_tokens"]
+                   + summary["cache_read_input_tokens"])
+    summary["cache_hit_ratio"] = round(summary["cache_read_input_tokens"] / total_input, 4) if total_input else 0.0
+
+    # 调用耗时与可靠性
+    summary["total_latency"] = round(sum(float(r.get("latency") or 0.0) for r in records), 3)
+    summary["max_ttfb"] = round(max((float(r.get("ttfb") or 0.0) for r in records), default=0.0), 3)
+    summary["retries"] = sum(int(r.get("retries") or 0) for r in records)
+    summary["errors"] = sum(1 for r in records if r.get("error"))
+    summary["parse_fallbacks"] = sum(1 for r in records if r.get("parse_fallback"))
+    summary["repairs"] = sum(1 for r in records if r.get("repair"))
+    summary["repair_failures"] = sum(1 for r in records if r.get("repair") and not r.get("repair_success"))
+
+    return summary
@@ -18,7 +18,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # 导入并启动应用
-from web.app import app
+from web.app import app, start_task_recovery
 from config.settings import WEB_CONFIG
 
 if __name__ == '__main__':
@@ -26,6 +26,9 @@ if __name__ == '__main__':
     print(f"Server running at http://{WEB_CONFIG['host']}:{WEB_CONFIG['port']}")
     print(f"Press Ctrl+C to stop")
     
+    # 继续轮询、下载上次运行时未完成的任务
+    start_task_recovery(debug=WEB_CONFIG['debug'])
+    
     app.run(
         host=WEB_CONFIG['host'],
         port=WEB_CONFIG['port'],
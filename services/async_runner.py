@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+常驻事件循环
+在后台线程中运行一个进程级事件循环，供同步的Flask视图提交协程，
+避免每个请求都新建并关闭事件循环
+"""
+
+import asyncio
+import threading
+import concurrent.futures
+from typing import Any, Awaitable, Optional
+
+
+class AsyncRunner:
+    """后台线程中的常驻事件循环"""
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """获取事件循环（首次访问时启动后台线程）"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._run_loop,
+                    name="async-runner",
+                    daemon=True
+                )
+                self._thread.start()
+        return self._loop
+
+    def _run_loop(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def submit(self, coro: Awaitable[Any]) -> concurrent.futures.Future:
+        """提交协程，立即返回concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+        """提交协程并阻塞等待结果"""
+        return self.submit(coro).result(timeout)
+
+
+# 进程级实例
+async_runner = AsyncRunner()
+
+
+def run_async(coro: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+    """在常驻事件循环中运行协程并返回结果"""
+    return async_runner.run(coro, timeout)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+模型熔断器
+按模型记录最近的调用结果和耗时，失败率或慢调用率超过阈值时熔断该模型一段时间，
+期间生成服务改用降级链中的其他模型；熔断到期后放行一次试探调用，成功则恢复、失败则继续熔断
+"""
+
+import time
+from collections import deque
+from typing import Dict, Any, Optional
+
+from config.settings import CIRCUIT_BREAKER
+
+
+class CircuitBreakerRegistry:
+    """各模型的熔断状态（closed / open / half_open）"""
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            config: 熔断参数，不传则使用配置中的CIRCUIT_BREAKER
+        """
+        self.config = {**CIRCUIT_BREAKER, **(config or {})}
+        self._models: Dict[str, Dict[str, Any]] = {}
+
+    def _model(self, model: str) -> Dict[str, Any]:
+        if model not in self._models:
+            self._models[model] = {
+                "state": "closed",
+                "calls": deque(maxlen=self.config["window"]),
+                "opened_at": 0.0,
+                "probing": False,
+                "last_error": None,
+                "totals": {"calls": 0, "failures": 0, "slow_calls": 0, "rejected": 0, "opened": 0}
+            }
+        return self._models[model]
+
+    def _slow_threshold(self, model: str) -> float:
+        thresholds = self.config["slow_call_seconds"]
+        return thresholds.get(model, thresholds.get("default", 600))
+
+    def state(self, model: str) -> str:
+        """当前状态；熔断到期后视为half_open"""
+        breaker = self._model(model)
+        if breaker["state"] == "open" and time.monotonic() - breaker["opened_at"] >= self.config["open_seconds"]:
+            breaker["state"] = "half_open"
+        return breaker["state"]
+
+    def allow(self, model: str) -> bool:
+        """
+        是否可以调用该模型
+
+        half_open时只放行一个试探调用并立即占用试探名额，
+        试探方必须随后调用record（或未实际调用时调用cancel）释放
+        """
+        state = self.state(model)
+        breaker = self._model(model)
+        if state == "closed":
+            return True
+        if state == "half_open" and not breaker["probing"]:
+            breaker["probing"] = True
+            return True
+        breaker["totals"]["rejected"] += 1
+        return False
+
+    def cancel(self, model: str) -> None:
+        """试探调用被取消或未实际发生，释放试探名额，不计入结果"""
+        self._model(model)["probing"] = False
+
+    def record(self, model: str, success: bool, elapsed: float, error: Optional[str] = None) -> None:
+        """
+        记录一次调用结果
+
+        Args:
+            model: 模型名称
+            success: 是否生成成功（只记录服务商侧的失败）
+            elapsed: 调用耗时（秒，不含排队）
+            error: 失败原因
+        """
+        breaker = self._model(model)
+        slow = elapsed >= self._slow_threshold(model)
+        totals = breaker["totals"]
+        totals["calls"] += 1
+        totals["failures"] += int(not success)
+        totals["slow_calls"] += int(slow)
+        if not success:
+            breaker["last_error"] = error
+
+        if breaker["probing"] or breaker["state"] == "half_open":
+            breaker["probing"] = False
+            if success and not slow:
+                print(f"✅ 模型 {model} 试探调用成功，恢复使用")
+                breaker["state"] = "closed"
+                breaker["calls"].clear()
+            else:
+                self._open(model, breaker, "试探调用失败")
+            return
+
+        breaker["calls"].append((success, slow))
+        calls = breaker["calls"]
+        if breaker["state"] != "closed" or len(calls) < self.config["min_calls"]:
+            return
+        failure_rate = sum(1 for ok, _ in calls if not ok) / len(calls)
+        slow_rate = sum(1 for _, is_slow in calls if is_slow) / len(calls)
+        if failure_rate >= self.config["failure_rate"]:
+            self._open(model, breaker, f"失败率 {failure_rate:.0%}")
+        elif slow_rate >= self.config["slow_call_rate"]:
+            self._open(model, breaker, f"慢调用率 {slow_rate:.0%}")
+
+    def _open(self, model: str, breaker: Dict[str, Any], reason: str) -> None:
+        breaker["state"] = "open"
+        breaker["opened_at"] = time.monotonic()
+        breaker["totals"]["opened"] += 1
+        breaker["calls"].clear()
+        print(f"⛔ 模型 {model} 熔断 {self.config['open_seconds']} 秒: {reason}")
+
+    def retry_after(self, model: str) -> float:
+        """熔断剩余秒数"""
+        breaker = self._model(model)
+        if self.state(model) != "open":
+            return 0.0
+        return max(0.0, self.config["open_seconds"] - (time.monotonic() - breaker["opened_at"]))
+
+    def stats(self) -> Dict[str, Any]:
+        """各模型的熔断状态、窗口内失败率和累计调用统计"""
+        result = {}
+        for model in list(self._models):
+            state = self.state(model)
+            breaker = self._models[model]
+            calls = breaker["calls"]
+            result[model] = {
+                "state": state,
+                "retry_after": round(self.retry_after(model), 1),
+                "window_calls": len(calls),
+                "failure_rate": round(sum(1 for ok, _ in calls if not ok) / len(calls), 3) if calls else 0.0,
+                "slow_call_rate": round(sum(1 for _, slow in calls if slow) / len(calls), 3) if calls else 0.0,
+                "last_error": breaker["last_error"],
+                **breaker["totals"]
+            }
+        return result
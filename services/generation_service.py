@@ -0,0 +1,747 @@
+#!/usr/bin/env python3
+"""
+图像/视频生成服务
+按任务类型调用对应模型的API，限制每个模型同时进行的任务数，复用相同请求的缓存结果，
+合并进行中的重复请求（指纹相同或幂等键相同），并将输出保存到项目；
+已提交的DashScope任务记录在任务日志中，服务重启后由recover_tasks继续轮询和下载
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import asyncio
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Any, Union
+
+from api.media_download import DownloadError
+from api.task_journal import journal_context, task_journal
+from api.provider_errors import provider_failures, is_provider_failure
+from config.settings import FALLBACK_CHAINS, TASK_JOURNAL
+from services.circuit_breaker import CircuitBreakerRegistry
+from services.model_scheduler import ModelScheduler
+from services.result_cache import GenerationResultCache, CacheMissError
+from services.request_fingerprint import request_fingerprint
+
+
+class IdempotencyConflictError(ValueError):
+    """同一个幂等键被用于不同的请求"""
+    pass
+
+
+class GenerationCancelledError(RuntimeError):
+    """生成任务被取消"""
+    pass
+
+
+class ModelUnavailableError(RuntimeError):
+    """请求的模型及其降级模型全部处于熔断状态"""
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class GenerationService:
+    """图像/视频生成服务"""
+
+    # 产物为图片的任务类型，其余任务类型产物为视频
+    IMAGE_TASK_TYPES = ("text-to-image", "image-edit")
+
+    # 各任务类型的请求参数及默认值（同时用于调用API和计算缓存指纹）
+    TASK_DEFAULTS = {
+        "text-to-image": {
+            "prompt": "", "negative_prompt": "", "size": "1920*1080", "style": "auto", "seed": None
+        },
+        "image-to-video": {
+            "image_path": "", "prompt": "", "negative_prompt": "", "duration": 5, "fps": 30,
+            "resolution": "1280*720"
+        },
+        "text-to-video": {
+            "prompt": "", "negative_prompt": "", "duration": 5, "fps": 30, "resolution": "1920*1080",
+            "seed": None, "style": "realistic", "motion_strength": 0.5
+        },
+        "keyframe-video": {
+            "first_frame_path": "", "last_frame_path": "", "prompt": "", "resolution": "720P",
+            "prompt_extend": True
+        },
+        "image-edit": {
+            "image_path": "", "edit_instruction": "", "negative_prompt": "", "watermark": False
+        }
+    }
+    # 项目内相对路径需要转换为完整路径的参数
+    PATH_FIELDS = ("image_path", "first_frame_path", "last_frame_path")
+    # 文生图单个任务最多生成的图片数（DashScope的n上限）和一次请求最多的提示词数
+    MAX_IMAGES_PER_TASK = 4
+    MAX_BATCH_PROMPTS = 16
+    # 幂等键的保留时间（秒）和最多保留条数
+    IDEMPOTENCY_TTL = 24 * 3600
+    IDEMPOTENCY_CAPACITY = 1000
+
+    def __init__(self,
+                 apis: Dict[str, Dict[str, Any]],
+                 project_manager: Any = None,
+                 model_concurrency: Optional[Dict[str, int]] = None,
+                 result_cache: Any = None,
+                 fallback_chains: Optional[Dict[str, List[str]]] = None):
+        """
+        初始化生成服务
+
+        Args:
+            apis: 任务类型 -> {模型名: API实例}
+            project_manager: 项目管理器实例
+            model_concurrency: 模型名 -> 最大并发任务数（"default"为未配置模型的默认值），用于创建默认调度器
+            result_cache: GenerationResultCache实例，不传则不缓存生成结果
+            fallback_chains: 任务类型 -> 模型降级顺序，不传则使用配置中的FALLBACK_CHAINS
+        """
+        self.apis = apis
+        self.project_manager = project_manager
+        self.scheduler = ModelScheduler(model_concurrency)
+        self.result_cache = result_cache
+        self.fallback_chains = FALLBACK_CHAINS if fallback_chains is None else fallback_chains
+        self.breakers = CircuitBreakerRegistry()
+        # 请求指纹 -> 进行中的生成任务
+        self._inflight: Dict[str, Dict[str, Any]] = {}
+        # 幂等键 -> {"task", "request_hash", "created_at"}
+        self._idempotency: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._coalesce_stats = {"flights": 0, "coalesced": 0}
+        # 正在恢复的任务ID
+        self._recovering: set = set()
+        # 作业ID -> 进行中的生成请求（可取消）
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        # 后台执行的服务商取消请求
+        self._background: set = set()
+
+    def resolve_model(self, task_type: str, model_name: Optional[str] = None) -> str:
+        """校验任务类型和模型，未指定模型时使用该任务类型的第一个模型"""
+        if task_type not in self.apis:
+            raise ValueError(f"Unknown task type: {task_type}")
+        if not model_name:
+            model_name = list(self.apis[task_type].keys())[0]
+        if model_name not in self.apis[task_type]:
+            raise ValueError(f"Unknown model: {model_name} for task: {task_type}")
+        return model_name
+
+    def candidate_models(self, task_type: str, model_name: str, fallback: bool = True) -> List[str]:
+        """请求的模型及其后按降级链排列的其他已注册模型"""
+        if not fallback:
+            return [model_name]
+        chain = self.fallback_chains.get(task_type, [])
+        return [model_name] + [model for model in chain if model != model_name and model in self.apis[task_type]]
+
+    def task_params(self, task_type: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """按任务类型提取请求参数（补全默认值，输入文件转换为完整路径）"""
+        if task_type not in self.TASK_DEFAULTS:
+            raise ValueError(f"Unknown task type: {task_type}")
+        params = {key: data.get(key, default) for key, default in self.TASK_DEFAULTS[task_type].items()}
+        for key in self.PATH_FIELDS:
+            if key in params:
+                params[key] = self._resolve_path(data.get('project_id'), params[key] or '')
+        if task_type == "text-to-image":
+            n = data.get('n') or 1
+            if not isinstance(n, int) or not 1 <= n <= self.MAX_IMAGES_PER_TASK:
+                raise ValueError(f"Invalid n: {n} (expected 1-{self.MAX_IMAGES_PER_TASK})")
+            if n > 1:
+                # 只在生成多张时参与指纹，n=1的请求与之前的缓存结果保持一致
+                params['n'] = n
+        return params
+
+    def _resolve_path(self, project_id: Optional[str], path: str) -> str:
+        """将项目内的相对路径转换为完整路径"""
+        if path and project_id and self.project_manager and not os.path.isabs(path):
+            return str(Path(self.project_manager.base_path) / project_id / path)
+        return path
+
+    async def generate(self, task_type: str, data: Dict[str, Any],
+                       idempotency_key: Optional[str] = None,
+                       job_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        执行一次生成任务
+
+        Args:
+            task_type: 任务类型（text-to-image/image-to-video/text-to-video/keyframe-video/image-edit）
+            data: 请求参数，与 /api/generate/<task_type> 的请求体相同；
+                  cache取bypass/prefer/only控制结果缓存，reuse_unseeded允许复用未指定seed的结果，
+                  coalesce为False时不与进行中的相同请求合并，
+                  priority取interactive（默认）或batch，
+                  fallback为False时不改用降级链中的其他模型；
+                  文生图可传n（一次任务生成多张）和prompts（多个提示词并发生成）
+            idempotency_key: 客户端提供的幂等键，相同键的重复提交返回同一结果
+            job_id: 作业ID（用于cancel_job），不传则使用data中的job_id或自动生成
+
+        Returns:
+            {"success", "job_id", "result_path", "saved_path", "model_used", "requested_model",
+             "fallbacks", "cache", "coalesced"}；生成多张时另有"result_paths"、"saved_paths"，
+            传prompts时为{"success", "job_id", "results"（每个提示词的结果）, "result_paths", "saved_paths"}
+        """
+        job_id = job_id or data.get('job_id') or uuid.uuid4().hex
+        if job_id in self._jobs:
+            raise ValueError(f"Job {job_id} is already running")
+
+        if idempotency_key:
+            task = asyncio.ensure_future(self._generate_idempotent(task_type, data, idempotency_key))
+        else:
+            task = asyncio.ensure_future(self._generate(task_type, data))
+        job = {
+            "task": task,
+            "task_type": task_type,
+            "model": data.get('model'),
+            "project_id": data.get('project_id'),
+            "priority": data.get('priority') or 'interactive',
+            "started_at": time.time(),
+            "cancelled": False
+        }
+        self._jobs[job_id] = job
+        try:
+            response = await task
+        except asyncio.CancelledError:
+            if job["cancelled"]:
+                raise GenerationCancelledError(f"Generation job {job_id} was cancelled")
+            raise
+        finally:
+            self._jobs.pop(job_id, None)
+        return {**response, "job_id": job_id}
+
+    async def cancel_job(self, job_id: str) -> bool:
+        """
+        取消进行中的生成作业：停止排队/轮询/下载、释放模型并发名额，
+        没有其他请求合并到同一任务时向服务商发送取消请求。返回作业是否存在
+        """
+        job = self._jobs.get(job_id)
+        if not job or job["task"].done():
+            return False
+        job["cancelled"] = True
+        job["task"].cancel()
+        print(f"🛑 取消生成作业: {job_id}")
+        return True
+
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        """进行中的生成作业"""
+        now = time.time()
+        return [
+            {
+                "job_id": job_id,
+                "task_type": job["task_type"],
+                "model": job["model"],
+                "project_id": job["project_id"],
+                "priority": job["priority"],
+                "elapsed": round(now - job["started_at"], 1)
+            }
+            for job_id, job in self._jobs.items()
+        ]
+
+    async def _generate_idempotent(self, task_type: str, data: Dict[str, Any], key: str) -> Dict[str, Any]:
+        """按幂等键执行：进行中的重复提交等待同一任务，已完成的直接返回原结果"""
+        request_hash = hashlib.sha256(json.dumps(
+            {"task_type": task_type, "data": {k: v for k, v in data.items() if k not in ('idempotency_key', 'job_id')}},
+            ensure_ascii=False, sort_keys=True, default=str
+        ).encode("utf-8")).hexdigest()
+
+        now = time.time()
+        # 清理过期的幂等记录
+        while self._idempotency:
+            oldest = next(iter(self._idempotency.values()))
+            if now - oldest["created_at"] <= self.IDEMPOTENCY_TTL and len(self._idempotency) <= self.IDEMPOTENCY_CAPACITY:
+                break
+            self._idempotency.popitem(last=False)
+
+        record = self._idempotency.get(key)
+        replay = record is not None
+        if replay:
+            if record["request_hash"] != request_hash:
+                raise IdempotencyConflictError(f"Idempotency key {key} was already used with a different request")
+        else:
+            task = asyncio.ensure_future(self._generate(task_type, data))
+            record = {"task": task, "request_hash": request_hash, "created_at": now, "waiters": 0}
+            self._idempotency[key] = record
+
+            def forget_failure(finished: asyncio.Future) -> None:
+                # 失败的请求不保留幂等记录，允许客户端用同一个键重试
+                if finished.cancelled() or finished.exception() is not None:
+                    current = self._idempotency.get(key)
+                    if current and current["task"] is finished:
+                        del self._idempotency[key]
+
+            task.add_done_callback(forget_failure)
+
+        record["waiters"] += 1
+        try:
+            response = await asyncio.shield(record["task"])
+        except asyncio.CancelledError:
+            # 所有等待方都已取消时取消任务本身
+            record["waiters"] -= 1
+            if record["waiters"] == 0:
+                record["task"].cancel()
+            raise
+        return {**response, "idempotent_replay": True} if replay else response
+
+    async def _generate(self, task_type: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        if data.get('prompts') is not None:
+            return await self._generate_batch(task_type, data)
+
+        response = await self._generate_one(task_type, data)
+        result_paths = response.pop("result_paths")
+        if len(result_paths) > 1:
+            response["result_paths"] = result_paths
+        project_id = data.get('project_id')
+        if result_paths and project_id and self.project_manager:
+            saved_paths = self._save_outputs(task_type, project_id, result_paths)
+            response["saved_path"] = saved_paths[0]
+            if len(saved_paths) > 1:
+                response["saved_paths"] = saved_paths
+        return response
+
+    async def _generate_batch(self, task_type: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """多个提示词并发生成（各自一个任务），所有结果一次保存到项目"""
+        prompts = data.get('prompts')
+        if task_type != "text-to-image":
+            raise ValueError(f"prompts is only supported for text-to-image, not {task_type}")
+        if (not isinstance(prompts, list) or not prompts or len(prompts) > self.MAX_BATCH_PROMPTS
+                or not all(isinstance(prompt, str) and prompt for prompt in prompts)):
+            raise ValueError(f"prompts must be a list of 1-{self.MAX_BATCH_PROMPTS} non-empty strings")
+        # 参数错误对所有提示词相同，先校验再提交
+        self.resolve_model(task_type, data.get('model'))
+        self.task_params(task_type, data)
+
+        outcomes = await asyncio.gather(
+            *(self._generate_one(task_type, {**data, 'prompt': prompt}) for prompt in prompts),
+            return_exceptions=True
+        )
+        results = []
+        for prompt, outcome in zip(prompts, outcomes):
+            if isinstance(outcome, BaseException) and not isinstance(outcome, Exception):
+                raise outcome
+            if isinstance(outcome, Exception):
+                outcome = {"success": False, "error": str(outcome) or type(outcome).__name__, "result_paths": []}
+            results.append({"prompt": prompt, **outcome})
+
+        result_paths = [path for item in results for path in item["result_paths"]]
+        response = {
+            "success": all(item["success"] for item in results),
+            "results": results,
+            "result_paths": result_paths
+        }
+        project_id = data.get('project_id')
+        if result_paths and project_id and self.project_manager:
+            response["saved_paths"] = self._save_outputs(task_type, project_id, result_paths)
+        return response
+
+    def _save_outputs(self, task_type: str, project_id: str, result_paths: List[str]) -> List[str]:
+        """把生成的文件一次保存到项目，返回项目中的路径"""
+        # 根据任务类型保存到相应目录（image-to-video的产物是视频）
+        output_type = "references" if task_type in self.IMAGE_TASK_TYPES else "videos"
+        saved_paths = self.project_manager.save_outputs(project_id, output_type, result_paths)
+        missing = [path for path, saved in zip(result_paths, saved_paths) if not saved]
+        if missing:
+            raise RuntimeError(f"Failed to save output to project: {', '.join(missing)}")
+        return saved_paths
+
+    async def _generate_one(self, task_type: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """执行单个提示词的生成（含降级），不保存到项目；result_paths为生成的所有文件"""
+        model_name = self.resolve_model(task_type, data.get('model'))
+        project_id = data.get('project_id')
+        priority = data.get('priority') or 'interactive'
+        if priority not in self.scheduler.PRIORITIES:
+            raise ValueError(f"Invalid priority: {priority} (expected one of {', '.join(self.scheduler.PRIORITIES)})")
+        params = self.task_params(task_type, data)
+        loop = asyncio.get_running_loop()
+
+        # 模型熔断或生成失败时按降级链改用其他模型（cache=only只查请求的模型）
+        candidates = self.candidate_models(task_type, model_name,
+                                           data.get('fallback', True) and data.get('cache') != 'only')
+        fallbacks = []
+        result = None
+        for index, candidate in enumerate(candidates):
+            api = self.apis[task_type][candidate]
+
+            # 输入图片的内容哈希在线程中计算
+            fingerprint, seeded = await loop.run_in_executor(None, request_fingerprint, task_type, candidate, params)
+
+            # 先查缓存：熔断中的模型也可以返回缓存结果，命中缓存不占用试探名额
+            # 缓存按单个文件保存，一次生成多张的结果不缓存（仍按指纹合并重复请求）
+            result, cache_status = await self._lookup_cache(None if params.get('n', 1) > 1 else fingerprint,
+                                                      seeded, api, data)
+            coalesced = False
+            if result is None:
+                probe = self.breakers.state(candidate) == "half_open"
+                if not self.breakers.allow(candidate):
+                    fallbacks.append({"model": candidate, "reason": "circuit_open"})
+                    continue
+                try:
+                    result, coalesced = await self._run_coalesced(
+                        task_type, candidate, api, params, fingerprint,
+                        coalesce=data.get('coalesce', True), project_id=project_id, priority=priority,
+                        probe=probe
+                    )
+                except Exception as e:
+                    if index == len(candidates) - 1:
+                        raise
+                    fallbacks.append({"model": candidate, "reason": f"error: {e}"})
+                    print(f"🔀 模型 {candidate} 生成失败，改用降级模型: {e}")
+                    continue
+            if result:
+                break
+            fallbacks.append({"model": candidate, "reason": "failed"})
+
+        if len(fallbacks) == len(candidates) and all(f["reason"] == "circuit_open" for f in fallbacks):
+            retry_after = min(self.breakers.retry_after(model) for model in candidates)
+            raise ModelUnavailableError(
+                f"All models for {task_type} are unavailable: {', '.join(candidates)}", retry_after
+            )
+
+        result_paths = self._result_paths(result)
+        response = {
+            "success": bool(result_paths),
+            "result_path": result_paths[0] if result_paths else None,
+            "result_paths": result_paths,
+            "model_used": candidate,
+            "requested_model": model_name,
+            "fallbacks": fallbacks,
+            "cache": cache_status,
+            "coalesced": coalesced
+        }
+        if not result_paths:
+            response["error"] = "Generation failed" + (f" on all models: {', '.join(candidates)}" if len(candidates) > 1 else "")
+        return response
+
+    @staticmethod
+    def _result_paths(result: Any) -> List[str]:
+        """生成结果（单个文件路径或一次生成多张时的路径列表）转换为路径列表"""
+        if not result:
+            return []
+        return [result] if isinstance(result, str) else list(result)
+
+    async def _lookup_cache(self, fingerprint: Optional[str], seeded: bool, api: Any, data: Dict[str, Any]):
+        """
+        按请求指纹查找缓存结果，返回 (复用的文件路径或None, 缓存状态)
+
+        缓存状态：disabled（未启用缓存、输入文件缺失无法计算指纹或一次生成多张）、bypass、hit、miss、
+        unseeded（未指定seed且未允许复用）；cache=only时除hit外都抛出CacheMissError，不会发起新的生成
+        """
+        mode = data.get('cache') or 'prefer'
+        if mode not in GenerationResultCache.MODES:
+            raise ValueError(f"Invalid cache mode: {mode} (expected one of {', '.join(GenerationResultCache.MODES)})")
+
+        if not self.result_cache or fingerprint is None:
+            status = "disabled"
+        elif mode == "bypass":
+            return None, "bypass"
+        elif not seeded and not data.get('reuse_unseeded', self.result_cache.reuse_unseeded):
+            status = "unseeded"
+        else:
+            # 文件复制在线程中进行，不阻塞共享事件循环上的轮询和下载
+            loop = asyncio.get_running_loop()
+            cached_path = await loop.run_in_executor(None, self.result_cache.lookup, fingerprint)
+            if cached_path:
+                return await loop.run_in_executor(None, self.result_cache.materialize, cached_path, api.output_dir), "hit"
+            status = "miss"
+
+        if mode == "only":
+            raise CacheMissError(f"No cached result for this request ({status})")
+        return None, status
+
+    async def _run_coalesced(self, task_type: str, model_name: str, api: Any, params: Dict[str, Any],
+                             fingerprint: Optional[str], coalesce: bool = True,
+                             project_id: Optional[str] = None, priority: str = "interactive",
+                             probe: bool = False):
+        """
+        执行生成；指纹相同的请求正在进行时直接等待其结果，返回 (文件路径, 是否合并到已有任务)
+
+        合并的每个请求各拿到一份文件（最后一个领取者拿原文件，其余为副本），
+        因为保存到项目时文件会被移动。probe表示本请求占用了熔断器的试探名额
+        """
+        if not fingerprint or not coalesce:
+            return await self._produce(task_type, model_name, api, params, fingerprint, project_id, priority,
+                                       probe), False
+
+        flight = self._inflight.get(fingerprint)
+        joined = flight is not None
+        if joined and probe:
+            # 合并到已有任务不会产生新的调用，由该任务的结果决定熔断状态
+            self.breakers.cancel(model_name)
+        if not joined:
+            task = asyncio.ensure_future(self._produce(task_type, model_name, api, params, fingerprint, project_id,
+                                                       priority, probe))
+            flight = {"task": task, "waiters": 0, "claims": 0, "copies": []}
+            self._inflight[fingerprint] = flight
+            task.add_done_callback(lambda _: self._inflight.pop(fingerprint, None))
+            self._coalesce_stats["flights"] += 1
+        else:
+            self._coalesce_stats["coalesced"] += 1
+
+        flight["waiters"] += 1
+        try:
+            result = await asyncio.shield(flight["task"])
+        except asyncio.CancelledError:
+            # 合并到同一任务的请求全部取消时才取消任务本身
+            flight["waiters"] -= 1
+            if flight["waiters"] == 0:
+                flight["task"].cancel()
+            raise
+
+        return await self._claim(flight, result), joined
+
+    @staticmethod
+    async def _claim(flight: Dict[str, Any], result: Union[str, List[str], None]) -> Union[str, List[str], None]:
+        """
+        领取合并任务的结果：最后一个领取者拿原文件，其余拿副本
+
+        复制在线程中进行，不阻塞共享事件循环上的轮询和下载；原文件保存到项目时会被移动，
+        所以最后一个领取者要等其他领取者的复制完成后才返回
+        """
+        flight["claims"] += 1
+        if not result:
+            return result
+        if flight["claims"] < flight["waiters"]:
+            copy = asyncio.get_running_loop().run_in_executor(None, GenerationService._copy_result, result)
+            flight["copies"].append(copy)
+            # 领取者被取消时复制仍在进行，最后一个领取者照样会等它完成
+            return await asyncio.shield(copy)
+        await asyncio.gather(*flight["copies"], return_exceptions=True)
+        return result
+
+    @staticmethod
+    def _copy_result(result: Union[str, List[str]]) -> Union[str, List[str]]:
+        """复制生成的文件（保持单个路径或路径列表的形式）"""
+        copies = []
+        for path in GenerationService._result_paths(result):
+            copy_path = Path(path).with_name(f"{Path(path).stem}_{uuid.uuid4().hex[:8]}{Path(path).suffix}")
+            shutil.copyfile(path, copy_path)
+            copies.append(str(copy_path))
+        return copies[0] if isinstance(result, str) else copies
+
+    async def _produce(self, task_type: str, model_name: str, api: Any, params: Dict[str, Any],
+                       fingerprint: Optional[str], project_id: Optional[str] = None,
+                       priority: str = "interactive", probe: bool = False) -> Union[str, List[str], None]:
+        """
+        在模型并发配额内调用API，并把结果写入缓存（一次生成多张的结果不缓存）
+
+        熔断器只记录成功和服务商侧的失败；参数错误、输入缺失、内容审核拒绝等调用方问题不计入
+        """
+        # API在此上下文中提交的任务写入任务日志
+        context = {"task_type": task_type, "model": model_name, "fingerprint": fingerprint,
+                   "project_id": project_id, "task_ids": []}
+        token = journal_context.set(context)
+        failures: List[str] = []
+        failures_token = provider_failures.set(failures)
+        started = None
+        try:
+            # 同一模型的任务数超过配额时按优先级和项目公平排队
+            async with self.scheduler.slot(model_name, project_id, priority):
+                started = time.monotonic()
+                result = await self._run_task(task_type, api, params)
+        except asyncio.CancelledError:
+            if probe:
+                self.breakers.cancel(model_name)
+            # 名额已在退出调度上下文时释放；向服务商取消已提交的任务
+            for task_id in context["task_ids"]:
+                task_journal.mark(task_id, "cancelled")
+                if hasattr(api, "cancel_task"):
+                    cancel = asyncio.ensure_future(api.cancel_task(task_id))
+                    self._background.add(cancel)
+                    cancel.add_done_callback(self._background.discard)
+            raise
+        except Exception as e:
+            if started is not None and (is_provider_failure(e) or failures):
+                self.breakers.record(model_name, False, time.monotonic() - started, str(e) or type(e).__name__)
+            elif probe:
+                self.breakers.cancel(model_name)
+            for task_id in context["task_ids"]:
+                task_journal.mark(task_id, "failed", error=str(e) or type(e).__name__)
+            raise
+        finally:
+            provider_failures.reset(failures_token)
+            journal_context.reset(token)
+        if result or failures:
+            self.breakers.record(model_name, bool(result), time.monotonic() - started,
+                                 None if result else failures[-1])
+        elif probe:
+            self.breakers.cancel(model_name)
+        for task_id in context["task_ids"]:
+            task_journal.mark(task_id, "done" if result else "failed",
+                              result_path=", ".join(self._result_paths(result)) or None)
+        if result and isinstance(result, str) and fingerprint and self.result_cache:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.result_cache.store, fingerprint, result, {"task_type": task_type, "model": model_name}
+            )
+        return result
+
+    # ==================== 任务恢复 ====================
+
+    async def recover_tasks(self) -> Dict[str, int]:
+        """
+        恢复任务日志中未结束的任务（服务启动时调用）：继续轮询、下载结果，
+        写入结果缓存并保存到原目标项目；恢复期间相同请求会合并到恢复中的任务
+
+        Returns:
+            各结果的任务数 {"done", "failed", "expired"}
+        """
+        entries = [entry for entry in task_journal.pending(orphaned_only=True)
+                   if entry["task_id"] not in self._recovering]
+        summary = {"done": 0, "failed": 0, "expired": 0}
+        if not entries:
+            return summary
+
+        print(f"🔄 恢复 {len(entries)} 个未完成的生成任务")
+        self._recovering.update(entry["task_id"] for entry in entries)
+        try:
+            outcomes = await asyncio.gather(*(self._recover_task(entry) for entry in entries),
+                                            return_exceptions=True)
+        finally:
+            self._recovering.difference_update(entry["task_id"] for entry in entries)
+        for entry, outcome in zip(entries, outcomes):
+            if isinstance(outcome, BaseException):
+                print(f"❌ 任务 {entry['task_id']} 恢复失败: {outcome}")
+                outcome = "failed"
+            summary[outcome] += 1
+        task_journal.prune()
+        print(f"✅ 任务恢复完成: {summary}")
+        return summary
+
+    async def _recover_task(self, entry: Dict[str, Any]) -> str:
+        """恢复单个任务，返回 done / failed / expired"""
+        task_id = entry["task_id"]
+        task_type = entry["task_type"]
+        api = self.apis.get(task_type, {}).get(entry["model"])
+        if api is None or not hasattr(api, "poll_task"):
+            task_journal.mark(task_id, "failed", error=f"Unknown model: {entry['model']} for task: {task_type}")
+            return "failed"
+        if time.time() - entry["submitted_at"] > TASK_JOURNAL["max_age"]:
+            task_journal.mark(task_id, "expired", error="task result expired")
+            return "expired"
+
+        fingerprint = entry["fingerprint"]
+        if fingerprint and fingerprint not in self._inflight:
+            # 登记为进行中的生成，重启后重复提交的相同请求直接等待恢复结果
+            task = asyncio.ensure_future(self._resume_task(entry, api))
+            flight = {"task": task, "waiters": 1, "claims": 0, "copies": []}
+            self._inflight[fingerprint] = flight
+            task.add_done_callback(lambda _: self._inflight.pop(fingerprint, None))
+            result = await self._claim(flight, await asyncio.shield(task))
+        else:
+            result = await self._resume_task(entry, api)
+
+        status = (task_journal.get(task_id) or {}).get("status", "failed")
+        if result and entry["project_id"] and self.project_manager:
+            output_type = "references" if task_type in self.IMAGE_TASK_TYPES else "videos"
+            saved_paths = self.project_manager.save_outputs(entry["project_id"], output_type, self._result_paths(result))
+            print(f"📁 任务 {task_id} 的结果已保存到项目 {entry['project_id']}: {', '.join(filter(None, saved_paths))}")
+        return status
+
+    async def _resume_task(self, entry: Dict[str, Any], api: Any) -> Union[str, List[str], None]:
+        """继续轮询已提交的任务并下载结果，返回本地文件路径（多张图片时为路径列表）"""
+        task_id = entry["task_id"]
+        task_type = entry["task_type"]
+        try:
+            # 任务仍占用服务商的并发配额
+            async with self.scheduler.slot(entry["model"], entry["project_id"]):
+                data = await api.poll_task(task_id)
+
+            if task_type in self.IMAGE_TASK_TYPES:
+                urls, suffix = api.extract_image_urls(data), ".png"
+            else:
+                url = api.extract_video_url(data)
+                urls, suffix = ([url] if url else []), ".mp4"
+            if not urls:
+                raise RuntimeError(f"任务结果中没有输出文件: {data.get('output')}")
+
+            # 一次生成多张的任务并发下载所有文件
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            output_paths = [Path(api.output_dir) / f"recovered_{timestamp}_{task_id[:8]}_{idx + 1}{suffix}"
+                            for idx in range(len(urls))]
+            await asyncio.gather(*(api.download(url, path) for url, path in zip(urls, output_paths)))
+        except DownloadError as e:
+            # 下载链接已过期
+            task_journal.mark(task_id, "expired", error=str(e))
+            return None
+        except Exception as e:
+            task_journal.mark(task_id, "failed", error=str(e) or type(e).__name__)
+            return None
+
+        result_paths = [str(path) for path in output_paths]
+        result = result_paths[0] if len(result_paths) == 1 else result_paths
+        task_journal.mark(task_id, "done", result_path=", ".join(result_paths))
+        if isinstance(result, str) and entry["fingerprint"] and self.result_cache:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.result_cache.store, entry["fingerprint"], result,
+                {"task_type": task_type, "model": entry["model"]}
+            )
+        return result
+
+    def coalesce_stats(self) -> Dict[str, Any]:
+        """请求合并统计：独立执行的生成数、合并到进行中任务的请求数、当前进行中的生成数"""
+        return {
+            **self._coalesce_stats,
+            "in_flight": len(self._inflight),
+            "idempotency_keys": len(self._idempotency)
+        }
+
+    async def _run_task(self, task_type: str, api: Any, params: Dict[str, Any]) -> Union[str, List[str], None]:
+        """根据不同的任务类型调用不同的方法，返回生成文件的本地路径（文生图一次生成多张时为路径列表）"""
+        if task_type == "text-to-image":
+            # QwenAPITester的generate_images方法：一次任务生成n张，并发下载
+            n = params.get('n', 1)
+            image_paths = await api.generate_images(
+                prompt=params['prompt'],
+                negative_prompt=params['negative_prompt'],
+                size=params['size'],
+                n=n,
+                style=params['style'],
+                seed=params['seed']
+            )
+            if not image_paths:
+                return None
+            return image_paths[0] if n == 1 else image_paths
+
+        if task_type == "image-to-video":
+            # QwenI2VFlashAPI的generate_video方法
+            api_result = await api.generate_video(
+                params['image_path'],
+                params['prompt'],
+                params['negative_prompt'],
+                params['duration'],
+                params['fps'],
+                params['resolution']
+            )
+
+        elif task_type == "text-to-video":
+            # QwenT2VPlusAPI和QwenLocalT2VAPI的generate_text_to_video方法
+            api_result = await api.generate_text_to_video(
+                prompt=params['prompt'],
+                negative_prompt=params['negative_prompt'],
+                duration=params['duration'],
+                fps=params['fps'],
+                resolution=params['resolution'],
+                seed=params['seed'],
+                style=params['style'],
+                motion_strength=params['motion_strength']
+            )
+
+        elif task_type == "keyframe-video":
+            # QwenKeyframePlusAPI的generate_keyframe_video方法
+            api_result = await api.generate_keyframe_video(
+                params['first_frame_path'],
+                params['last_frame_path'],
+                params['prompt'],
+                params['resolution'],
+                params['prompt_extend']
+            )
+
+        elif task_type == "image-edit":
+            # QwenImageEditAPI的edit_image方法
+            api_result = await api.edit_image(
+                params['image_path'],
+                params['edit_instruction'],
+                params['negative_prompt'],
+                params['watermark']
+            )
+
+        else:
+            raise ValueError(f"Unknown task type: {task_type}")
+
+        # 提取local_path作为result
+        return api_result.get('local_path') if api_result and api_result.get('status') == 'success' else None
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+按模型配额调度生成任务
+每个模型同时运行的任务数不超过配置的并发上限（与服务商的并发配额一致），
+超出的任务排队：交互式请求优先于批量任务，同一优先级内优先放行当前占用最少、最久未获得名额的项目，
+批量任务等待过久时提升为交互式优先级，避免饿死。队列深度和等待时间可供查询
+"""
+
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional, List, AsyncIterator
+
+from config.settings import MODEL_CONCURRENCY
+
+
+class ModelScheduler:
+    """按模型限制并发、区分优先级并在项目间公平分配的调度器"""
+
+    # 优先级（从高到低）
+    PRIORITIES = ("interactive", "batch")
+    # 批量任务等待超过该时间（秒）后按交互式优先级调度
+    AGING_SECONDS = 120
+    # 每个模型保留的最近等待时间样本数
+    WAIT_WINDOW = 500
+
+    def __init__(self, model_concurrency: Optional[Dict[str, int]] = None):
+        """
+        Args:
+            model_concurrency: 模型名 -> 最大并发任务数（"default"为未配置模型的默认值）
+        """
+        self.model_concurrency = model_concurrency or MODEL_CONCURRENCY
+        self._models: Dict[str, Dict[str, Any]] = {}
+
+    def limit(self, model: str) -> int:
+        return max(1, self.model_concurrency.get(model, self.model_concurrency.get("default", 2)))
+
+    def _model(self, model: str) -> Dict[str, Any]:
+        if model not in self._models:
+            self._models[model] = {
+                "active": 0,
+                "active_by_project": {},
+                # 项目 -> 最近一次获得名额的时间（轮转放行）
+                "last_granted": {},
+                "waiters": [],
+                "granted": 0,
+                "waits": deque(maxlen=self.WAIT_WINDOW),
+                "max_wait": 0.0
+            }
+        return self._models[model]
+
+    @asynccontextmanager
+    async def slot(self, model: str, project_id: Optional[str] = None,
+                   priority: str = "interactive") -> AsyncIterator[float]:
+        """
+        占用模型的一个并发名额，产出排队等待的秒数
+
+        Args:
+            model: 模型名称
+            project_id: 所属项目（用于项目间公平分配）
+            priority: interactive 或 batch
+        """
+        if priority not in self.PRIORITIES:
+            raise ValueError(f"Invalid priority: {priority} (expected one of {', '.join(self.PRIORITIES)})")
+
+        waited = await self._acquire(model, project_id or "-", priority)
+        try:
+            yield waited
+        finally:
+            self._release(model, project_id or "-")
+
+    async def _acquire(self, model: str, project: str, priority: str) -> float:
+        state = self._model(model)
+        enqueued_at = time.monotonic()
+
+        if state["active"] < self.limit(model) and not state["waiters"]:
+            self._grant(state, project, 0.0)
+            return 0.0
+
+        waiter = {
+            "project": project,
+            "priority": priority,
+            "enqueued_at": enqueued_at,
+            "future": asyncio.get_running_loop().create_future()
+        }
+        state["waiters"].append(waiter)
+        try:
+            await waiter["future"]
+        except asyncio.CancelledError:
+            if waiter["future"].done() and not waiter["future"].cancelled():
+                # 名额已分配但调用方被取消，归还名额
+                self._release(model, project)
+            elif waiter in state["waiters"]:
+                state["waiters"].remove(waiter)
+            raise
+        return time.monotonic() - enqueued_at
+
+    def _grant(self, state: Dict[str, Any], project: str, waited: float) -> None:
+        state["active"] += 1
+        state["active_by_project"][project] = state["active_by_project"].get(project, 0) + 1
+        state["last_granted"][project] = time.monotonic()
+        state["granted"] += 1
+        state["waits"].append(waited)
+        state["max_wait"] = max(state["max_wait"], waited)
+
+    def _release(self, model: str, project: str) -> None:
+        state = self._model(model)
+        state["active"] -= 1
+        remaining = state["active_by_project"].get(project, 1) - 1
+        if remaining > 0:
+            state["active_by_project"][project] = remaining
+        else:
+            state["active_by_project"].pop(project, None)
+        self._dispatch(model)
+
+    def _effective_priority(self, waiter: Dict[str, Any], now: float) -> int:
+        if waiter["priority"] == "batch" and now - waiter["enqueued_at"] >= self.AGING_SECONDS:
+            return 0
+        return self.PRIORITIES.index(waiter["priority"])
+
+    def _dispatch(self, model: str) -> None:
+        """有空闲名额时按 优先级 → 项目当前占用 → 项目最近获得名额的时间 → 等待时间 放行排队任务"""
+        state = self._model(model)
+        now = time.monotonic()
+        while state["waiters"] and state["active"] < self.limit(model):
+            waiter = min(state["waiters"], key=lambda w: (
+                self._effective_priority(w, now),
+                state["active_by_project"].get(w["project"], 0),
+                state["last_granted"].get(w["project"], 0.0),
+                w["enqueued_at"]
+            ))
+            state["waiters"].remove(waiter)
+            if waiter["future"].done():
+                continue
+            self._grant(state, waiter["project"], now - waiter["enqueued_at"])
+            waiter["future"].set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        """各模型的并发占用、队列深度（按优先级和项目）和等待时间"""
+        now = time.monotonic()
+        result = {}
+        for model, state in self._models.items():
+            waits: List[float] = sorted(state["waits"])
+            queued_by_priority = {priority: 0 for priority in self.PRIORITIES}
+            queued_by_project: Dict[str, int] = {}
+            for waiter in state["waiters"]:
+                queued_by_priority[waiter["priority"]] += 1
+                queued_by_project[waiter["project"]] = queued_by_project.get(waiter["project"], 0) + 1
+            result[model] = {
+                "limit": self.limit(model),
+                "active": state["active"],
+                "active_by_project": dict(state["active_by_project"]),
+                "queued": len(state["waiters"]),
+                "queued_by_priority": queued_by_priority,
+                "queued_by_project": queued_by_project,
+                "oldest_wait": round(max((now - w["enqueued_at"] for w in state["waiters"]), default=0.0), 3),
+                "granted": state["granted"],
+                "avg_wait": round(sum(waits) / len(waits), 3) if waits else 0.0,
+                "p95_wait": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0, 3),
+                "max_wait": round(state["max_wait"], 3)
+            }
+        return result
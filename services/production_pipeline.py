@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+成片生产流水线
+将分镜脚本的每个镜头依次生成关键帧图片（文生图）和镜头视频（图生视频/首尾帧视频）。
+各镜头独立推进：镜头N的图片完成后立即开始生成它的视频，不等待其他镜头；
+每个模型的并发数由GenerationService限制。每个镜头的状态持久化到项目中，重新运行时跳过已完成的阶段
+"""
+
+import asyncio
+import hashlib
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Any
+
+from services.generation_service import GenerationCancelledError
+
+
+class ProductionPipeline:
+    """分镜 → 图片 → 视频 的生产流水线"""
+
+    # 视频阶段的生成方式：i2v（单图生视频）/ keyframe（本镜头图片为首帧、下一镜头图片为尾帧）
+    VIDEO_MODES = {
+        "i2v": "image-to-video",
+        "keyframe": "keyframe-video"
+    }
+
+    def __init__(self, generation_service: Any, project_manager: Any):
+        """
+        初始化流水线
+
+        Args:
+            generation_service: GenerationService实例
+            project_manager: 项目管理器实例
+        """
+        self.generation_service = generation_service
+        self.project_manager = project_manager
+        self._runs: Dict[str, asyncio.Task] = {}
+
+    def is_running(self, project_id: str) -> bool:
+        """项目是否有正在运行的生产任务"""
+        task = self._runs.get(project_id)
+        return task is not None and not task.done()
+
+    async def start(self,
+                    project_id: str,
+                    storyboard: Optional[Dict[str, Any]] = None,
+                    options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        在后台启动生产任务，立即返回初始状态
+
+        Args:
+            project_id: 项目ID
+            storyboard: 分镜脚本Agent的结果，为空时使用项目中最新的分镜脚本
+            options: video_mode, image_model, video_model, size, resolution, duration,
+                     style_prompt, negative_prompt
+        """
+        if self.is_running(project_id):
+            raise RuntimeError(f"Production is already running for project {project_id}")
+
+        state = self._prepare(project_id, storyboard, options or {})
+        self._runs[project_id] = asyncio.ensure_future(self._execute(project_id, state))
+        return state
+
+    async def run(self,
+                  project_id: str,
+                  storyboard: Optional[Dict[str, Any]] = None,
+                  options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """执行生产任务并等待全部镜头完成，返回最终状态（与start一样登记任务，可被cancel取消）"""
+        if self.is_running(project_id):
+            raise RuntimeError(f"Production is already running for project {project_id}")
+
+        state = self._prepare(project_id, storyboard, options or {})
+        task = asyncio.ensure_future(self._execute(project_id, state))
+        self._runs[project_id] = task
+        return await task
+
+    async def cancel(self, project_id: str) -> bool:
+        """取消项目正在运行的生产任务（进行中的生成一并取消），返回是否有任务被取消"""
+        task = self._runs.get(project_id)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return True
+
+    def get_state(self, project_id: str) -> Optional[Dict[str, Any]]:
+        """获取项目的生产状态"""
+        return self.project_manager.load_production_state(project_id)
+
+    def build_shots(self, storyboard: Dict[str, Any], options: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """从分镜脚本生成每个镜头的图片和视频prompt"""
+        style_prompt = options.get("style_prompt", "")
+        shots = []
+        for i, shot in enumerate(storyboard.get("storyboard", [])):
+            if not isinstance(shot, dict):
+                continue
+            visual = shot.get("visual_content", {}) or {}
+            camera = shot.get("shot_description", {}) or {}
+
+            image_prompt = shot.get("image_prompt") or shot.get("complete_prompt") or "，".join(
+                str(part) for part in [
+                    visual.get("main_subject"),
+                    visual.get("subject_action"),
+                    visual.get("environment"),
+                    visual.get("lighting"),
+                    visual.get("mood"),
+                    camera.get("shot_type"),
+                    camera.get("camera_angle")
+                ] if part
+            )
+            if style_prompt:
+                image_prompt = f"{image_prompt}，{style_prompt}"
+
+            video_prompt = shot.get("video_prompt") or "，".join(
+                str(part) for part in [
+                    visual.get("subject_action"),
+                    camera.get("camera_movement"),
+                    visual.get("mood")
+                ] if part
+            ) or image_prompt
+
+            shots.append({
+                "shot_id": shot.get("shot_id") or f"SHOT_{str(i+1).zfill(3)}",
+                "image_prompt": image_prompt,
+                "video_prompt": video_prompt
+            })
+        return shots
+
+    def _prepare(self, project_id: str, storyboard: Optional[Dict[str, Any]], options: Dict[str, Any]) -> Dict[str, Any]:
+        """构建本次运行的状态，沿用上次运行中prompt未变化且文件仍存在的阶段结果"""
+        if storyboard is None:
+            storyboard = self._latest_storyboard(project_id)
+        if not storyboard or not storyboard.get("storyboard"):
+            raise ValueError("No storyboard available for production")
+
+        video_mode = options.get("video_mode", "i2v")
+        if video_mode not in self.VIDEO_MODES:
+            raise ValueError(f"Unknown video_mode: {video_mode}")
+
+        image_model = self.generation_service.resolve_model("text-to-image", options.get("image_model"))
+        video_model = self.generation_service.resolve_model(self.VIDEO_MODES[video_mode], options.get("video_model"))
+
+        previous = self.project_manager.load_production_state(project_id) or {}
+        previous_shots = previous.get("shots", {})
+        project_path = Path(self.project_manager.base_path) / project_id
+
+        shots = self.build_shots(storyboard, options)
+        state_shots = {}
+        for index, shot in enumerate(shots):
+            image_key = self._stage_key(image_model, shot["image_prompt"], options.get("size"))
+            video_key = self._stage_key(video_model, video_mode, shot["video_prompt"],
+                                        options.get("resolution"), options.get("duration"))
+            old = previous_shots.get(shot["shot_id"], {})
+
+            image = self._reuse_stage(old.get("image"), image_key, project_path)
+            video = self._reuse_stage(old.get("video"), video_key, project_path)
+            # 图片重新生成时视频也必须重新生成
+            if image["status"] != "done":
+                video = self._new_stage(video_key)
+
+            state_shots[shot["shot_id"]] = {
+                "index": index,
+                "image_prompt": shot["image_prompt"],
+                "video_prompt": shot["video_prompt"],
+                "image": image,
+                "video": video
+            }
+
+        # 首尾帧模式下尾帧是下一镜头的图片，下一镜头图片重新生成时本镜头视频也要重新生成
+        if video_mode == "keyframe":
+            ordered = sorted(state_shots.values(), key=lambda s: s["index"])
+            for current, following in zip(ordered, ordered[1:]):
+                if following["image"]["status"] != "done":
+                    current["video"] = self._new_stage(current["video"]["key"])
+
+        state = {
+            "project_id": project_id,
+            "status": "running",
+            "started_at": datetime.now().isoformat(),
+            "updated_at": datetime.now().isoformat(),
+            "video_mode": video_mode,
+            "models": {"image": image_model, "video": video_model},
+            "options": options,
+            "shots": state_shots
+        }
+        state["summary"] = self._summarize(state)
+        self.project_manager.save_production_state(project_id, state)
+        return state
+
+    async def _execute(self, project_id: str, state: Dict[str, Any]) -> Dict[str, Any]:
+        """并发推进所有镜头"""
+        options = state["options"]
+        ordered = sorted(state["shots"].items(), key=lambda item: item[1]["index"])
+
+        # 每个镜头图片阶段的Future，首尾帧模式下视频阶段需要等待下一镜头的图片
+        image_futures: Dict[str, asyncio.Future] = {}
+
+        async def run_image(shot_id: str, shot: Dict[str, Any]) -> Optional[str]:
+            stage = shot["image"]
+            if stage["status"] == "done":
+                return stage["path"]
+            path = await self._run_stage(project_id, state, stage, "text-to-image", {
+                "project_id": project_id,
+                "model": state["models"]["image"],
+                "prompt": shot["image_prompt"],
+                "negative_prompt": options.get("negative_prompt", ""),
+                "size": options.get("size", "1920*1080")
+            })
+            return path
+
+        async def run_shot(position: int, shot_id: str, shot: Dict[str, Any]) -> None:
+            image_path = await image_futures[shot_id]
+            stage = shot["video"]
+            if stage["status"] == "done":
+                return
+            if not image_path:
+                self._update(project_id, state, stage, status="skipped", error="image stage failed or cancelled")
+                return
+
+            if state["video_mode"] == "keyframe":
+                # 最后一个镜头没有下一镜头，首尾帧使用同一张图片
+                last_path = image_path
+                if position + 1 < len(ordered):
+                    last_path = await image_futures[ordered[position + 1][0]] or image_path
+                await self._run_stage(project_id, state, stage, "keyframe-video", {
+                    "project_id": project_id,
+                    "model": state["models"]["video"],
+                    "first_frame_path": image_path,
+                    "last_frame_path": last_path,
+                    "prompt": shot["video_prompt"],
+                    "resolution": options.get("resolution", "720P")
+                })
+            else:
+                await self._run_stage(project_id, state, stage, "image-to-video", {
+                    "project_id": project_id,
+                    "model": state["models"]["video"],
+                    "image_path": image_path,
+                    "prompt": shot["video_prompt"],
+                    "negative_prompt": options.get("negative_prompt", ""),
+                    "duration": options.get("duration", 5),
+                    "resolution": options.get("resolution", "1280*720")
+                })
+
+        try:
+            for shot_id, shot in ordered:
+                image_futures[shot_id] = asyncio.ensure_future(run_image(shot_id, shot))
+            await asyncio.gather(*[
+                run_shot(position, shot_id, shot) for position, (shot_id, shot) in enumerate(ordered)
+            ])
+            summary = self._summarize(state)
+            state["status"] = "completed" if summary["videos_done"] == summary["total_shots"] else "partial"
+        except asyncio.CancelledError:
+            for future in image_futures.values():
+                future.cancel()
+            await asyncio.gather(*image_futures.values(), return_exceptions=True)
+            state["status"] = "cancelled"
+            state["finished_at"] = datetime.now().isoformat()
+            self._persist(project_id, state)
+            print(f"🛑 Production cancelled for project {project_id}")
+            raise
+        except Exception as e:
+            state["status"] = "failed"
+            state["error"] = str(e)
+            print(f"❌ Production failed for project {project_id}: {e}")
+
+        state["finished_at"] = datetime.now().isoformat()
+        self._persist(project_id, state)
+        return state
+
+    async def _run_stage(self,
+                         project_id: str,
+                         state: Dict[str, Any],
+                         stage: Dict[str, Any],
+                         task_type: str,
+                         data: Dict[str, Any]) -> Optional[str]:
+        """执行一个阶段，返回保存到项目中的相对路径（失败时返回None）"""
+        self._update(project_id, state, stage, status="running", started_at=datetime.now().isoformat(), error=None)
+        try:
+            # 流水线任务按批量优先级调度，不挤占交互式请求
+            result = await self.generation_service.generate(task_type, {"priority": "batch", **data})
+            saved = result.get("saved_path") or result.get("result_path")
+            if not saved:
+                raise RuntimeError("generation returned no output")
+            path = self._relative_path(project_id, saved)
+            self._update(project_id, state, stage, status="done", path=path,
+                         model=result.get("model_used"), finished_at=datetime.now().isoformat())
+            return path
+        except asyncio.CancelledError:
+            # 整个流水线被取消
+            self._update(project_id, state, stage, status="cancelled", finished_at=datetime.now().isoformat())
+            raise
+        except GenerationCancelledError:
+            # 单个阶段的生成作业被取消，其他镜头继续
+            self._update(project_id, state, stage, status="cancelled", finished_at=datetime.now().isoformat())
+            return None
+        except Exception as e:
+            self._update(project_id, state, stage, status="failed", error=str(e),
+                         finished_at=datetime.now().isoformat())
+            return None
+
+    def _update(self, project_id: str, state: Dict[str, Any], stage: Dict[str, Any], **fields) -> None:
+        """更新阶段状态并持久化"""
+        stage.update(fields)
+        self._persist(project_id, state)
+
+    def _persist(self, project_id: str, state: Dict[str, Any]) -> None:
+        state["updated_at"] = datetime.now().isoformat()
+        state["summary"] = self._summarize(state)
+        self.project_manager.save_production_state(project_id, state)
+
+    @staticmethod
+    def _summarize(state: Dict[str, Any]) -> Dict[str, int]:
+        shots = state["shots"].values()
+        summary = {"total_shots": len(state["shots"])}
+        for stage in ["image", "video"]:
+            for status in ["done", "running", "failed"]:
+                summary[f"{stage}s_{status}"] = sum(1 for shot in shots if shot[stage]["status"] == status)
+        return summary
+
+    def _latest_storyboard(self, project_id: str) -> Optional[Dict[str, Any]]:
+        """项目中最新保存的分镜脚本"""
+        prompts = self.project_manager.get_project_prompts(project_id, "storyboard")
+        if not prompts:
+            return None
+        return max(prompts, key=lambda p: p["created_at"])["content"]
+
+    def _relative_path(self, project_id: str, path: str) -> str:
+        project_path = Path(self.project_manager.base_path) / project_id
+        try:
+            return str(Path(path).resolve().relative_to(project_path.resolve()))
+        except ValueError:
+            return path
+
+    @staticmethod
+    def _stage_key(*parts: Any) -> str:
+        """阶段输入的指纹，输入不变时可以复用上次的结果"""
+        return hashlib.sha256("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def _new_stage(key: str) -> Dict[str, Any]:
+        return {"status": "pending", "key": key, "path": None, "error": None}
+
+    def _reuse_stage(self, old: Optional[Dict[str, Any]], key: str, project_path: Path) -> Dict[str, Any]:
+        if old and old.get("status") == "done" and old.get("key") == key and old.get("path"):
+            path = Path(old["path"])
+            if (path if path.is_absolute() else project_path / path).exists():
+                return old
+        return self._new_stage(key)
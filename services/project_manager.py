@@ -7,17 +7,25 @@ import os
 import json
 import uuid
 import shutil
+import threading
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 
 
 class ProjectManager:
     """项目管理器"""
     
+    # Agent结果的输入哈希索引文件（位于prompts目录下）
+    AGENT_INDEX_FILE = "_agent_index.json"
+    # 长篇故事分块分析结果的缓存文件（位于prompts目录下，按分块哈希保存）及保留条数
+    CHUNK_CACHE_FILE = "_chunk_cache.json"
+    CHUNK_CACHE_SIZE = 512
+    
     def __init__(self, base_path: str = "./projects"):
         self.base_path = Path(base_path)
         self.base_path.mkdir(exist_ok=True)
+        self._index_lock = threading.Lock()
     
     def create_project(self, name: str, description: str = "") -> Dict[str, Any]:
         """创建新项目"""
@@ -173,8 +181,9 @@ class ProjectManager:
         
         return str(target_path)
     
-    def save_prompt(self, project_id: str, prompt_type: str, filename: str, content: Dict[str, Any]) -> Optional[str]:
-        """保存生成的prompt"""
+    def save_prompt(self, project_id: str, prompt_type: str, filename: str, content: Dict[str, Any],
+                    input_hash: Optional[str] = None) -> Optional[str]:
+        """保存生成的prompt（提供input_hash时登记到Agent结果索引）"""
         project_path = self.base_path / project_id
         
         if not project_path.exists():
@@ -190,6 +199,12 @@ class ProjectManager:
         with open(file_path, "w", encoding="utf-8") as f:
             json.dump(content, f, indent=2, ensure_ascii=False)
         
+        if input_hash:
+            with self._index_lock:
+                index = self._load_agent_index(project_path)
+                index.setdefault(prompt_type, {})[input_hash] = filename
+                self._write_agent_index(project_path, index)
+        
         # 记录到历史
         self._add_history(project_id, "prompt_generated", {
             "type": prompt_type,
@@ -199,38 +214,166 @@ class ProjectManager:
         
         return str(file_path)
     
-    def save_output(self, project_id: str, output_type: str, file_path: str) -> Optional[str]:
-        """保存生成的输出"""
+    def find_prompt_by_hash(self, project_id: str, prompt_type: str, input_hash: str) -> Optional[Dict[str, Any]]:
+        """根据输入哈希查找已保存的Agent结果，未找到返回None"""
         project_path = self.base_path / project_id
         
         if not project_path.exists():
             return None
         
-        source = Path(file_path)
-        if not source.exists():
+        with self._index_lock:
+            index = self._load_agent_index(project_path)
+            filename = index.get(prompt_type, {}).get(input_hash)
+            if not filename:
+                return None
+            
+            file_path = project_path / "prompts" / prompt_type / f"{filename}.json"
+            if not file_path.exists():
+                # 结果文件已被删除，清理失效的索引项
+                del index[prompt_type][input_hash]
+                self._write_agent_index(project_path, index)
+                return None
+        
+        with open(file_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    
+    def _load_agent_index(self, project_path: Path) -> Dict[str, Dict[str, str]]:
+        """读取Agent结果索引，不存在时从已保存结果的_metadata重建（跳过降级结果）"""
+        index_path = project_path / "prompts" / self.AGENT_INDEX_FILE
+        if index_path.exists():
+            with open(index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        
+        index: Dict[str, Dict[str, str]] = {}
+        prompts_dir = project_path / "prompts"
+        if not prompts_dir.exists():
+            return index
+        
+        for type_dir in prompts_dir.iterdir():
+            if not type_dir.is_dir():
+                continue
+            # 按修改时间排序，同一哈希保留最新的结果
+            for file_path in sorted(type_dir.glob("*.json"), key=lambda p: p.stat().st_mtime):
+                try:
+                    with open(file_path, "r", encoding="utf-8") as f:
+                        metadata = json.load(f).get("_metadata", {})
+                    input_hash = metadata.get("input_hash")
+                except (OSError, ValueError, AttributeError):
+                    continue
+                # 未通过输出校验的降级结果不登记
+                if input_hash and metadata.get("output_valid", True):
+                    index.setdefault(type_dir.name, {})[input_hash] = file_path.stem
+        
+        return index
+    
+    def _write_agent_index(self, project_path: Path, index: Dict[str, Dict[str, str]]) -> None:
+        """写入Agent结果索引"""
+        index_path = project_path / "prompts" / self.AGENT_INDEX_FILE
+        with open(index_path, "w", encoding="utf-8") as f:
+            json.dump(index, f, indent=2, ensure_ascii=False)
+    
+    def load_chunk_analyses(self, project_id: str, keys: List[str]) -> Dict[str, Dict[str, Any]]:
+        """读取项目中已保存的分块分析结果，返回 分块哈希 -> 分析结果（只包含找到的分块）"""
+        project_path = self.base_path / project_id
+        if not project_path.exists() or not keys:
+            return {}
+        
+        with self._index_lock:
+            cache = self._load_chunk_cache(project_path)
+        return {key: cache[key] for key in keys if key in cache}
+    
+    def save_chunk_analyses(self, project_id: str, analyses: Dict[str, Dict[str, Any]]) -> None:
+        """保存分块分析结果（超过CHUNK_CACHE_SIZE时淘汰最早保存的条目）"""
+        project_path = self.base_path / project_id
+        if not (project_path / "prompts").exists() or not analyses:
+            return
+        
+        with self._index_lock:
+            cache = self._load_chunk_cache(project_path)
+            for key, analysis in analyses.items():
+                cache.pop(key, None)
+                cache[key] = analysis
+            while len(cache) > self.CHUNK_CACHE_SIZE:
+                cache.pop(next(iter(cache)))
+            cache_path = project_path / "prompts" / self.CHUNK_CACHE_FILE
+            tmp_path = cache_path.with_suffix(".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(cache, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, cache_path)
+    
+    def _load_chunk_cache(self, project_path: Path) -> Dict[str, Dict[str, Any]]:
+        """读取分块分析缓存（调用方持有锁）"""
+        cache_path = project_path / "prompts" / self.CHUNK_CACHE_FILE
+        if not cache_path.exists():
+            return {}
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def save_production_state(self, project_id: str, state: Dict[str, Any]) -> Optional[str]:
+        """保存成片生产流水线的镜头状态（先写临时文件再替换，避免读到写了一半的文件）"""
+        project_path = self.base_path / project_id
+        
+        if not project_path.exists():
             return None
         
-        # 确定目标路径
-        output_dir = project_path / "outputs" / output_type
-        if not output_dir.exists():
+        state_path = project_path / "production_state.json"
+        temp_path = state_path.with_suffix(".json.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2, ensure_ascii=False)
+        os.replace(temp_path, state_path)
+        
+        return str(state_path)
+    
+    def load_production_state(self, project_id: str) -> Optional[Dict[str, Any]]:
+        """读取成片生产流水线的镜头状态"""
+        state_path = self.base_path / project_id / "production_state.json"
+        
+        if not state_path.exists():
             return None
         
-        # 生成唯一文件名
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{timestamp}_{source.name}"
-        target_path = output_dir / filename
+        with open(state_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    
+    def save_output(self, project_id: str, output_type: str, file_path: str) -> Optional[str]:
+        """保存生成的输出"""
+        return self.save_outputs(project_id, output_type, [file_path])[0]
+    
+    def save_outputs(self, project_id: str, output_type: str, file_paths: List[str]) -> List[Optional[str]]:
+        """批量保存生成的输出（多张变体图等），所有文件的历史记录一次写入"""
+        project_path = self.base_path / project_id
+        output_dir = project_path / "outputs" / output_type
+        
+        if not project_path.exists() or not output_dir.exists():
+            return [None] * len(file_paths)
         
-        # 移动文件
-        shutil.move(str(source), str(target_path))
+        saved_paths = []
+        history_entries = []
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        for file_path in file_paths:
+            source = Path(file_path)
+            if not source.exists():
+                saved_paths.append(None)
+                continue
+            
+            # 生成唯一文件名并移动文件
+            filename = f"{timestamp}_{source.name}"
+            target_path = output_dir / filename
+            shutil.move(str(source), str(target_path))
+            
+            saved_paths.append(str(target_path))
+            history_entries.append(("output_generated", {
+                "type": output_type,
+                "filename": filename,
+                "path": str(target_path.relative_to(project_path))
+            }))
         
         # 记录到历史
-        self._add_history(project_id, "output_generated", {
-            "type": output_type,
-            "filename": filename,
-            "path": str(target_path.relative_to(project_path))
-        })
+        self._add_history_entries(project_id, history_entries)
         
-        return str(target_path)
+        return saved_paths
     
     def get_project_prompts(self, project_id: str, prompt_type: Optional[str] = None) -> List[Dict[str, Any]]:
         """获取项目的prompts"""
@@ -300,17 +443,23 @@ class ProjectManager:
     
     def _add_history(self, project_id: str, action: str, details: Dict[str, Any]) -> None:
         """添加历史记录"""
+        self._add_history_entries(project_id, [(action, details)])
+    
+    def _add_history_entries(self, project_id: str, entries: List[Tuple[str, Dict[str, Any]]]) -> None:
+        """添加多条历史记录（只读写一次元数据）"""
+        if not entries:
+            return
         metadata = self.get_project(project_id)
         if not metadata:
             return
         
-        history_entry = {
-            "timestamp": datetime.now().isoformat(),
-            "action": action,
-            "details": details
-        }
-        
-        metadata["history"].append(history_entry)
+        timestamp = datetime.now().isoformat()
+        for action, details in entries:
+            metadata["history"].append({
+                "timestamp": timestamp,
+                "action": action,
+                "details": details
+            })
         
         # 限制历史记录数量
         if len(metadata["history"]) > 100:
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+生成请求指纹
+由任务类型、模型和规范化后的请求参数计算，输入图片按内容哈希参与计算（与路径无关），
+用于结果缓存与并发请求合并
+"""
+
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Any, Optional, Tuple
+
+# 按内容哈希参与指纹的输入文件字段
+INPUT_FILE_FIELDS = ("image_path", "first_frame_path", "last_frame_path")
+# 文件哈希记忆的条目上限
+MAX_MEMO_ENTRIES = 4096
+
+_lock = threading.Lock()
+_file_hashes: Dict[Tuple[str, int, int], str] = {}
+
+
+def file_hash(path: str) -> Optional[str]:
+    """输入文件的sha256（按路径、大小和修改时间记忆），文件不存在时返回None"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _lock:
+        if key in _file_hashes:
+            return _file_hashes[key]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    with _lock:
+        if len(_file_hashes) >= MAX_MEMO_ENTRIES:
+            _file_hashes.clear()
+        _file_hashes[key] = digest.hexdigest()
+    return digest.hexdigest()
+
+
+def request_fingerprint(task_type: str, model: str, params: Dict[str, Any]) -> Tuple[Optional[str], bool]:
+    """
+    计算请求指纹，返回 (指纹, 是否指定了seed)；输入文件不存在时指纹为None
+
+    Args:
+        task_type: 任务类型
+        model: 模型名称
+        params: 规范化后的请求参数（输入文件为完整路径）
+    """
+    canonical = {}
+    for key, value in params.items():
+        if key in INPUT_FILE_FIELDS and value:
+            content_hash = file_hash(value)
+            if content_hash is None:
+                return None, False
+            canonical[key] = f"sha256:{content_hash}"
+        else:
+            canonical[key] = value
+
+    payload = json.dumps({"task_type": task_type, "model": model, "params": canonical},
+                         ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest(), params.get("seed") is not None
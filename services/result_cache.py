@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+生成结果缓存
+以请求指纹（见request_fingerprint.py）索引已生成的文件，
+清单保存在缓存目录的manifest.json中，总大小超过上限时按最近使用时间淘汰；
+命中时只在内存中更新最近使用时间，清单按间隔批量写入。
+未指定seed的请求结果不确定，只有显式允许时才复用
+"""
+
+import atexit
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+from config.settings import GENERATION_CACHE
+
+
+class CacheMissError(LookupError):
+    """cache=only 时缓存未命中"""
+    pass
+
+
+class GenerationResultCache:
+    """按请求指纹复用生成结果的磁盘缓存"""
+
+    MANIFEST_FILE = "manifest.json"
+    # 命中缓存只更新最近使用时间时，清单最多每隔该秒数写入一次
+    MANIFEST_FLUSH_INTERVAL = 30
+    # 请求级缓存策略：bypass不读缓存（结果仍写入）、prefer优先读缓存、only只读缓存
+    MODES = ("bypass", "prefer", "only")
+
+    def __init__(self,
+                 cache_dir: Optional[str] = None,
+                 max_bytes: Optional[int] = None,
+                 reuse_unseeded: Optional[bool] = None):
+        """
+        Args:
+            cache_dir: 缓存目录（清单与文件）
+            max_bytes: 缓存文件总大小上限
+            reuse_unseeded: 默认是否复用未指定seed的请求结果
+        """
+        self.cache_dir = Path(cache_dir or GENERATION_CACHE["dir"])
+        self.files_dir = self.cache_dir / "files"
+        self.files_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes or GENERATION_CACHE["max_bytes"]
+        self.reuse_unseeded = GENERATION_CACHE["reuse_unseeded"] if reuse_unseeded is None else reuse_unseeded
+        self._lock = threading.Lock()
+        self._manifest = self._load_manifest()
+        # 内存中的清单是否有尚未写入的最近使用时间
+        self._dirty = False
+        self._written_at = time.monotonic()
+        # 进程退出时写入尚未保存的最近使用时间
+        atexit.register(self.flush)
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    # ==================== 清单 ====================
+
+    def _load_manifest(self) -> Dict[str, Dict[str, Any]]:
+        manifest_path = self.cache_dir / self.MANIFEST_FILE
+        if not manifest_path.exists():
+            return {}
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return {}
+
+    def _write_manifest(self) -> None:
+        """原子写入清单（调用方持有锁）"""
+        manifest_path = self.cache_dir / self.MANIFEST_FILE
+        tmp_path = manifest_path.with_suffix(".json.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, manifest_path)
+        self._dirty = False
+        self._written_at = time.monotonic()
+
+    def flush(self) -> None:
+        """写入尚未保存的最近使用时间"""
+        with self._lock:
+            if self._dirty:
+                self._write_manifest()
+
+    def _evict(self) -> None:
+        """按最近使用时间淘汰，直到总大小不超过上限（调用方持有锁）"""
+        total = sum(entry["size"] for entry in self._manifest.values())
+        for fingerprint, entry in sorted(self._manifest.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            (self.files_dir / entry["file"]).unlink(missing_ok=True)
+            del self._manifest[fingerprint]
+            total -= entry["size"]
+            self._stats["evictions"] += 1
+
+    # ==================== 读写 ====================
+
+    def lookup(self, fingerprint: str) -> Optional[Path]:
+        """查找缓存文件，命中时更新最近使用时间（清单按MANIFEST_FLUSH_INTERVAL批量写入）"""
+        with self._lock:
+            entry = self._manifest.get(fingerprint)
+            if entry:
+                cached_path = self.files_dir / entry["file"]
+                if cached_path.exists():
+                    entry["last_used"] = time.time()
+                    entry["hits"] = entry.get("hits", 0) + 1
+                    self._stats["hits"] += 1
+                    self._dirty = True
+                    if time.monotonic() - self._written_at >= self.MANIFEST_FLUSH_INTERVAL:
+                        self._write_manifest()
+                    return cached_path
+                # 文件已被删除，清理失效条目
+                del self._manifest[fingerprint]
+                self._write_manifest()
+            self._stats["misses"] += 1
+            return None
+
+    def store(self, fingerprint: str, source_path: str, metadata: Optional[Dict[str, Any]] = None) -> Optional[Path]:
+        """
+        将生成的文件复制进缓存（视频文件较大，应在线程中调用）
+
+        Args:
+            fingerprint: 请求指纹
+            source_path: 生成的文件
+            metadata: 随清单保存的附加信息（任务类型、模型等）
+        """
+        source = Path(source_path)
+        if not source.exists():
+            return None
+        size = source.stat().st_size
+        if size > self.max_bytes:
+            return None
+
+        filename = f"{fingerprint}{source.suffix}"
+        target = self.files_dir / filename
+        tmp_target = target.with_name(f".{filename}.{uuid.uuid4().hex[:8]}")
+        shutil.copyfile(source, tmp_target)
+        os.replace(tmp_target, target)
+
+        with self._lock:
+            now = time.time()
+            self._manifest[fingerprint] = {
+                **(metadata or {}),
+                "file": filename,
+                "size": size,
+                "created_at": datetime.now().isoformat(),
+                "last_used": now,
+                "hits": 0
+            }
+            self._stats["stores"] += 1
+            self._evict()
+            self._write_manifest()
+        return target
+
+    def materialize(self, cached_path: Path, output_dir: Path) -> str:
+        """将缓存文件复制到API输出目录（后续保存到项目时会被移动），返回新路径（视频文件较大，应在线程中调用）"""
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        target = output_dir / f"cached_{timestamp}_{uuid.uuid4().hex[:8]}{cached_path.suffix}"
+        shutil.copyfile(cached_path, target)
+        return str(target)
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存命中率和占用空间"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._manifest)
+            stats["bytes"] = sum(entry["size"] for entry in self._manifest.values())
+        stats["max_bytes"] = self.max_bytes
+        stats["reuse_unseeded"] = self.reuse_unseeded
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
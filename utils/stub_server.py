@@ -0,0 +1,563 @@
+#!/usr/bin/env python3
+"""
+DashScope / 本地T2V 桩服务
+模拟通义千问、通义万相、Claude以及局域网T2V服务的接口协议（含异步任务的查询与取消），用于离线压测
+
+用法:
+    python -m utils.stub_server --port 8899 --latency lognormal:-2.5,0.5 --throttle-rate 0.05
+
+然后将客户端指向桩服务:
+    DASHSCOPE_BASE_URL=http://127.0.0.1:8899/api/v1
+    LOCAL_T2V_BASE_URL=http://127.0.0.1:8899
+    CLAUDE_BASE_URL=http://127.0.0.1:8899
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import struct
+import time
+import uuid
+import zlib
+from typing import Dict, Any, Optional, Callable
+
+from aiohttp import web
+
+
+def parse_distribution(spec: str) -> Callable[[], float]:
+    """
+    解析延迟分布描述，返回采样函数（单位：秒）
+
+    支持: fixed:0.1 / uniform:0.05,0.3 / exp:0.2 / lognormal:mu,sigma
+    """
+    kind, _, args = spec.partition(":")
+    params = [float(x) for x in args.split(",") if x.strip()] if args else []
+
+    if kind == "fixed":
+        value = params[0] if params else 0.0
+        return lambda: value
+    if kind == "uniform":
+        low, high = params
+        return lambda: random.uniform(low, high)
+    if kind == "exp":
+        mean = params[0]
+        return lambda: random.expovariate(1.0 / mean) if mean > 0 else 0.0
+    if kind == "lognormal":
+        mu, sigma = params
+        return lambda: random.lognormvariate(mu, sigma)
+
+    raise ValueError(f"Unsupported distribution: {spec}")
+
+
+def make_tiny_png(width: int = 8, height: int = 8) -> bytes:
+    """生成一张纯色小PNG图片"""
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    raw = b"".join(b"\x00" + b"\x80\x80\xff" * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw))
+            + chunk(b"IEND", b""))
+
+
+def make_fake_mp4(size: int) -> bytes:
+    """生成一段带ftyp头的伪MP4数据（仅用于下载链路测试）"""
+    header = struct.pack(">I", 24) + b"ftypmp42" + struct.pack(">I", 0) + b"mp42isom"
+    padding = max(0, size - len(header) - 8)
+    return header + struct.pack(">I", padding + 8) + b"free" + b"\x00" * padding
+
+
+class StubConfig:
+    """桩服务配置"""
+
+    def __init__(self,
+                 latency: str = "fixed:0.05",
+                 failure_rate: float = 0.0,
+                 throttle_rate: float = 0.0,
+                 task_failure_rate: float = 0.0,
+                 image_duration: str = "uniform:2,5",
+                 video_duration: str = "uniform:10,30",
+                 local_duration: str = "uniform:10,30",
+                 media_bytes: int = 256 * 1024,
+                 key_concurrency: int = 0):
+        """
+        Args:
+            latency: 每个HTTP请求的响应延迟分布
+            failure_rate: 返回HTTP 500的概率
+            throttle_rate: 返回HTTP 429的概率
+            task_failure_rate: 异步任务最终FAILED的概率
+            image_duration: 图片任务耗时分布
+            video_duration: 视频任务耗时分布
+            local_duration: 本地T2V任务耗时分布
+            media_bytes: 伪视频文件大小
+            key_concurrency: 每个API Key同时未结束的异步任务上限（0为不限），超出时返回HTTP 429
+        """
+        self.latency = parse_distribution(latency)
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.task_failure_rate = task_failure_rate
+        self.durations = {
+            "image": parse_distribution(image_duration),
+            "video": parse_distribution(video_duration),
+            "local": parse_distribution(local_duration)
+        }
+        self.media_bytes = media_bytes
+        self.key_concurrency = key_concurrency
+
+
+class StubServer:
+    """DashScope / 本地T2V / Claude 桩服务"""
+
+    def __init__(self, config: Optional[StubConfig] = None):
+        self.config = config or StubConfig()
+        self.tasks: Dict[str, Dict[str, Any]] = {}
+        self.files: Dict[str, bytes] = {
+            "image.png": make_tiny_png(),
+            "video.mp4": make_fake_mp4(self.config.media_bytes)
+        }
+        self.cached_prefixes = set()
+        self.stats = {
+            "requests": {},
+            "responses": {},
+            "in_flight": 0,
+            "peak_in_flight": 0,
+            # API Key -> 提交的异步任务数
+            "tasks_by_key": {},
+            "started_at": time.time()
+        }
+
+    def build_app(self) -> web.Application:
+        """构建aiohttp应用"""
+        app = web.Application(middlewares=[self._middleware], client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/api/v1/services/aigc/text-generation/generation", self.text_generation)
+        app.router.add_post("/api/v1/services/aigc/text2image/image-synthesis", self.image_synthesis)
+        app.router.add_post("/api/v1/services/aigc/video-generation/video-synthesis", self.video_synthesis)
+        app.router.add_post("/api/v1/services/aigc/image2video/video-synthesis", self.video_synthesis)
+        app.router.add_post("/api/v1/services/aigc/multimodal-generation/generation", self.multimodal_generation)
+        app.router.add_get("/api/v1/tasks/{task_id}", self.task_status)
+        app.router.add_post("/api/v1/tasks/{task_id}/cancel", self.task_cancel)
+        app.router.add_post("/v1/messages", self.claude_messages)
+        app.router.add_post("/generate_video_minimal", self.local_submit)
+        app.router.add_get("/task_status/{job_id}", self.local_status)
+        app.router.add_get("/proxy_video/{job_id}", self.local_download)
+        app.router.add_get("/files/{name}", self.serve_file)
+        app.router.add_get("/_stub/stats", self.get_stats)
+        return app
+
+    # ==================== 通用处理 ====================
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        """统一注入延迟、限流和故障"""
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        self.stats["requests"][route] = self.stats["requests"].get(route, 0) + 1
+        self.stats["in_flight"] += 1
+        self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.stats["in_flight"])
+
+        try:
+            await asyncio.sleep(max(0.0, self.config.latency()))
+
+            if not request.path.startswith("/_stub"):
+                roll = random.random()
+                if roll < self.config.throttle_rate:
+                    response = web.json_response({
+                        "code": "Throttling.RateQuota",
+                        "message": "Requests rate limit exceeded, please try again later.",
+                        "request_id": str(uuid.uuid4())
+                    }, status=429)
+                    return self._count(route, response)
+                if roll < self.config.throttle_rate + self.config.failure_rate:
+                    response = web.json_response({
+                        "code": "InternalError",
+                        "message": "Stub injected failure.",
+                        "request_id": str(uuid.uuid4())
+                    }, status=500)
+                    return self._count(route, response)
+
+            return self._count(route, await handler(request))
+        finally:
+            self.stats["in_flight"] -= 1
+
+    def _count(self, route: str, response: web.StreamResponse) -> web.StreamResponse:
+        """统计响应状态码"""
+        key = f"{route} {response.status}"
+        self.stats["responses"][key] = self.stats["responses"].get(key, 0) + 1
+        return response
+
+    def _file_url(self, request: web.Request, name: str) -> str:
+        """构造桩服务上的媒体文件URL"""
+        return f"{request.scheme}://{request.host}/files/{name}"
+
+    def _create_task(self, kind: str, result: Dict[str, Any], owner: str = "") -> Dict[str, Any]:
+        """创建一个模拟的异步任务"""
+        task_id = str(uuid.uuid4())
+        now = time.time()
+        task = {
+            "task_id": task_id,
+            "kind": kind,
+            "owner": owner,
+            "submitted_at": now,
+            "finish_at": now + max(0.0, self.config.durations[kind]()),
+            "will_fail": random.random() < self.config.task_failure_rate,
+            "result": result
+        }
+        self.tasks[task_id] = task
+        return task
+
+    def _task_state(self, task: Dict[str, Any]) -> str:
+        """根据时间推算任务状态"""
+        if task.get("canceled"):
+            return "CANCELED"
+        now = time.time()
+        if now >= task["finish_at"]:
+            return "FAILED" if task["will_fail"] else "SUCCEEDED"
+
+        # 前10%的时间处于排队状态
+        elapsed = now - task["submitted_at"]
+        total = task["finish_at"] - task["submitted_at"]
+        return "PENDING" if elapsed < total * 0.1 else "RUNNING"
+
+    @staticmethod
+    def _format_time(timestamp: float) -> str:
+        """DashScope风格的时间字符串（毫秒精度）"""
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)) + f".{int(timestamp * 1000) % 1000:03d}"
+
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        return max(1, len(text) // 4)
+
+    def _fake_completion(self, prompt_text: str) -> str:
+        """返回一个合法的JSON文本作为模型回复"""
+        return json.dumps({
+            "stub_response": True,
+            "prompt_digest": hashlib.md5(prompt_text.encode("utf-8")).hexdigest()[:8]
+        }, ensure_ascii=False)
+
+    # ==================== DashScope 接口 ====================
+
+    async def text_generation(self, request: web.Request) -> web.Response:
+        """通义千问文本生成（同步）"""
+        body = await request.json()
+        messages = body.get("input", {}).get("messages", [])
+        prompt_text = "".join(str(m.get("content", "")) for m in messages)
+        content = self._fake_completion(prompt_text)
+
+        return web.json_response({
+            "output": {
+                "choices": [{
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": content}
+                }]
+            },
+            "usage": {
+                "input_tokens": self._estimate_tokens(prompt_text),
+                "output_tokens": self._estimate_tokens(content),
+                "total_tokens": self._estimate_tokens(prompt_text) + self._estimate_tokens(content)
+            },
+            "request_id": str(uuid.uuid4())
+        })
+
+    async def _submit_async(self, request: web.Request, kind: str, result: Dict[str, Any]) -> web.Response:
+        """异步任务提交的通用处理"""
+        if request.headers.get("X-DashScope-Async") != "enable":
+            return web.json_response({
+                "code": "AccessDenied",
+                "message": "current user api does not support synchronous calls",
+                "request_id": str(uuid.uuid4())
+            }, status=403)
+
+        owner = request.headers.get("Authorization", "")
+        if self.config.key_concurrency:
+            running = sum(1 for task in self.tasks.values()
+                          if task.get("owner") == owner and self._task_state(task) in ("PENDING", "RUNNING"))
+            if running >= self.config.key_concurrency:
+                return web.json_response({
+                    "code": "Throttling.RateQuota",
+                    "message": "Requests rate limit exceeded, please try again later.",
+                    "request_id": str(uuid.uuid4())
+                }, status=429)
+
+        task = self._create_task(kind, result, owner)
+        self.stats["tasks_by_key"][owner[-8:]] = self.stats["tasks_by_key"].get(owner[-8:], 0) + 1
+        return web.json_response({
+            "output": {"task_id": task["task_id"], "task_status": "PENDING"},
+            "request_id": str(uuid.uuid4())
+        })
+
+    async def image_synthesis(self, request: web.Request) -> web.Response:
+        """通义万相文生图"""
+        body = await request.json()
+        n = int(body.get("input", {}).get("n", 1) or 1)
+        urls = [{"url": self._file_url(request, "image.png")} for _ in range(n)]
+        return await self._submit_async(request, "image", {"results": urls})
+
+    async def video_synthesis(self, request: web.Request) -> web.Response:
+        """通义万相文生视频 / 图生视频 / 首尾帧视频"""
+        await request.json()
+        return await self._submit_async(request, "video", {"video_url": self._file_url(request, "video.mp4")})
+
+    async def task_status(self, request: web.Request) -> web.Response:
+        """查询异步任务状态（与DashScope一致，只能查询本Key提交的任务）"""
+        task = self.tasks.get(request.match_info["task_id"])
+        if not task or task.get("owner", "") != request.headers.get("Authorization", ""):
+            return web.json_response({
+                "output": {"task_id": request.match_info["task_id"], "task_status": "UNKNOWN"},
+                "request_id": str(uuid.uuid4())
+            })
+
+        state = self._task_state(task)
+        output = {"task_id": task["task_id"], "task_status": state}
+        output["submit_time"] = self._format_time(task["submitted_at"])
+        if state in ("SUCCEEDED", "FAILED"):
+            output["end_time"] = self._format_time(task["finish_at"])
+        if state == "SUCCEEDED":
+            output.update(task["result"])
+        elif state == "FAILED":
+            output.update({"code": "InternalError", "message": "Stub injected task failure."})
+
+        return web.json_response({
+            "output": output,
+            "usage": {"video_duration": 5, "video_ratio": "1280*720"} if task["kind"] == "video" else {},
+            "request_id": str(uuid.uuid4())
+        })
+
+    async def task_cancel(self, request: web.Request) -> web.Response:
+        """取消异步任务（与DashScope一致，只能取消排队中的任务）"""
+        task = self.tasks.get(request.match_info["task_id"])
+        if (not task or task.get("owner", "") != request.headers.get("Authorization", "")
+                or self._task_state(task) != "PENDING"):
+            return web.json_response({
+                "code": "UnsupportedOperation",
+                "message": "Failed to cancel the task, please confirm if the task is in PENDING status.",
+                "request_id": str(uuid.uuid4())
+            }, status=400)
+        task["canceled"] = True
+        return web.json_response({"request_id": str(uuid.uuid4())})
+
+    async def multimodal_generation(self, request: web.Request) -> web.Response:
+        """通义千问图片编辑（同步）"""
+        await request.json()
+        await asyncio.sleep(max(0.0, self.config.durations["image"]()))
+        return web.json_response({
+            "output": {
+                "choices": [{
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": [{"image": self._file_url(request, "image.png")}]}
+                }]
+            },
+            "usage": {"width": 8, "height": 8, "image_count": 1},
+            "request_id": str(uuid.uuid4())
+        })
+
+    # ==================== Claude 接口 ====================
+
+    async def claude_messages(self, request: web.Request) -> web.Response:
+        """Anthropic Messages API，模拟提示词缓存的写入与命中"""
+        body = await request.json()
+
+        cached_tokens = 0
+        creation_tokens = 0
+        uncached_text = ""
+        prefix_text = ""
+
+        blocks = []
+        system = body.get("system")
+        if isinstance(system, list):
+            blocks.extend(system)
+        elif system:
+            blocks.append({"type": "text", "text": system})
+        for message in body.get("messages", []):
+            content = message.get("content")
+            if isinstance(content, list):
+                blocks.extend(content)
+            else:
+                blocks.append({"type": "text", "text": str(content)})
+
+        # 最后一个cache_control之前（含）的内容视为可缓存前缀
+        last_breakpoint = max((i for i, b in enumerate(blocks) if b.get("cache_control")), default=-1)
+        for i, block in enumerate(blocks):
+            if i <= last_breakpoint:
+                prefix_text += block.get("text", "")
+            else:
+                uncached_text += block.get("text", "")
+
+        if prefix_text:
+            digest = hashlib.sha256(prefix_text.encode("utf-8")).hexdigest()
+            if digest in self.cached_prefixes:
+                cached_tokens = self._estimate_tokens(prefix_text)
+            else:
+                creation_tokens = self._estimate_tokens(prefix_text)
+                self.cached_prefixes.add(digest)
+
+        content = self._fake_completion(prefix_text + uncached_text)
+        message = {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model"),
+            "content": [{"type": "text", "text": content}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": self._estimate_tokens(uncached_text),
+                "output_tokens": self._estimate_tokens(content),
+                "cache_creation_input_tokens": creation_tokens,
+                "cache_read_input_tokens": cached_tokens
+            }
+        }
+
+        if not body.get("stream"):
+            return web.json_response(message)
+
+        return await self._stream_claude_message(request, message)
+
+    async def _stream_claude_message(self, request: web.Request, message: Dict[str, Any]) -> web.StreamResponse:
+        """以SSE事件流返回Claude消息"""
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        async def send(event_type: str, data: Dict[str, Any]):
+            data["type"] = event_type
+            payload = f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+            await response.write(payload.encode("utf-8"))
+
+        text = message["content"][0]["text"]
+        start_message = dict(message, content=[], stop_reason=None)
+        start_message["usage"] = dict(message["usage"], output_tokens=1)
+
+        await send("message_start", {"message": start_message})
+        await send("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+        for i in range(0, len(text), 16):
+            await send("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": text[i:i + 16]}})
+        await send("content_block_stop", {"index": 0})
+        await send("message_delta", {
+            "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+            "usage": {"output_tokens": message["usage"]["output_tokens"]}
+        })
+        await send("message_stop", {})
+        await response.write_eof()
+        return response
+
+    # ==================== 本地T2V 接口 ====================
+
+    async def local_submit(self, request: web.Request) -> web.Response:
+        """提交本地T2V任务"""
+        body = await request.json()
+        if not body.get("positive"):
+            return web.json_response({"detail": [{"loc": ["body", "positive"], "msg": "field required"}]}, status=422)
+
+        task = self._create_task("local", {"outputs": [{"filename": "video.mp4", "type": "output", "subfolder": ""}]})
+        return web.json_response({"job_id": task["task_id"], "status": "pending"})
+
+    async def local_status(self, request: web.Request) -> web.Response:
+        """查询本地T2V任务状态"""
+        job_id = request.match_info["job_id"]
+        task = self.tasks.get(job_id)
+        if not task:
+            return web.json_response({"status": "not_found", "message": f"job {job_id} not found"})
+
+        state = self._task_state(task)
+        if state == "PENDING":
+            queued_before = sum(1 for t in self.tasks.values()
+                                if t["kind"] == "local" and t["submitted_at"] < task["submitted_at"]
+                                and self._task_state(t) == "PENDING")
+            return web.json_response({"status": "pending", "queue_position": queued_before + 1})
+        if state == "RUNNING":
+            elapsed = time.time() - task["submitted_at"]
+            total = task["finish_at"] - task["submitted_at"]
+            return web.json_response({"status": "running", "progress": f"{int(elapsed / total * 100)}%"})
+        if state == "FAILED":
+            return web.json_response({"status": "failed", "message": "Stub injected task failure."})
+
+        return web.json_response({
+            "status": "completed",
+            "outputs": task["result"]["outputs"],
+            "execution_time": task["finish_at"] - task["submitted_at"],
+            "completed_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(task["finish_at"]))
+        })
+
+    async def local_download(self, request: web.Request) -> web.StreamResponse:
+        """下载本地T2V生成的视频"""
+        if request.match_info["job_id"] not in self.tasks:
+            return web.json_response({"detail": "job not found"}, status=404)
+        return self._bytes_response(request, self.files["video.mp4"], "video/mp4")
+
+    # ==================== 媒体文件与统计 ====================
+
+    async def serve_file(self, request: web.Request) -> web.StreamResponse:
+        """提供伪媒体文件下载（支持Range）"""
+        name = request.match_info["name"]
+        if name not in self.files:
+            return web.Response(status=404)
+        content_type = "image/png" if name.endswith(".png") else "video/mp4"
+        return self._bytes_response(request, self.files[name], content_type)
+
+    def _bytes_response(self, request: web.Request, data: bytes, content_type: str) -> web.Response:
+        """返回字节内容，处理 Range: bytes=N- 请求"""
+        range_header = request.headers.get("Range", "")
+        if range_header.startswith("bytes="):
+            start_text, _, end_text = range_header[len("bytes="):].partition("-")
+            start = int(start_text or 0)
+            end = int(end_text) if end_text else len(data) - 1
+            if start >= len(data):
+                return web.Response(status=416, headers={"Content-Range": f"bytes */{len(data)}"})
+            return web.Response(
+                status=206,
+                body=data[start:end + 1],
+                content_type=content_type,
+                headers={"Content-Range": f"bytes {start}-{end}/{len(data)}", "Accept-Ranges": "bytes"}
+            )
+        return web.Response(body=data, content_type=content_type, headers={"Accept-Ranges": "bytes"})
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        """桩服务统计"""
+        stats = dict(self.stats)
+        stats["tasks"] = len(self.tasks)
+        stats["uptime"] = time.time() - self.stats["started_at"]
+        return web.json_response(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DashScope / 本地T2V 桩服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8899)
+    parser.add_argument("--latency", default="fixed:0.05", help="请求延迟分布，如 uniform:0.05,0.3")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="HTTP 500 概率")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="HTTP 429 概率")
+    parser.add_argument("--task-failure-rate", type=float, default=0.0, help="异步任务失败概率")
+    parser.add_argument("--image-duration", default="uniform:2,5", help="图片任务耗时分布")
+    parser.add_argument("--video-duration", default="uniform:10,30", help="视频任务耗时分布")
+    parser.add_argument("--local-duration", default="uniform:10,30", help="本地T2V任务耗时分布")
+    parser.add_argument("--media-bytes", type=int, default=256 * 1024, help="伪视频文件大小")
+    parser.add_argument("--key-concurrency", type=int, default=0, help="每个API Key的并发任务上限（0为不限）")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    config = StubConfig(
+        latency=args.latency,
+        failure_rate=args.failure_rate,
+        throttle_rate=args.throttle_rate,
+        task_failure_rate=args.task_failure_rate,
+        image_duration=args.image_duration,
+        video_duration=args.video_duration,
+        local_duration=args.local_duration,
+        media_bytes=args.media_bytes,
+        key_concurrency=args.key_concurrency
+    )
+
+    server = StubServer(config)
+    print(f"🧪 桩服务启动: http://{args.host}:{args.port}")
+    print(f"   DASHSCOPE_BASE_URL=http://{args.host}:{args.port}/api/v1")
+    print(f"   LOCAL_T2V_BASE_URL=http://{args.host}:{args.port}")
+    print(f"   CLAUDE_BASE_URL=http://{args.host}:{args.port}")
+    web.run_app(server.build_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
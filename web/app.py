@@ -23,6 +23,12 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 
 # 导入服务
 from services.project_manager import ProjectManager
+from services.async_runner import run_async, async_runner
+from services.generation_service import (
+    GenerationService, IdempotencyConflictError, GenerationCancelledError, ModelUnavailableError
+)
+from services.result_cache import GenerationResultCache, CacheMissError
+from services.production_pipeline import ProductionPipeline
 
 # 导入LLM
 from llm.free_llm import FreeLLM
@@ -33,10 +39,13 @@ except ImportError:
     CLAUDE_AVAILABLE = False
     print("Claude LLM not available (anthropic not installed)")
 
+from llm.telemetry import llm_telemetry
+
 # 导入Agents
 from agents.story_agent import StoryAnalysisAgent
 from agents.storyboard_agent import StoryboardAgent
 from agents.character_agent import CharacterDesignAgent
+from agents.pipeline import build_preproduction_pipeline
 
 # 导入所有图像/视频生成API
 from api.qwen_t2i_flash import QwenAPITester  # 文生图
@@ -45,6 +54,12 @@ from api.qwen_t2v_plus import QwenT2VPlusAPI  # 文生视频Plus
 from api.qwen_keyframe_plus import QwenKeyframePlusAPI  # 首尾帧视频
 from api.qwen_image_edit import QwenImageEditAPI  # 图片编辑
 from api.qwen_local_t2v import QwenLocalT2VAPI  # 本地文生视频
+from api.dashscope_client import dashscope_pool, task_poller
+from api.task_eta import task_eta
+from api.media_download import download_telemetry
+from api.image_encoding import image_uri_cache
+from api.task_journal import task_journal
+from api.credential_pool import credential_pool
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max
@@ -96,6 +111,19 @@ apis = {
     }
 }
 
+# 生成服务（按模型限制并发、复用相同请求的结果）和成片生产流水线
+result_cache = GenerationResultCache()
+generation_service = GenerationService(apis, project_manager, result_cache=result_cache)
+production_pipeline = ProductionPipeline(generation_service, project_manager)
+
+
+def start_task_recovery(debug: bool = False) -> None:
+    """在后台恢复任务日志中未完成的生成任务（调试模式下只在重载后的工作进程中执行）"""
+    if debug and os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
+        return
+    async_runner.submit(generation_service.recover_tasks())
+
+
 # 允许的文件扩展名
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'avi', 'mov'}
 
@@ -266,6 +294,8 @@ def execute_agent(agent_type):
     project_id = data.get('project_id')
     input_data = data.get('input_data', {})
     save_result = data.get('save_result', True)  # 是否保存结果
+    # 单独执行Agent用于反复调试，默认总是重新生成；传入use_cache=true时输入未变化则复用已有结果
+    use_cache = data.get('use_cache', False)
     
     if not project_id:
         return jsonify({"success": False, "error": "project_id is required"}), 400
@@ -273,16 +303,64 @@ def execute_agent(agent_type):
     try:
         agent = agents[agent_type]
         
-        # 创建事件循环来运行异步代码
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(agent.execute(project_id, input_data, save_result))
-        loop.close()
+        # 在常驻事件循环中运行异步代码
+        result = run_async(agent.execute(project_id, input_data, save_result, use_cache))
         
         return jsonify({"success": True, "result": result})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/api/pipelines/preproduction/execute', methods=['POST'])
+def execute_preproduction_pipeline():
+    """执行前期制作流水线：故事分析后并发执行分镜脚本和角色设计"""
+    required = ["story", "storyboard", "character"]
+    missing = [name for name in required if name not in agents]
+    if missing:
+        return jsonify({"success": False, "error": f"Agents not available: {', '.join(missing)}"}), 400
+    
+    data = request.json
+    project_id = data.get('project_id')
+    story = data.get('story')
+    save_result = data.get('save_result', True)
+    use_cache = data.get('use_cache', True)
+    
+    if not project_id:
+        return jsonify({"success": False, "error": "project_id is required"}), 400
+    if not story:
+        return jsonify({"success": False, "error": "story is required"}), 400
+    
+    pipeline_input = {
+        "story": story,
+        "requirements": data.get('requirements', ''),
+        "target_audience": data.get('target_audience', 'general'),
+        "duration": data.get('duration', 60)
+    }
+    
+    try:
+        pipeline = build_preproduction_pipeline(agents)
+        outcome = run_async(pipeline.run(project_id, pipeline_input, save_result, use_cache))
+        
+        return jsonify({"success": not outcome["errors"], **outcome})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/api/telemetry/llm', methods=['GET'])
+def get_llm_telemetry():
+    """获取按Agent/模型聚合的LLM调用统计"""
+    return jsonify({"success": True, "stats": llm_telemetry.snapshot()})
+
+@app.route('/api/telemetry/http', methods=['GET'])
+def get_http_telemetry():
+    """获取DashScope连接复用、集中轮询、任务耗时预估、媒体下载及图片编码缓存统计"""
+    return jsonify({
+        "success": True,
+        "stats": dashscope_pool.stats(),
+        "poller": task_poller.stats(),
+        "polling": task_eta.snapshot(),
+        "downloads": download_telemetry.snapshot(),
+        "image_cache": image_uri_cache.stats()
+    })
+
 # ==================== 模型API（支持选择） ====================
 
 @app.route('/api/models', methods=['GET'])
@@ -293,159 +371,159 @@ def list_models():
         models[task_type] = list(task_models.keys())
     return jsonify({"success": True, "models": models})
 
+@app.route('/api/models/health', methods=['GET'])
+def get_models_health():
+    """获取各模型的熔断状态、失败率以及各任务类型的降级顺序"""
+    return jsonify({
+        "success": True,
+        "breakers": generation_service.breakers.stats(),
+        "fallback_chains": {
+            task_type: generation_service.candidate_models(task_type, generation_service.resolve_model(task_type))
+            for task_type in apis
+        }
+    })
+
 @app.route('/api/generate/<task_type>', methods=['POST'])
 def generate_content(task_type):
     """通用生成接口，支持模型选择"""
-    if task_type not in apis:
-        return jsonify({"success": False, "error": f"Unknown task type: {task_type}"}), 400
-    
     data = request.json
-    model_name = data.get('model', None)
-    project_id = data.get('project_id')
-    
-    # 如果没有指定模型，使用第一个可用的
-    if not model_name:
-        model_name = list(apis[task_type].keys())[0]
     
-    if model_name not in apis[task_type]:
-        return jsonify({"success": False, "error": f"Unknown model: {model_name} for task: {task_type}"}), 400
+    try:
+        generation_service.resolve_model(task_type, data.get('model'))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
     
-    api = apis[task_type][model_name]
+    # 幂等键：请求头Idempotency-Key或请求体idempotency_key
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
     
     try:
-        result = None
-        
-        # 创建事件循环来运行异步代码
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        # 根据不同的任务类型调用不同的方法
-        if task_type == "text-to-image":
-            prompt = data.get('prompt', '')
-            negative_prompt = data.get('negative_prompt', '')
-            size = data.get('size', '1920*1080')
-            style = data.get('style', 'auto')
-            
-            # 使用QwenAPITester的内部方法
-            async def generate_image():
-                # 提交任务
-                task_id = await api._submit_generation_task(
-                    prompt=prompt,
-                    negative_prompt=negative_prompt,
-                    size=size,
-                    n=1,
-                    style=style,
-                    seed=None
-                )
-                # 轮询状态
-                result_data = await api._poll_task_status(task_id)
-                # 下载图片
-                if result_data and result_data.get("images"):
-                    image_url = result_data["images"][0]
-                    import time
-                    output_path = api.output_dir / f"gen_{int(time.time())}.png"
-                    await api._download_image(image_url, output_path)
-                    return str(output_path)
-                return None
-            
-            result = loop.run_until_complete(generate_image())
-            
-        elif task_type == "image-to-video":
-            image_path = data.get('image_path', '')
-            # 如果是相对路径，转换为项目的完整路径
-            if image_path and project_id and not os.path.isabs(image_path):
-                project_path = Path(project_manager.base_path) / project_id
-                image_path = str(project_path / image_path)
-            prompt = data.get('prompt', '')
-            negative_prompt = data.get('negative_prompt', '')
-            duration = data.get('duration', 5)
-            fps = data.get('fps', 30)
-            resolution = data.get('resolution', '1280*720')
-            # QwenI2VFlashAPI的generate_video方法
-            api_result = loop.run_until_complete(api.generate_video(
-                image_path, prompt, negative_prompt, duration, fps, resolution
-            ))
-            # 提取local_path作为result
-            result = api_result.get('local_path') if api_result and api_result.get('status') == 'success' else None
-            
-        elif task_type == "text-to-video":
-            prompt = data.get('prompt', '')
-            negative_prompt = data.get('negative_prompt', '')
-            duration = data.get('duration', 5)
-            fps = data.get('fps', 30)
-            resolution = data.get('resolution', '1920*1080')
-            style = data.get('style', 'realistic')
-            motion_strength = data.get('motion_strength', 0.5)
-            seed = data.get('seed')
-            # QwenT2VPlusAPI和QwenLocalT2VAPI的generate_text_to_video方法
-            api_result = loop.run_until_complete(api.generate_text_to_video(
-                prompt=prompt, 
-                negative_prompt=negative_prompt, 
-                duration=duration, 
-                fps=fps, 
-                resolution=resolution, 
-                seed=seed,
-                style=style, 
-                motion_strength=motion_strength
-            ))
-            # 提取local_path作为result
-            result = api_result.get('local_path') if api_result and api_result.get('status') == 'success' else None
-                
-        elif task_type == "keyframe-video":
-            first_frame = data.get('first_frame_path', '')
-            last_frame = data.get('last_frame_path', '')
-            # 转换路径
-            if project_id:
-                project_path = Path(project_manager.base_path) / project_id
-                if first_frame and not os.path.isabs(first_frame):
-                    first_frame = str(project_path / first_frame)
-                if last_frame and not os.path.isabs(last_frame):
-                    last_frame = str(project_path / last_frame)
-            prompt = data.get('prompt', '')
-            resolution = data.get('resolution', '720P')
-            prompt_extend = data.get('prompt_extend', True)
-            # QwenKeyframePlusAPI的generate_keyframe_video方法
-            api_result = loop.run_until_complete(api.generate_keyframe_video(
-                first_frame, last_frame, prompt, resolution, prompt_extend
-            ))
-            # 提取local_path作为result
-            result = api_result.get('local_path') if api_result and api_result.get('status') == 'success' else None
-            
-        elif task_type == "image-edit":
-            image_path = data.get('image_path', '')
-            # 转换路径
-            if image_path and project_id and not os.path.isabs(image_path):
-                project_path = Path(project_manager.base_path) / project_id
-                image_path = str(project_path / image_path)
-            instruction = data.get('edit_instruction', '')
-            negative_prompt = data.get('negative_prompt', '')
-            watermark = data.get('watermark', False)
-            # QwenImageEditAPI的edit_image方法
-            api_result = loop.run_until_complete(api.edit_image(
-                image_path, instruction, negative_prompt, watermark
-            ))
-            # 提取local_path作为result
-            result = api_result.get('local_path') if api_result and api_result.get('status') == 'success' else None
-        
-        loop.close()
-        
-        if result and project_id:
-            # 根据任务类型保存到相应目录
-            output_type = "references" if "image" in task_type else "videos"
-            saved_path = project_manager.save_output(project_id, output_type, result)
-            
-            return jsonify({
-                "success": True, 
-                "result_path": result,
-                "saved_path": saved_path,
-                "model_used": model_name
-            })
-        
-        return jsonify({"success": True, "result_path": result, "model_used": model_name})
+        result = run_async(generation_service.generate(task_type, data, idempotency_key))
+        return jsonify(result)
         
+    except IdempotencyConflictError as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+    except GenerationCancelledError as e:
+        return jsonify({"success": False, "error": str(e), "cancelled": True}), 409
+    except ModelUnavailableError as e:
+        response = jsonify({"success": False, "error": str(e), "retry_after": round(e.retry_after, 1)})
+        response.headers['Retry-After'] = str(max(1, int(e.retry_after)))
+        return response, 503
+    except CacheMissError as e:
+        return jsonify({"success": False, "error": str(e), "cache": "miss"}), 404
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/api/generate/jobs', methods=['GET'])
+def list_generation_jobs():
+    """列出进行中的生成作业"""
+    return jsonify({"success": True, "jobs": generation_service.list_jobs()})
+
+@app.route('/api/generate/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_generation_job(job_id):
+    """取消进行中的生成作业（停止轮询和下载、释放并发名额，并尽量取消服务商任务）"""
+    if not run_async(generation_service.cancel_job(job_id)):
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify({"success": True, "job_id": job_id})
+
+@app.route('/api/generation-cache', methods=['GET'])
+def get_generation_cache_stats():
+    """获取生成结果缓存的命中率、占用空间及重复请求合并统计"""
+    return jsonify({
+        "success": True,
+        "stats": result_cache.stats(),
+        "coalescing": generation_service.coalesce_stats()
+    })
+
+@app.route('/api/local-t2v/backends', methods=['GET'])
+def get_local_t2v_backends():
+    """获取本地T2V各节点的可用状态、进行中任务数和吞吐统计（check=true时先做健康检查）"""
+    pool = apis["text-to-video"]["local-t2v"].pool
+    if request.args.get('check', 'false').lower() == 'true':
+        run_async(pool.check_health(force=True))
+    return jsonify({
+        "success": True,
+        **pool.stats()
+    })
+
+@app.route('/api/task-journal', methods=['GET'])
+def get_task_journal():
+    """获取任务日志中各状态的任务数及未完成的任务"""
+    return jsonify({
+        "success": True,
+        **task_journal.stats(),
+        "pending": task_journal.pending()
+    })
+
+@app.route('/api/task-journal/recover', methods=['POST'])
+def recover_journal_tasks():
+    """立即恢复任务日志中未完成的任务（等待恢复结束）"""
+    try:
+        summary = run_async(generation_service.recover_tasks())
+        return jsonify({"success": True, **summary})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/api/scheduler', methods=['GET'])
+def get_scheduler_stats():
+    """获取各模型的并发占用、排队深度（按优先级和项目）和等待时间"""
+    return jsonify({
+        "success": True,
+        "models": generation_service.scheduler.stats()
+    })
+
+@app.route('/api/credentials', methods=['GET'])
+def get_credential_stats():
+    """获取各DashScope API Key的进行中任务数、提交/完成/限流次数和冷却状态"""
+    return jsonify({
+        "success": True,
+        **credential_pool.stats()
+    })
+
+@app.route('/api/pipelines/production/execute', methods=['POST'])
+def execute_production_pipeline():
+    """启动成片生产流水线：分镜 → 镜头图片 → 镜头视频（后台运行）"""
+    data = request.json
+    project_id = data.get('project_id')
+    
+    if not project_id or not project_manager.get_project(project_id):
+        return jsonify({"success": False, "error": "Project not found"}), 404
+    
+    options = {
+        key: data[key] for key in [
+            'video_mode', 'image_model', 'video_model', 'size',
+            'resolution', 'duration', 'style_prompt', 'negative_prompt'
+        ] if key in data
+    }
+    
+    try:
+        state = run_async(production_pipeline.start(project_id, data.get('storyboard'), options))
+        return jsonify({"success": True, "state": state}), 202
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+
+@app.route('/api/pipelines/production/<project_id>/cancel', methods=['POST'])
+def cancel_production_pipeline(project_id):
+    """取消项目正在运行的成片生产流水线（进行中的生成任务一并取消）"""
+    if not run_async(production_pipeline.cancel(project_id)):
+        return jsonify({"success": False, "error": "No running production"}), 404
+    return jsonify({"success": True, "state": production_pipeline.get_state(project_id)})
+
+@app.route('/api/pipelines/production/<project_id>', methods=['GET'])
+def get_production_state(project_id):
+    """获取成片生产流水线的镜头状态"""
+    state = production_pipeline.get_state(project_id)
+    if not state:
+        return jsonify({"success": False, "error": "No production state"}), 404
+    return jsonify({
+        "success": True,
+        "running": production_pipeline.is_running(project_id),
+        "state": state
+    })
+
 # ==================== 素材管理API ====================
 
 @app.route('/api/projects/<project_id>/assets', methods=['POST'])
@@ -565,4 +643,5 @@ def serve_asset_file(filename):
     return send_from_directory('assets', filename)
 
 if __name__ == '__main__':
+    start_task_recovery(debug=True)
     app.run(debug=True, port=30001)
\ No newline at end of file